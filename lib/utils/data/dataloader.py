@@ -3,11 +3,16 @@ import torch.multiprocessing as multiprocessing
 from torch._C import _set_worker_signal_handlers, _update_worker_pids, \
     _remove_worker_pids, _error_if_any_worker_fails
 from .sampler import SequentialSampler, RandomSampler, BatchSampler
+from . import profiler
 import signal
+import random
+import weakref
 import functools
 import collections
 import re
 import sys
+import math
+import time
 import threading
 import traceback
 from torch._six import string_classes, int_classes
@@ -31,7 +36,93 @@ _use_shared_memory = False
 """Whether to use shared memory in default_collate"""
 
 
-def _worker_loop(dataset, index_queue, data_queue, collate_fn, seed, init_fn, worker_id):
+def _seed_all(seed):
+    torch.manual_seed(seed)
+    np.random.seed(seed % 2**32)
+    random.seed(seed)
+
+
+class _SlotRef(object):
+    r"""Tells the main process that a batch of ``n`` samples is in a worker's shared memory slot; ``rest`` holds
+    the fields which are not tensors in samples, collated as usual"""
+
+    def __init__(self, worker_id, slot_id, n, rest, slot=None):
+        self.worker_id = worker_id
+        self.slot_id = slot_id
+        self.n = n
+        self.rest = rest
+        # tensors of the slot travel (as shared memory handles) only with the first batch written into it
+        self.slot = slot
+
+
+def _new_slot(template, elem, reuse=False):
+    r"""Allocates an empty shared memory batch with the structure and shapes of
+    the collated batch ``template`` for the fields which are tensors in its
+    sample ``elem``. Other fields (numbers, strings, numpy arrays) are None:
+    they are cheap to collate with every batch (see :func:`_collate_rest`).
+    With ``reuse``, tensors of ``template`` itself become the slot."""
+    if torch.is_tensor(elem):
+        if reuse:
+            return template
+        return template.new(template.storage()._new_shared(template.numel())).resize_(template.size())
+    elif isinstance(elem, collections.Mapping):
+        return {key: _new_slot(template[key], elem[key], reuse) for key in elem}
+    elif isinstance(elem, collections.Sequence) and not isinstance(elem, string_classes):
+        return [_new_slot(t, e, reuse) for t, e in zip(template, elem)]
+    return None
+
+
+def _collate_into(batch, slot):
+    r"""Like default_collate, but writes the tensor fields of the batch into
+    the preallocated ``slot``. Returns False if the batch does not fit the slot
+    (different structure, dtype, sample shape or more samples), in which case
+    the slot content is undefined."""
+    elem = batch[0]
+    if slot is None:  # not a tensor field, see _collate_rest
+        return True
+    elif torch.is_tensor(elem):
+        if not torch.is_tensor(slot) or elem.type() != slot.type() or len(batch) > slot.size(0) \
+                or elem.size() != slot.size()[1:]:
+            return False
+        torch.stack(batch, 0, out=slot.narrow(0, 0, len(batch)))
+        return True
+    elif isinstance(elem, collections.Mapping):
+        if not isinstance(slot, collections.Mapping) or set(elem) != set(slot):
+            return False
+        return all(_collate_into([d[key] for d in batch], slot[key]) for key in elem)
+    elif isinstance(elem, string_classes):
+        return False
+    elif isinstance(elem, collections.Sequence):
+        if not isinstance(slot, list) or len(elem) != len(slot):
+            return False
+        return all(_collate_into(list(samples), s) for samples, s in zip(zip(*batch), slot))
+    return False
+
+
+def _collate_rest(batch, slot):
+    r"""Collates the fields of a batch which ``slot`` does not hold (None),
+    after :func:`_collate_into` succeeded; tensor fields are None."""
+    if slot is None:
+        return default_collate(batch)
+    elif torch.is_tensor(slot):
+        return None
+    elif isinstance(slot, collections.Mapping):
+        return {key: _collate_rest([d[key] for d in batch], value) for key, value in slot.items()}
+    return [_collate_rest(list(samples), s) for samples, s in zip(zip(*batch), slot)]
+
+
+def _narrow_batch(slot, n, rest):
+    if slot is None:
+        return rest
+    elif torch.is_tensor(slot):
+        return slot.narrow(0, 0, n)
+    elif isinstance(slot, collections.Mapping):
+        return {key: _narrow_batch(value, n, rest[key]) for key, value in slot.items()}
+    return [_narrow_batch(value, n, r) for value, r in zip(slot, rest)]
+
+
+def _worker_loop(dataset, index_queue, data_queue, collate_fn, seed, init_fn, worker_id,
+                 num_slots=0, free_queue=None, load_times=None, load_counts=None, stats_queue=None):
     global _use_shared_memory
     _use_shared_memory = True
 
@@ -45,20 +136,69 @@ def _worker_loop(dataset, index_queue, data_queue, collate_fn, seed, init_fn, wo
     torch.manual_seed(seed)
     np.random.seed(seed)
 
+    if stats_queue is not None:
+        profiler.enable()
+
     if init_fn is not None:
         init_fn(worker_id)
 
+    slots = None  # shared memory batches owned by this worker, allocated from the first batch
+    free_slots = []
+    sent = set()
     while True:
         r = index_queue.get()
         if r is None:
             break
-        idx, batch_indices = r
+        idx, batch_indices, batch_seed = r
+        # RNG state depends only on the batch, not on which worker loads it, so it can be restored on resume
+        _seed_all(batch_seed)
+        start = time.time()
         try:
-            samples = collate_fn([dataset[i] for i in batch_indices])
+            samples = [dataset[i] for i in batch_indices]
+            with profiler.stage('collate') as stage:
+                if num_slots == 0:
+                    result = collate_fn(samples)
+                elif slots is None:
+                    # the first batch becomes slot 0 and fixes the shapes of all slots
+                    result = collate_fn(samples)
+                    slot = _new_slot(result, samples[0], reuse=True)
+                    if slot is None:  # no tensor field to hold
+                        num_slots = 0
+                    else:
+                        slots = [slot] + [_new_slot(result, samples[0]) for _ in range(num_slots - 1)]
+                        free_slots = list(range(1, num_slots))
+                        sent.add(0)
+                        result = _SlotRef(worker_id, 0, len(samples), _collate_rest(samples, slot), slot)
+                else:
+                    while not free_queue.empty() or len(free_slots) == 0:
+                        released = free_queue.get()
+                        if released is None:
+                            return
+                        free_slots.append(released)
+                    slot_id = free_slots.pop()
+                    fits = False
+                    try:
+                        if _collate_into(samples, slots[slot_id]):
+                            rest = _collate_rest(samples, slots[slot_id])
+                            fits = True
+                    finally:
+                        if not fits:  # also when collation raises, so the pool never shrinks
+                            free_slots.append(slot_id)
+                    if fits:
+                        result = _SlotRef(worker_id, slot_id, len(samples), rest,
+                                          slots[slot_id] if slot_id not in sent else None)
+                        sent.add(slot_id)
+                    else:  # e.g. a batch of another size, sent the usual way
+                        result = collate_fn(samples)
+                stage.nbytes = _batch_nbytes(result if not isinstance(result, _SlotRef) else slots[result.slot_id])
         except Exception:
-            data_queue.put((idx, ExceptionWrapper(sys.exc_info())))
-        else:
-            data_queue.put((idx, samples))
+            result = ExceptionWrapper(sys.exc_info())
+        if load_times is not None:
+            load_times[worker_id] += time.time() - start
+            load_counts[worker_id] += 1
+        if stats_queue is not None:  # before the batch, so its stages are in once the batch is
+            stats_queue.put(profiler.collect())
+        data_queue.put((idx, result))
 
 
 def _worker_manager_loop(in_queue, out_queue, done_event, pin_memory, device_id):
@@ -139,6 +279,37 @@ def default_collate(batch):
     raise TypeError((error_msg.format(type(batch[0]))))
 
 
+def pad_collate(batch):
+    """Like default_collate, but image tensors ``(..., H, W)`` of different
+    sizes are zero-padded at the bottom and right to the largest height and
+    width in the batch. For dict samples, the original ``(H, W)`` of each
+    sample's first image field is returned under ``'size'``."""
+
+    elem = batch[0]
+    if torch.is_tensor(elem) and elem.dim() >= 2:
+        h = max([x.size(-2) for x in batch])
+        w = max([x.size(-1) for x in batch])
+        shape = (len(batch),) + tuple(elem.size()[:-2]) + (h, w)
+        if _use_shared_memory:
+            numel = functools.reduce(lambda a, b: a * b, shape, 1)
+            out = elem.new(elem.storage()._new_shared(numel)).resize_(shape).zero_()
+        else:
+            out = elem.new_zeros(shape)
+        for i, x in enumerate(batch):
+            out[i, ..., :x.size(-2), :x.size(-1)].copy_(x)
+        return out
+    elif isinstance(elem, collections.Mapping):
+        out = {key: pad_collate([d[key] for d in batch]) for key in elem}
+        image_keys = [key for key in elem if torch.is_tensor(elem[key]) and elem[key].dim() >= 2]
+        if 'size' not in out and len(image_keys) > 0:
+            out['size'] = torch.LongTensor([list(d[image_keys[0]].size()[-2:]) for d in batch])
+        return out
+    elif isinstance(elem, collections.Sequence) and not isinstance(elem, string_classes):
+        transposed = zip(*batch)
+        return [pad_collate(samples) for samples in transposed]
+    return default_collate(batch)
+
+
 def pin_memory_batch(batch):
     if torch.is_tensor(batch):
         return batch.pin_memory()
@@ -182,19 +353,149 @@ def _set_SIGCHLD_handler():
     _SIGCHLD_handler_set = True
 
 
+def _batch_nbytes(batch):
+    if torch.is_tensor(batch):
+        return batch.numel() * batch.element_size()
+    elif isinstance(batch, collections.Mapping):
+        return sum(_batch_nbytes(value) for value in batch.values())
+    elif isinstance(batch, collections.Sequence) and not isinstance(batch, string_classes):
+        return sum(_batch_nbytes(value) for value in batch)
+    return 0
+
+
+class PrefetchTuner(object):
+    r"""Adapts the prefetch depth of a DataLoader, and its number of workers
+    between epochs, to how long the training loop waits for batches.
+
+    Every ``interval`` batches it compares the time the main process spent
+    blocked on worker results (``wait``) with the time spent outside the loader
+    (``compute``) and the mean time a worker needs per batch (``load``):
+
+    * if the loop waited more than ``grow_above`` of the time, ``num_workers``
+      more batches are prefetched, up to ``max_prefetch_factor * num_workers``
+      and to what fits in ``memory_budget``;
+    * if it waited less than ``shrink_below``, one batch less is prefetched,
+      down to ``num_workers``;
+    * the number of workers needed to keep up, ``ceil(load / compute) + 1``
+      within ``[1, max_workers]`` and the memory budget, is applied when the
+      next epoch's iterator is created.
+
+    Decisions are printed.
+
+    Arguments:
+        num_workers (int): initial number of workers
+        interval (int, optional): number of batches between decisions (default: 50)
+        max_workers (int, optional): upper limit of workers (default: number of CPUs - 1)
+        memory_budget (int, optional): bytes that prefetched and in flight batches
+            may take (default: no limit)
+        max_prefetch_factor (int, optional): upper limit of batches prefetched per
+            worker (default: 8)
+        grow_above (float, optional): waited fraction of time above which prefetch
+            grows (default: 0.05)
+        shrink_below (float, optional): waited fraction of time below which
+            prefetch shrinks (default: 0.01)
+    """
+
+    def __init__(self, num_workers, interval=50, max_workers=None, memory_budget=None,
+                 max_prefetch_factor=8, grow_above=0.05, shrink_below=0.01):
+        self.num_workers = num_workers
+        self.prefetch = 2 * num_workers
+        self.interval = interval
+        self.max_workers = max_workers if max_workers is not None else max(1, multiprocessing.cpu_count() - 1)
+        self.memory_budget = memory_budget
+        self.max_prefetch_factor = max_prefetch_factor
+        self.grow_above = grow_above
+        self.shrink_below = shrink_below
+        self.batch_bytes = None
+        self.start(None, None)
+
+    def start(self, load_times, load_counts):
+        """Starts a window of measurements on the worker counters of an iterator"""
+        self.load_times = load_times
+        self.load_counts = load_counts
+        self.wait = self.compute = 0.
+        self.batches = 0
+        self.last_load = (sum(load_times), sum(load_counts)) if load_times is not None else (0., 0)
+
+    def _max_batches(self):
+        if self.memory_budget is None or not self.batch_bytes:
+            return None
+        return max(1, int(self.memory_budget // self.batch_bytes))
+
+    def observe(self, batch, wait, compute):
+        """Records one batch returned to the training loop.
+
+        Arguments:
+            batch: the batch, used once to measure its size
+            wait (float): seconds the main process was blocked on workers for it
+            compute (float): seconds spent outside the loader since the previous batch
+        """
+        if self.batch_bytes is None:
+            self.batch_bytes = _batch_nbytes(batch)
+        self.wait += wait
+        self.compute += compute
+        self.batches += 1
+        if self.batches >= self.interval:
+            self._update()
+
+    def _update(self):
+        load_time, load_count = sum(self.load_times), sum(self.load_counts)
+        if load_count > self.last_load[1]:
+            load = (load_time - self.last_load[0]) / (load_count - self.last_load[1])
+        else:
+            load = None
+        waited = self.wait / max(self.wait + self.compute, 1e-9)
+        compute = self.compute / self.batches
+
+        max_batches = self._max_batches()
+        max_prefetch = self.max_prefetch_factor * self.num_workers
+        if max_batches is not None:
+            max_prefetch = min(max_prefetch, max(self.num_workers, max_batches - self.num_workers))
+
+        prefetch = self.prefetch
+        if waited > self.grow_above:
+            prefetch = min(max_prefetch, prefetch + self.num_workers)
+        elif waited < self.shrink_below:
+            prefetch = max(self.num_workers, prefetch - 1)
+        if prefetch != self.prefetch:
+            print('DataLoader: waited {:.1%} of the time, prefetch {} -> {} batches'.format(
+                waited, self.prefetch, prefetch))
+            self.prefetch = prefetch
+
+        if load is not None:
+            workers = min(self.max_workers, int(math.ceil(load / max(compute, 1e-9))) + 1)
+            if max_batches is not None:
+                workers = min(workers, max(1, max_batches // 2))
+            workers = max(1, workers)
+            if workers != self.num_workers:
+                print('DataLoader: {:.3f}s to load and {:.3f}s to use a batch, {} -> {} workers from next epoch'.format(
+                    load, compute, self.num_workers, workers))
+                # keep the same prefetch per worker
+                self.prefetch = max(workers, self.prefetch * workers // self.num_workers)
+                self.num_workers = workers
+
+        self.start(self.load_times, self.load_counts)
+
+
 class DataLoaderIter(object):
     "Iterates once over the DataLoader's dataset, as specified by the sampler"
 
-    def __init__(self, loader):
+    def __init__(self, loader, state=None):
         self.dataset = loader.dataset
         self.collate_fn = loader.collate_fn
         self.batch_sampler = loader.batch_sampler
         self.num_workers = loader.num_workers
         self.pin_memory = loader.pin_memory and torch.cuda.is_available()
         self.timeout = loader.timeout
+        self.batch_slots = loader.batch_slots
+        self.persistent_workers = loader.persistent_workers
+        self.in_order = loader.in_order
+        self.tuner = loader.tuner
+        self.profile = profiler.Profile('DataLoader stages') if loader.profile else None
+        self.loader_profiles = loader.profiles
+        self.stats_queue = None
         self.done_event = threading.Event()
-
-        self.sample_iter = iter(self.batch_sampler)
+        self._start_pass(state)
 
         if self.num_workers > 0:
             self.worker_init_fn = loader.worker_init_fn
@@ -203,16 +504,40 @@ class DataLoaderIter(object):
             self.batches_outstanding = 0
             self.worker_pids_set = False
             self.shutdown = False
-            self.send_idx = 0
-            self.rcvd_idx = 0
+            self.send_idx = self.rcvd_idx
             self.reorder_dict = {}
+            # index queue messages are numbered idx_base + batch index, monotonically over all passes, so
+            # results of an abandoned pass can be told apart from those of the current one
+            self.idx_base = 0
+            self.stale_outstanding = 0
+
+            # worker w gets free slot ids of its batch slots back through free_queues[w]
+            self.free_queues = [multiprocessing.SimpleQueue() if self.batch_slots > 0 else None
+                                for _ in range(self.num_workers)]
+            self.slot_cache = {}
+            self.held_slot = None
+
+            # number of batches kept in flight, adapted by the tuner if any
+            self.prefetch = self.tuner.prefetch if self.tuner is not None else 2 * self.num_workers
+            if self.tuner is not None:
+                # per worker: seconds spent loading batches and number of batches
+                self.load_times = multiprocessing.Array('d', self.num_workers, lock=False)
+                self.load_counts = multiprocessing.Array('l', self.num_workers, lock=False)
+                self.tuner.start(self.load_times, self.load_counts)
+            else:
+                self.load_times = self.load_counts = None
+            self.waited = 0.
+            self.last_return = None
+            if self.profile is not None:
+                self.stats_queue = multiprocessing.SimpleQueue()
 
-            base_seed = torch.LongTensor(1).random_(0, 2**31-1)[0]
+            base_seed = self.base_seed
             self.workers = [
                 multiprocessing.Process(
                     target=_worker_loop,
                     args=(self.dataset, self.index_queue, self.worker_result_queue, self.collate_fn,
-                          base_seed + i, self.worker_init_fn, i))
+                          base_seed + i, self.worker_init_fn, i, self.batch_slots, self.free_queues[i],
+                          self.load_times, self.load_counts, self.stats_queue))
                 for i in range(self.num_workers)]
 
             if self.pin_memory or self.timeout > 0:
@@ -240,47 +565,119 @@ class DataLoaderIter(object):
             self.worker_pids_set = True
 
             # prime the prefetch loop
-            for _ in range(2 * self.num_workers):
-                self._put_indices()
+            self._fill_prefetch()
+
+    def _start_pass(self, state):
+        # a resumed iterator replays the saved permutation and batch seeds from the first unconsumed batch
+        if state is not None:
+            self.batch_sampler.load_state_dict(state['batch_sampler'])
+            self.base_seed = state['base_seed']
+            self.rcvd_idx = state['batch_sampler']['start']
+            self.returned = set(state.get('skip', ()))
+        else:
+            self.base_seed = int(torch.LongTensor(1).random_(0, 2**31-1)[0])
+            self.rcvd_idx = 0
+            self.returned = set()
+        # rcvd_idx: all batches before it were returned; returned: batches after it which were returned as well
+        # (unordered delivery), they are neither sent again nor counted twice
+        self.sample_iter = iter(self.batch_sampler)
+        self.draining = False
+
+    def drain(self):
+        """Stops sending batches to workers: the iterator only returns the
+        batches already requested and then ends. With ``in_order=False`` this
+        closes the gaps listed in ``skip`` of :meth:`state_dict` without
+        prefetching, and so returning, any later batch."""
+        self.draining = True
+
+    def _reset(self, state=None):
+        """Starts a new pass over the batch sampler on the live workers (used
+        with ``persistent_workers``). Batches of the previous pass still in
+        flight are dropped as they arrive."""
+        self._release_slot()
+        self.idx_base += self.send_idx
+        self.stale_outstanding += self.batches_outstanding
+        self.batches_outstanding = 0
+        for batch in self.reorder_dict.values():
+            self._drop_batch(batch)
+        self.reorder_dict = {}
+
+        self._start_pass(state)
+        self.send_idx = self.rcvd_idx
+        self.last_return = None
+        if self.profile is not None:
+            self.profile = profiler.Profile(self.profile.title)
+        if self.tuner is not None:
+            self.tuner.start(self.load_times, self.load_counts)
+        self._fill_prefetch()
 
     def __len__(self):
         return len(self.batch_sampler)
 
     def _get_batch(self):
-        if self.timeout > 0:
-            try:
-                return self.data_queue.get(timeout=self.timeout)
-            except queue.Empty:
-                raise RuntimeError('DataLoader timed out after {} seconds'.format(self.timeout))
-        else:
-            return self.data_queue.get()
+        start = time.time()
+        try:
+            if self.timeout > 0:
+                try:
+                    return self.data_queue.get(timeout=self.timeout)
+                except queue.Empty:
+                    raise RuntimeError('DataLoader timed out after {} seconds'.format(self.timeout))
+            else:
+                return self.data_queue.get()
+        finally:
+            self.waited += time.time() - start
 
     def __next__(self):
         if self.num_workers == 0:  # same-process loading
-            indices = next(self.sample_iter)  # may raise StopIteration
-            batch = self.collate_fn([self.dataset[i] for i in indices])
+            while self.rcvd_idx in self.returned:  # resumed from an unordered run
+                self.returned.discard(self.rcvd_idx)
+                next(self.sample_iter)
+                self.rcvd_idx += 1
+            indices = next(self.sample_iter, None)
+            if indices is None:
+                self._end_profile()
+                raise StopIteration
+            self.rcvd_idx += 1
+            profiler.enable(self.profile is not None)
+            samples = [self.dataset[i] for i in indices]
+            with profiler.stage('collate') as stage:
+                batch = self.collate_fn(samples)
+                stage.nbytes = _batch_nbytes(batch)
+            if self.profile is not None:
+                self.profile.merge(profiler.collect())
+                profiler.enable(False)
             if self.pin_memory:
                 batch = pin_memory_batch(batch)
             return batch
 
+        # the previous batch has been used, its slot can be refilled
+        self._release_slot()
+
         # check if the next sample has already been generated
         if self.rcvd_idx in self.reorder_dict:
             batch = self.reorder_dict.pop(self.rcvd_idx)
-            return self._process_next_batch(batch)
+            return self._process_next_batch(batch, self.rcvd_idx)
 
         if self.batches_outstanding == 0:
-            self._shutdown_workers()
+            self._end_profile()
+            if not self.persistent_workers:
+                self._shutdown_workers()
             raise StopIteration
 
         while True:
             assert (not self.shutdown and self.batches_outstanding > 0)
             idx, batch = self._get_batch()
+            if idx < self.idx_base:  # left over from an abandoned pass
+                self.stale_outstanding -= 1
+                self._drop_batch(batch)
+                continue
+            idx -= self.idx_base
             self.batches_outstanding -= 1
-            if idx != self.rcvd_idx:
+            if self.in_order and idx != self.rcvd_idx:
                 # store out-of-order samples
                 self.reorder_dict[idx] = batch
                 continue
-            return self._process_next_batch(batch)
+            return self._process_next_batch(batch, idx)
 
     next = __next__  # Python 2 compatibility
 
@@ -288,21 +685,96 @@ class DataLoaderIter(object):
         return self
 
     def _put_indices(self):
-        assert self.batches_outstanding < 2 * self.num_workers
+        if self.draining or self.batches_outstanding >= self.prefetch:  # prefetch may have shrunk
+            return False
+        while self.send_idx in self.returned:  # resumed from an unordered run
+            next(self.sample_iter, None)
+            self.send_idx += 1
         indices = next(self.sample_iter, None)
         if indices is None:
-            return
-        self.index_queue.put((self.send_idx, indices))
+            return False
+        self.index_queue.put((self.idx_base + self.send_idx, indices, self.base_seed + self.send_idx))
         self.batches_outstanding += 1
         self.send_idx += 1
-
-    def _process_next_batch(self, batch):
-        self.rcvd_idx += 1
-        self._put_indices()
+        return True
+
+    def _fill_prefetch(self):
+        while self._put_indices():
+            pass
+
+    def _process_next_batch(self, batch, idx):
+        if self.profile is not None:
+            while not self.stats_queue.empty():
+                self.profile.merge(self.stats_queue.get())
+        self.returned.add(idx)
+        while self.rcvd_idx in self.returned:
+            self.returned.discard(self.rcvd_idx)
+            self.rcvd_idx += 1
         if isinstance(batch, ExceptionWrapper):
+            self._put_indices()
             raise batch.exc_type(batch.exc_msg)
+        if isinstance(batch, _SlotRef):
+            batch = self._take_slot(batch)
+        if self.tuner is not None:
+            now = time.time()
+            if self.last_return is not None:
+                self.tuner.observe(batch, self.waited, now - self.last_return - self.waited)
+            self.waited = 0.
+            self.last_return = now
+            self.prefetch = self.tuner.prefetch
+        self._fill_prefetch()
         return batch
 
+    def _take_slot(self, ref):
+        key = (ref.worker_id, ref.slot_id)
+        if ref.slot is not None:
+            self.slot_cache[key] = ref.slot
+        batch = _narrow_batch(self.slot_cache[key], ref.n, ref.rest)
+        if self.pin_memory:
+            # the pinned copy is independent of the slot, so the worker may refill it right away
+            batch = pin_memory_batch(batch)
+            self.free_queues[ref.worker_id].put(ref.slot_id)
+        else:
+            self.held_slot = ref
+        return batch
+
+    def _end_profile(self):
+        if self.profile is None:
+            return
+        while self.stats_queue is not None and not self.stats_queue.empty():
+            self.profile.merge(self.stats_queue.get())
+        if len(self.profile.stages) > 0:
+            print(self.profile.summary())
+        self.loader_profiles.append(self.profile)
+        self.profile = profiler.Profile(self.profile.title)
+
+    def _drop_batch(self, batch):
+        if isinstance(batch, _SlotRef):
+            if batch.slot is not None:
+                self.slot_cache[(batch.worker_id, batch.slot_id)] = batch.slot
+            self.free_queues[batch.worker_id].put(batch.slot_id)
+
+    def _release_slot(self):
+        if self.held_slot is not None:
+            self.free_queues[self.held_slot.worker_id].put(self.held_slot.slot_id)
+            self.held_slot = None
+
+    def state_dict(self):
+        """Returns the position of this iterator: the batch sampler state with
+        the number of batches already returned (not merely prefetched) and the
+        base seed from which each batch's worker RNG state is derived.
+
+        With ``in_order=False``, ``start`` is the first batch not returned yet
+        and ``skip`` lists the later batches which were already returned. Both
+        are honoured on resume whatever ``in_order`` of the resuming loader.
+
+        With ``num_workers=0`` samples are loaded with the main process RNG,
+        which is not part of this state."""
+        batch_sampler_state = self.batch_sampler.state_dict()
+        batch_sampler_state['start'] = self.rcvd_idx
+        return {'batch_sampler': batch_sampler_state, 'base_seed': self.base_seed,
+                'skip': sorted(self.returned)}
+
     def __getstate__(self):
         # TODO: add limited pickling support for sharing an iterator
         # across multiple threads for HOGWILD.
@@ -321,6 +793,10 @@ class DataLoaderIter(object):
                     self.data_queue.get()
                 for _ in self.workers:
                     self.index_queue.put(None)
+                # wake up workers waiting for a free batch slot
+                for free_queue in self.free_queues:
+                    if free_queue is not None:
+                        free_queue.put(None)
                 # done_event should be sufficient to exit worker_manager_thread,
                 # but be safe here and put another None
                 self.worker_result_queue.put(None)
@@ -366,6 +842,31 @@ class DataLoader(object):
         worker_init_fn (callable, optional): If not None, this will be called on each
             worker subprocess with the worker id (an int in ``[0, num_workers - 1]``) as
             input, after seeding and before data loading. (default: None)
+        batch_slots (int, optional): if positive, each worker preallocates this many
+            shared memory batches, shaped like its first batch, and collates every
+            following batch directly into a free one. Only a slot reference is sent
+            to the main process, so no storage is allocated, shared or pickled per
+            batch. Slots hold the fields which are tensors in samples; other fields
+            (e.g. an int index) are collated and sent with every batch. Batches of
+            another shape are sent the usual way. Requires
+            ``default_collate`` and ``num_workers > 0``. (default: 0)
+        profile (bool, optional): if ``True``, the dataset's pipeline stages (see
+            ``lib.utils.data.profiler``) and collation are timed in the workers,
+            merged in the main process and printed at the end of every pass; the
+            :class:`~lib.utils.data.profiler.Profile` of each pass is appended to
+            ``profiles`` for export. (default: False)
+        in_order (bool, optional): if ``False``, batches are returned as soon as any
+            worker finishes them instead of in sampler order, so one slow batch does
+            not hold back the finished ones. At most the prefetch depth of batches
+            are outstanding either way. (default: True)
+        adaptive (bool or PrefetchTuner, optional): if ``True`` (or a configured
+            :class:`PrefetchTuner`), the prefetch depth, fixed to ``2 * num_workers``
+            otherwise, follows how long the training loop waits for batches, and
+            ``num_workers`` is adjusted between epochs. (default: False)
+        persistent_workers (bool, optional): if ``True``, worker processes are not
+            shut down at the end of an epoch; the next ``iter(loader)`` sends them
+            the indices of the new epoch. Datasets, worker-local caches and batch
+            slots stay warm, and no process is forked per epoch. (default: False)
 
     .. note:: By default, each worker will have its PyTorch seed set to
               ``base_seed + worker_id``, where ``base_seed`` is a long generated
@@ -373,13 +874,28 @@ class DataLoader(object):
               this value in :attr:`worker_init_fn`, which can be used to set other seeds
               (e.g. NumPy) before data loading.
 
+    .. note:: Before loading each batch, a worker reseeds PyTorch, NumPy and ``random``
+              with ``base_seed + batch_index``, so augmentations of a batch do not depend
+              on which worker loads it. Together with :meth:`state_dict` this lets a
+              restarted job continue mid-epoch exactly where it stopped.
+
+    .. warning:: With :attr:`batch_slots`, a batch (unless pinned) is a view of a
+                 worker's slot and is overwritten once the next batch is requested.
+                 ``clone()`` tensors that must outlive the training step.
+
+    .. warning:: With :attr:`persistent_workers`, workers keep the copy of the dataset
+                 they were started with. Changes made to the dataset in the main
+                 process afterwards (e.g. a new transform) do not reach them; build
+                 a new DataLoader instead.
+
     .. warning:: If ``spawn'' start method is used, :attr:`worker_init_fn` cannot be an
                  unpicklable object, e.g., a lambda function.
     """
 
     def __init__(self, dataset, batch_size=1, shuffle=False, sampler=None, batch_sampler=None,
                  num_workers=0, collate_fn=default_collate, pin_memory=False, drop_last=False,
-                 timeout=0, worker_init_fn=None):
+                 timeout=0, worker_init_fn=None, batch_slots=0, persistent_workers=False, adaptive=False,
+                 in_order=True, profile=False):
         self.dataset = dataset
         self.batch_size = batch_size
         self.num_workers = num_workers
@@ -388,10 +904,32 @@ class DataLoader(object):
         self.drop_last = drop_last
         self.timeout = timeout
         self.worker_init_fn = worker_init_fn
+        self.batch_slots = batch_slots
+        self.persistent_workers = persistent_workers
+        self.in_order = in_order
+        self.profile = profile
+        self.profiles = []
 
         if timeout < 0:
             raise ValueError('timeout option should be non-negative')
 
+        if batch_slots < 0:
+            raise ValueError('batch_slots option should be non-negative')
+
+        if batch_slots > 0 and collate_fn is not default_collate:
+            raise ValueError('batch_slots requires default_collate')
+
+        if persistent_workers and num_workers == 0:
+            raise ValueError('persistent_workers option needs num_workers > 0')
+
+        if adaptive and num_workers == 0:
+            raise ValueError('adaptive option needs num_workers > 0')
+        if isinstance(adaptive, PrefetchTuner):
+            self.tuner = adaptive
+            self.tuner.batch_bytes = None  # batches of this loader may be of another size
+        else:
+            self.tuner = PrefetchTuner(num_workers) if adaptive else None
+
         if batch_sampler is not None:
             if batch_size > 1 or shuffle or sampler is not None or drop_last:
                 raise ValueError('batch_sampler is mutually exclusive with '
@@ -414,9 +952,44 @@ class DataLoader(object):
 
         self.sampler = sampler
         self.batch_sampler = batch_sampler
+        self._iterator = None
+        self._resume_state = None
+        self._workers_iterator = None
 
     def __iter__(self):
-        return DataLoaderIter(self)
+        if self.tuner is not None and self.tuner.num_workers != self.num_workers:
+            self.num_workers = self.tuner.num_workers
+            self._workers_iterator = None  # persistent workers are restarted with the new count
+        if self._workers_iterator is not None:
+            iterator = self._workers_iterator
+            iterator._reset(self._resume_state)
+        else:
+            iterator = DataLoaderIter(self, self._resume_state)
+            if self.persistent_workers:
+                # kept alive (with its workers) until the loader itself is deleted
+                self._workers_iterator = iterator
+        self._iterator = weakref.ref(iterator)
+        self._resume_state = None
+        return iterator
+
+    def state_dict(self):
+        """Returns the state of the current (or last) iterator, see
+        :meth:`DataLoaderIter.state_dict`."""
+        iterator = self._iterator() if self._iterator is not None else None
+        if iterator is None:
+            raise RuntimeError('DataLoader has no live iterator to save')
+        return iterator.state_dict()
+
+    def load_state_dict(self, state):
+        """Makes the next iterator resume from ``state``."""
+        self._resume_state = state
+
+    def shutdown(self):
+        """Stops the workers kept alive by ``persistent_workers``; a later
+        iteration starts new ones."""
+        if self._workers_iterator is not None:
+            self._workers_iterator._shutdown_workers()
+            self._workers_iterator = None
 
     def __len__(self):
         return len(self.batch_sampler)
@@ -1,6 +1,7 @@
 import math
+import numpy as np
 import torch
-from .sampler import Sampler
+from .sampler import Sampler, _index_dtype, _split
 from torch.distributed import get_world_size, get_rank
 
 
@@ -15,14 +16,32 @@ class DistributedSampler(Sampler):
     .. note::
         Dataset is assumed to be of constant size.
 
+    .. note::
+        :meth:`state_dict` saves the epoch and the position within it, so a
+        resumed job continues the same permutation where it stopped.
+
+    With ``shards``, whole storage shards (e.g. tar files, or offset ranges of
+    one tar, see :meth:`shards_from_offsets`) are assigned to ranks instead of
+    random samples, so each process only reads its own part of the storage
+    and can keep it in its page cache. Shards are dealt largest first to the
+    least loaded rank, which balances sample counts, and the resulting groups
+    of shards are handed to ranks in a random order; every rank is then padded
+    or truncated to ``num_samples`` with its own samples, shuffled per epoch.
+    There must be at least ``num_replicas`` shards.
+
     Arguments:
         dataset: Dataset used for sampling.
         num_replicas (optional): Number of processes participating in
             distributed training.
         rank (optional): Rank of the current process within num_replicas.
+        shards (array-like, optional): shard id of each sample of the dataset.
+        shuffle_shards (bool, optional): if ``True``, the assignment of shards
+            to ranks is drawn anew (deterministically) every epoch through
+            :meth:`set_epoch`; if ``False`` each rank keeps the same shards
+            for the whole run, which is best for local caches. (default: True)
     """
 
-    def __init__(self, dataset, num_replicas=None, rank=None):
+    def __init__(self, dataset, num_replicas=None, rank=None, shards=None, shuffle_shards=True):
         if num_replicas is None:
             num_replicas = get_world_size()
         if rank is None:
@@ -33,15 +52,57 @@ class DistributedSampler(Sampler):
         self.epoch = 0
         self.num_samples = int(math.ceil(len(self.dataset) * 1.0 / self.num_replicas))
         self.total_size = self.num_samples * self.num_replicas
+        self.shards = np.asarray(shards) if shards is not None else None
+        self.shuffle_shards = shuffle_shards
+        if self.shards is not None and len(self.shards) != len(self.dataset):
+            raise ValueError('shards must give the shard of every sample of the dataset')
+        if self.shards is not None and len(np.unique(self.shards)) < self.num_replicas:
+            raise ValueError('{} shards cannot feed {} replicas, every replica needs at least one shard'.format(
+                len(np.unique(self.shards)), self.num_replicas))
 
-    def __iter__(self):
+    @staticmethod
+    def shards_from_offsets(offsets, shard_bytes=1 << 30):
+        """Returns shard ids grouping samples of one archive into ranges of
+        ``shard_bytes`` of storage, e.g. from ``tar_offset`` of a metadata
+        sidecar."""
+        return np.asarray(offsets, dtype=np.int64) // shard_bytes
+
+    def _shard_indices(self, seed):
+        ids, inverse, counts = np.unique(self.shards, return_inverse=True, return_counts=True)
+
+        # deal shards largest first to the least loaded rank, ties broken at random
+        assign_rng = np.random.RandomState((seed if self.shuffle_shards else 0) % 2**32)
+        order = np.lexsort((assign_rng.permutation(len(ids)), -counts))
+        loads = np.zeros(self.num_replicas, dtype=np.int64)
+        owner = np.empty(len(ids), dtype=np.int64)
+        for shard in order:
+            rank = int(np.argmin(loads))
+            owner[shard] = rank
+            loads[rank] += counts[shard]
+        # with uneven shards the dealing hardly depends on the seed, so the seed also picks the rank of each group
+        owner = assign_rng.permutation(self.num_replicas)[owner]
+
+        indices = np.flatnonzero(owner[inverse] == self.rank).astype(_index_dtype(len(self.dataset)))
+        indices = indices[np.random.RandomState(seed % 2**32).permutation(len(indices))]
+
+        # pad with own samples (or truncate) to make all ranks the same length
+        if len(indices) < self.num_samples:
+            indices = np.resize(indices, self.num_samples)
+        return indices[:self.num_samples]
+
+    def _indices(self):
         # deterministically shuffle based on epoch
+        seed, start = self._begin(self.epoch)
+        if self.shards is not None:
+            return self._shard_indices(seed)[start:], start
+
         g = torch.Generator()
-        g.manual_seed(self.epoch)
-        indices = list(torch.randperm(len(self.dataset), generator=g))
+        g.manual_seed(seed)
+        n = len(self.dataset)
+        indices = torch.randperm(n, generator=g).numpy().astype(_index_dtype(n))
 
         # add extra samples to make it evenly divisible
-        indices += indices[:(self.total_size - len(indices))]
+        indices = np.concatenate([indices, indices[:(self.total_size - n)]])
         assert len(indices) == self.total_size
 
         # subsample
@@ -49,7 +110,16 @@ class DistributedSampler(Sampler):
         indices = indices[offset:offset + self.num_samples]
         assert len(indices) == self.num_samples
 
-        return iter(indices)
+        return indices[start:], start
+
+    def chunks(self):
+        """Yields the indices of this replica as index arrays."""
+        indices, _ = self._indices()
+        yield indices
+
+    def __iter__(self):
+        indices, start = self._indices()
+        return self._track_chunks(_split(indices), start)
 
     def __len__(self):
         return self.num_samples
@@ -0,0 +1,168 @@
+import json
+import math
+import time
+import torch
+
+_enabled = False
+"""Whether stages are recorded in this process"""
+
+_stats = {}
+"""Stage name -> StageStats recorded in this process since the last collect()"""
+
+NUM_BINS = 32
+"""Histogram bins: bin ``b > 0`` counts durations in ``[2**(b-1), 2**b)`` microseconds"""
+
+
+class StageStats(object):
+    r"""Wall time and bytes of one pipeline stage, with a log2 histogram of
+    durations so percentiles survive merging across workers."""
+
+    def __init__(self):
+        self.count = 0
+        self.seconds = 0.
+        self.nbytes = 0
+        self.hist = [0] * NUM_BINS
+
+    def add(self, seconds, nbytes=0):
+        self.count += 1
+        self.seconds += seconds
+        self.nbytes += nbytes
+        us = seconds * 1e6
+        self.hist[min(NUM_BINS - 1, int(math.log(us, 2)) + 1 if us >= 1 else 0)] += 1
+
+    def merge(self, other):
+        self.count += other.count
+        self.seconds += other.seconds
+        self.nbytes += other.nbytes
+        self.hist = [a + b for a, b in zip(self.hist, other.hist)]
+
+    def percentile(self, q):
+        """Returns the upper bound in seconds of the histogram bin holding the
+        ``q``-th quantile."""
+        rank, seen = q * self.count, 0
+        for b, n in enumerate(self.hist):
+            seen += n
+            if seen >= rank and n > 0:
+                return 2 ** b * 1e-6
+        return 0.
+
+    def to_dict(self):
+        return {'count': self.count, 'seconds': self.seconds, 'bytes': self.nbytes, 'hist': list(self.hist)}
+
+
+class _Stage(object):
+    __slots__ = ('name', 'nbytes', 'start')
+
+    def __init__(self, name, nbytes):
+        self.name = name
+        self.nbytes = nbytes
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, *exc):
+        record(self.name, time.time() - self.start, self.nbytes)
+        return False
+
+
+class _NullStage(object):
+    r"Stands in for _Stage when profiling is off; setting ``nbytes`` is harmless"
+
+    nbytes = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+_null_stage = _NullStage()
+
+
+def enable(flag=True):
+    global _enabled
+    _enabled = flag
+
+
+def is_enabled():
+    return _enabled
+
+
+def stage(name, nbytes=0):
+    r"""Context manager timing a pipeline stage. Assign the size of what the
+    stage produced to ``nbytes`` of the returned object, e.g.::
+
+        with profiler.stage('decode') as s:
+            image.load()
+            s.nbytes = profiler.nbytes(image)
+
+    Costs one attribute lookup when profiling is off."""
+    if not _enabled:
+        return _null_stage
+    return _Stage(name, nbytes)
+
+
+def record(name, seconds, nbytes=0):
+    if name not in _stats:
+        _stats[name] = StageStats()
+    _stats[name].add(seconds, nbytes)
+
+
+def nbytes(obj):
+    r"Size in bytes of a tensor, PIL image, numpy array or bytes object"
+    if torch.is_tensor(obj):
+        return obj.numel() * obj.element_size()
+    if hasattr(obj, 'getbands'):  # PIL image
+        return obj.size[0] * obj.size[1] * len(obj.getbands())
+    if hasattr(obj, 'nbytes'):
+        return int(obj.nbytes)
+    if isinstance(obj, (bytes, bytearray)):
+        return len(obj)
+    return 0
+
+
+def collect():
+    r"""Returns the stages recorded since the last call and starts over; used
+    by workers to ship their share to the main process."""
+    global _stats
+    stats, _stats = _stats, {}
+    return stats
+
+
+class Profile(object):
+    r"""Per-stage totals merged from all workers of a DataLoader pass.
+
+    Arguments:
+        title (str, optional): first line of :meth:`summary`
+    """
+
+    def __init__(self, title='DataLoader'):
+        self.title = title
+        self.stages = {}
+
+    def merge(self, stats):
+        for name, s in stats.items():
+            if name not in self.stages:
+                self.stages[name] = StageStats()
+            self.stages[name].merge(s)
+
+    def summary(self):
+        """Returns a table of stages, slowest total first: count, share of
+        total time, mean and approximate p50/p90/p99 duration and throughput."""
+        total = sum(s.seconds for s in self.stages.values()) or 1.
+        lines = [self.title,
+                 '{:<12}{:>10}{:>8}{:>10}{:>10}{:>10}{:>10}{:>10}'.format(
+                     'stage', 'count', 'share', 'mean ms', 'p50 ms', 'p90 ms', 'p99 ms', 'MB/s')]
+        for name, s in sorted(self.stages.items(), key=lambda item: -item[1].seconds):
+            lines.append('{:<12}{:>10}{:>8.1%}{:>10.2f}{:>10.2f}{:>10.2f}{:>10.2f}{:>10.1f}'.format(
+                name, s.count, s.seconds / total, 1e3 * s.seconds / max(s.count, 1),
+                1e3 * s.percentile(0.5), 1e3 * s.percentile(0.9), 1e3 * s.percentile(0.99),
+                s.nbytes / 1e6 / max(s.seconds, 1e-9)))
+        return '\n'.join(lines)
+
+    def export(self, path):
+        """Writes the stages as json."""
+        with open(path, 'w') as f:
+            json.dump({name: s.to_dict() for name, s in self.stages.items()}, f, indent=1)
@@ -1,6 +1,18 @@
+import math
+import numpy as np
 import torch
 
 
+def _index_dtype(n):
+    return np.int32 if n < 2**31 else np.int64
+
+
+def _split(indices, chunk_size=65536):
+    """Yields consecutive slices (views) of an index array."""
+    for start in range(0, len(indices), chunk_size):
+        yield indices[start:start + chunk_size]
+
+
 class Sampler(object):
     """Base class for all Samplers.
 
@@ -18,6 +30,52 @@ class Sampler(object):
     def __len__(self):
         raise NotImplementedError
 
+    def state_dict(self):
+        """Returns the seed of the current (or last) iteration and the number
+        of indices yielded by it so far."""
+        return {'seed': getattr(self, '_seed', None), 'start': getattr(self, '_yielded', 0)}
+
+    def load_state_dict(self, state):
+        """Makes the next iteration replay the one saved in ``state``, starting
+        after its first ``state['start']`` indices."""
+        self._resume = dict(state)
+
+    def _begin(self, seed=None, seeded=True):
+        """Starts an iteration and returns its ``(seed, start)``. A loaded state
+        takes precedence over ``seed``; if both are None and ``seeded``, a seed
+        is drawn from the default generator."""
+        resume = getattr(self, '_resume', None)
+        self._resume = None
+        if resume is not None:
+            seed, start = resume['seed'], resume['start']
+        else:
+            start = 0
+            if seed is None and seeded:
+                seed = int(torch.LongTensor(1).random_(0, 2**31 - 1)[0])
+        self._seed = seed
+        self._yielded = start
+        return seed, start
+
+    def _generator(self, seed):
+        g = torch.Generator()
+        g.manual_seed(seed)
+        return g
+
+    def _track(self, indices, start):
+        """Yields ``indices[start:]`` and counts them for :meth:`state_dict`."""
+        for i in range(start, len(indices)):
+            self._yielded = i + 1
+            yield indices[i]
+
+    def _track_chunks(self, chunks, start):
+        """Yields the indices of a sequence of index arrays, which continue
+        after the first ``start`` indices, as ints and counts them."""
+        for chunk in chunks:
+            for idx in chunk.tolist():
+                start += 1
+                self._yielded = start
+                yield idx
+
 
 class SequentialSampler(Sampler):
     """Samples elements sequentially, always in the same order.
@@ -30,7 +88,8 @@ class SequentialSampler(Sampler):
         self.data_source = data_source
 
     def __iter__(self):
-        return iter(range(len(self.data_source)))
+        _, start = self._begin(seeded=False)
+        return self._track(range(len(self.data_source)), start)
 
     def __len__(self):
         return len(self.data_source)
@@ -39,6 +98,9 @@ class SequentialSampler(Sampler):
 class RandomSampler(Sampler):
     """Samples elements randomly, without replacement.
 
+    The permutation is kept as one int32 array rather than a list of Python
+    ints; :meth:`chunks` hands it to :class:`BatchSampler` as is.
+
     Arguments:
         data_source (Dataset): dataset to sample from
     """
@@ -46,8 +108,22 @@ class RandomSampler(Sampler):
     def __init__(self, data_source):
         self.data_source = data_source
 
+    def _permutation(self):
+        seed, start = self._begin()
+        n = len(self.data_source)
+        # shuffled in place, so no int64 permutation is ever built next to the int32 one
+        perm = np.arange(n, dtype=_index_dtype(n))
+        np.random.RandomState(seed % 2**32).shuffle(perm)
+        return perm[start:], start
+
+    def chunks(self):
+        """Yields the indices of an iteration as index arrays."""
+        perm, _ = self._permutation()
+        yield perm
+
     def __iter__(self):
-        return iter(torch.randperm(len(self.data_source)).long())
+        perm, start = self._permutation()
+        return self._track_chunks(_split(perm), start)
 
     def __len__(self):
         return len(self.data_source)
@@ -64,7 +140,9 @@ class SubsetRandomSampler(Sampler):
         self.indices = indices
 
     def __iter__(self):
-        return (self.indices[i] for i in torch.randperm(len(self.indices)))
+        seed, start = self._begin()
+        perm = torch.randperm(len(self.indices), generator=self._generator(seed)).tolist()
+        return (self.indices[i] for i in self._track(perm, start))
 
     def __len__(self):
         return len(self.indices)
@@ -87,15 +165,249 @@ class WeightedRandomSampler(Sampler):
         self.replacement = replacement
 
     def __iter__(self):
-        return iter(torch.multinomial(self.weights, self.num_samples, self.replacement))
+        seed, start = self._begin()
+        indices = torch.multinomial(self.weights, self.num_samples, self.replacement, generator=self._generator(seed))
+        return self._track(indices.tolist(), start)
 
     def __len__(self):
         return self.num_samples
 
 
+def _feistel(x, keys, half_bits):
+    """Balanced Feistel network on ``2 * half_bits``-bit integers; a bijection
+    for any round function."""
+    mask = np.uint64((1 << half_bits) - 1)
+    left, right = x >> np.uint64(half_bits), x & mask
+    for key in keys:
+        f = (right * np.uint64(0x9E3779B97F4A7C15)) ^ key
+        f = (f ^ (f >> np.uint64(29))) * np.uint64(0xBF58476D1CE4E5B9)
+        left, right = right, left ^ ((f >> np.uint64(32)) & mask)
+    return (left << np.uint64(half_bits)) | right
+
+
+class PermutationSampler(Sampler):
+    """Samples elements randomly, without replacement, without ever holding
+    the permutation in memory.
+
+    Position ``i`` of an epoch maps to index ``perm(i)``, where ``perm`` is a
+    keyed Feistel network over the smallest power of 4 covering the dataset,
+    restricted to ``[0, len)`` by cycle walking. Indices are computed
+    vectorised, ``chunk_size`` positions at a time, so memory is O(chunk)
+    even for hundreds of millions of elements, and resuming at any position
+    costs nothing.
+
+    Can be sharded like :class:`DistributedSampler` (the same permutation
+    padded to ``num_samples * num_replicas`` and interleaved by rank). In that
+    case call :meth:`set_epoch` every epoch and give all replicas the same
+    ``seed``.
+
+    Arguments:
+        data_source (Dataset or int): dataset to sample from, or its length
+        chunk_size (int, optional): number of indices computed at once
+        num_replicas (int, optional): number of processes to shard across
+        rank (int, optional): rank of the current process within num_replicas
+        seed (int, optional): base seed of the permutation. If None, a new seed
+            is drawn from the default generator every epoch (single process only).
+        rounds (int, optional): number of Feistel rounds
+    """
+
+    def __init__(self, data_source, chunk_size=65536, num_replicas=1, rank=0, seed=None, rounds=4):
+        self.length = data_source if isinstance(data_source, int) else len(data_source)
+        self.chunk_size = chunk_size
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.seed = 0 if seed is None and num_replicas > 1 else seed
+        self.rounds = rounds
+        self.epoch = 0
+        self.num_samples = int(math.ceil(self.length * 1.0 / num_replicas))
+        self.half_bits = max(1, (max(self.length - 1, 1).bit_length() + 1) // 2)
+
+    def _keys(self, seed):
+        rng = np.random.RandomState(seed % 2**32)
+        return rng.randint(0, 2**62, size=self.rounds, dtype=np.int64).astype(np.uint64)
+
+    def permute(self, positions, keys):
+        """Maps an array of positions in ``[0, len)`` to indices."""
+        out = _feistel(positions.astype(np.uint64), keys, self.half_bits)
+        outside = np.flatnonzero(out >= self.length)
+        while len(outside) > 0:  # cycle walking
+            out[outside] = _feistel(out[outside], keys, self.half_bits)
+            outside = outside[out[outside] >= self.length]
+        return out.astype(_index_dtype(self.length))
+
+    def _chunks(self, seed, start):
+        keys = self._keys(seed)
+        for begin in range(start, self.num_samples, self.chunk_size):
+            j = np.arange(begin, min(begin + self.chunk_size, self.num_samples), dtype=np.int64)
+            yield self.permute((j * self.num_replicas + self.rank) % self.length, keys)
+
+    def chunks(self):
+        """Yields the indices of an iteration as index arrays of ``chunk_size``."""
+        seed, start = self._begin(None if self.seed is None else self.seed + self.epoch)
+        return self._chunks(seed, start)
+
+    def __iter__(self):
+        seed, start = self._begin(None if self.seed is None else self.seed + self.epoch)
+        return self._track_chunks(self._chunks(seed, start), start)
+
+    def __len__(self):
+        return self.num_samples
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+
+class LossAwareSampler(WeightedRandomSampler):
+    """Samples elements with probability proportional to their recent loss,
+    mixed with uniform sampling so that no element starves.
+
+    Losses reported through :meth:`update` are kept per element as an
+    exponential moving average in one float32 array. Elements never reported
+    count with the mean loss of those which were. Sampling weights are
+    computed when an iteration starts, so choose ``num_samples`` smaller than
+    the dataset to follow the losses more closely.
+
+    Arguments:
+        num_items (int): number of elements of the dataset
+        num_samples (int, optional): number of samples to draw per iteration
+            (default: num_items)
+        decay (float, optional): weight of the previous average in the moving
+            average of losses
+        uniform (float, optional): share of the probability mass spread
+            uniformly over all elements
+        replacement (bool, optional): if ``True``, samples are drawn with
+            replacement
+    """
+
+    def __init__(self, num_items, num_samples=None, decay=0.9, uniform=0.2, replacement=True):
+        self.num_items = num_items
+        self.num_samples = num_samples if num_samples is not None else num_items
+        self.decay = decay
+        self.uniform = uniform
+        self.replacement = replacement
+        self.losses = np.zeros(num_items, dtype=np.float32)
+        self.seen = np.zeros(num_items, dtype=np.bool_)
+        self.weights = None
+
+    def update(self, indices, losses):
+        """Reports losses of elements, e.g. of a batch after a training step.
+
+        Arguments:
+            indices (array-like): dataset indices of the elements
+            losses (array-like): non-negative loss of each element
+        """
+        indices = np.asarray(indices, dtype=np.int64)
+        losses = np.asarray(losses, dtype=np.float32)
+        seen = self.seen[indices]
+        self.losses[indices] = np.where(seen, self.decay * self.losses[indices] + (1 - self.decay) * losses, losses)
+        self.seen[indices] = True
+
+    def _weights(self):
+        if not self.seen.any():
+            return np.full(self.num_items, 1.0 / self.num_items)
+        losses = np.where(self.seen, self.losses, self.losses[self.seen].mean()).astype(np.float64)
+        total = losses.sum()
+        if total <= 0:
+            return np.full(self.num_items, 1.0 / self.num_items)
+        return (1 - self.uniform) * losses / total + self.uniform / self.num_items
+
+    def __iter__(self):
+        self.weights = torch.from_numpy(self._weights())
+        return super(LossAwareSampler, self).__iter__()
+
+    def state_dict(self):
+        """Returns the iteration state along with the loss estimates."""
+        state = super(LossAwareSampler, self).state_dict()
+        state['losses'] = self.losses.copy()
+        state['seen'] = self.seen.copy()
+        return state
+
+    def load_state_dict(self, state):
+        """Restores the loss estimates; the interrupted iteration is redrawn
+        from them with its saved seed."""
+        state = dict(state)
+        if 'losses' in state:
+            self.losses = np.asarray(state.pop('losses'), dtype=np.float32)
+            self.seen = np.asarray(state.pop('seen'), dtype=np.bool_)
+        super(LossAwareSampler, self).load_state_dict(state)
+
+
+class BlockShuffleSampler(Sampler):
+    """Samples elements in shuffled blocks of consecutive (in storage order)
+    elements, so that reads from tar archives or shards are mostly sequential.
+
+    The storage order is split into blocks of ``block_size`` elements and the
+    order of blocks is shuffled. Elements are then shuffled within each window
+    of ``window`` consecutive blocks, so a window spans only a few contiguous
+    regions of storage while batches still mix ``block_size * window``
+    elements.
+
+    Blocks can be sharded across processes like :class:`DistributedSampler`:
+    each replica takes every ``num_replicas``-th shuffled block and is then
+    wrapped or truncated to ``ceil(len(data_source) / num_replicas)``
+    elements. In that case call :meth:`set_epoch` every epoch and give all
+    replicas the same ``seed``.
+
+    Arguments:
+        data_source (Dataset): dataset to sample from
+        block_size (int): number of consecutive elements per block
+        window (int): number of blocks whose elements are shuffled together
+        offsets (array-like, optional): storage offset of each element (e.g.
+            ``tar_offset`` of a metadata sidecar). Index order is used if None.
+        num_replicas (int, optional): number of processes to shard blocks across
+        rank (int, optional): rank of the current process within num_replicas
+        seed (int, optional): base seed of the shuffle. If None, a new seed is
+            drawn from the default generator every epoch (single process only).
+    """
+
+    def __init__(self, data_source, block_size=1024, window=4, offsets=None, num_replicas=1, rank=0, seed=None):
+        self.data_source = data_source
+        self.block_size = block_size
+        self.window = window
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.seed = 0 if seed is None and num_replicas > 1 else seed
+        self.epoch = 0
+        if offsets is None:
+            self.order = torch.arange(0, len(data_source)).long()
+        else:
+            self.order = torch.sort(torch.LongTensor([int(o) for o in offsets]))[1]
+        self.num_blocks = int(math.ceil(len(data_source) * 1.0 / block_size))
+        self.num_samples = int(math.ceil(len(data_source) * 1.0 / num_replicas))
+
+    def __iter__(self):
+        seed, start = self._begin(None if self.seed is None else self.seed + self.epoch)
+        g = self._generator(seed)
+
+        blocks = torch.randperm(self.num_blocks, generator=g)[self.rank::self.num_replicas].tolist()
+        indices = []
+        for offset in range(0, len(blocks), self.window):
+            window = torch.cat([self.order[b * self.block_size:(b + 1) * self.block_size]
+                                for b in blocks[offset:offset + self.window]])
+            indices.append(window[torch.randperm(len(window), generator=g)])
+        indices = torch.cat(indices).tolist() if len(indices) > 0 else []
+
+        # wrap or truncate to the same length on every replica
+        if self.num_replicas > 1:
+            while 0 < len(indices) < self.num_samples:
+                indices += indices[:(self.num_samples - len(indices))]
+            indices = indices[:self.num_samples]
+        return self._track(indices, start)
+
+    def __len__(self):
+        return self.num_samples
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+
 class BatchSampler(object):
     """Wraps another sampler to yield a mini-batch of indices.
 
+    If the sampler provides ``chunks()`` (index arrays, e.g.
+    :class:`RandomSampler` or :class:`PermutationSampler`), batches are
+    contiguous slices of those arrays instead of lists of Python ints.
+
     Args:
         sampler (Sampler): Base sampler.
         batch_size (int): Size of mini-batch.
@@ -113,19 +425,144 @@ class BatchSampler(object):
         self.sampler = sampler
         self.batch_size = batch_size
         self.drop_last = drop_last
+        self.yielded = 0
+        self._start = 0
 
     def __iter__(self):
+        self.yielded, self._start = self._start, 0
+        if hasattr(self.sampler, 'chunks'):
+            for batch in self._slices(self.sampler.chunks()):
+                self.yielded += 1
+                yield batch
+            return
+
+        sampler = iter(self.sampler)
+        if not hasattr(self.sampler, 'load_state_dict'):  # skip already consumed batches by hand
+            for _ in range(self.yielded * self.batch_size):
+                next(sampler, None)
+
         batch = []
-        for idx in self.sampler:
+        for idx in sampler:
             batch.append(idx)
             if len(batch) == self.batch_size:
+                self.yielded += 1
                 yield batch
                 batch = []
         if len(batch) > 0 and not self.drop_last:
+            self.yielded += 1
             yield batch
 
+    def _slices(self, chunks):
+        rest = None
+        for chunk in chunks:
+            if rest is not None and len(rest) > 0:
+                chunk = np.concatenate([rest, chunk])
+            end = len(chunk) - len(chunk) % self.batch_size
+            for start in range(0, end, self.batch_size):
+                yield chunk[start:start + self.batch_size]
+            rest = chunk[end:]
+        if rest is not None and len(rest) > 0 and not self.drop_last:
+            yield rest
+
+    def state_dict(self):
+        """Returns the state of the wrapped sampler and the number of batches
+        yielded by the current (or last) iteration."""
+        sampler_state = self.sampler.state_dict() if hasattr(self.sampler, 'state_dict') else None
+        return {'sampler': sampler_state, 'start': self.yielded}
+
+    def load_state_dict(self, state):
+        """Makes the next iteration replay the saved one, starting after its
+        first ``state['start']`` batches."""
+        self._start = state['start']
+        if state['sampler'] is not None:
+            sampler_state = dict(state['sampler'])
+            sampler_state['start'] = state['start'] * self.batch_size
+            self.sampler.load_state_dict(sampler_state)
+
     def __len__(self):
         if self.drop_last:
             return len(self.sampler) // self.batch_size
         else:
             return (len(self.sampler) + self.batch_size - 1) // self.batch_size
+
+
+class BucketBatchSampler(Sampler):
+    """Groups indices of similarly sized images into mini-batches, so that
+    padding a batch to its largest image wastes few pixels.
+
+    Images are bucketed by their width and height rounded up to a multiple
+    of ``granularity``, which groups by aspect ratio and size at once. Every
+    batch is taken from a single bucket, hence padding is at most
+    ``granularity - 1`` pixels per side. Use together with ``pad_collate``.
+
+    Args:
+        sizes (array-like or callable): ``(width, height)`` of each image, as
+            an ``N x 2`` array (e.g. from a metadata sidecar) or a callable
+            returning one (e.g. ``PlacesDataset.get_image_sizes``), which is
+            only evaluated on first iteration.
+        batch_size (int): Size of mini-batch.
+        granularity (int): Bucket width in pixels.
+        max_pixels (int, optional): If given, batches of large buckets are
+            shrunk so that ``batch_size * padded_area <= max_pixels``.
+        drop_last (bool): If ``True``, drop the last incomplete batch of each
+            bucket.
+        shuffle (bool): If ``True``, shuffle indices within buckets and the
+            order of batches.
+
+    Example:
+        >>> list(BucketBatchSampler([(64, 48), (500, 375), (60, 40), (512, 384)], batch_size=2, granularity=32))
+        [[0, 2], [1, 3]]
+    """
+
+    def __init__(self, sizes, batch_size, granularity=32, max_pixels=None, drop_last=False, shuffle=False):
+        self.sizes = sizes
+        self.batch_size = batch_size
+        self.granularity = granularity
+        self.max_pixels = max_pixels
+        self.drop_last = drop_last
+        self.shuffle = shuffle
+        self._buckets = None
+
+    @property
+    def buckets(self):
+        if self._buckets is None:
+            sizes = self.sizes() if callable(self.sizes) else self.sizes
+            buckets = {}
+            for i, (w, h) in enumerate(sizes):
+                key = (-(-int(w) // self.granularity), -(-int(h) // self.granularity))
+                buckets.setdefault(key, []).append(i)
+            self._buckets = buckets
+        return self._buckets
+
+    def _bucket_batch_size(self, key):
+        if self.max_pixels is None:
+            return self.batch_size
+        area = key[0] * key[1] * self.granularity ** 2
+        return max(1, min(self.batch_size, self.max_pixels // area))
+
+    def __iter__(self):
+        seed, start = self._begin(seeded=self.shuffle)
+        g = self._generator(seed) if self.shuffle else None
+        batches = []
+        for key in sorted(self.buckets):
+            indices = self.buckets[key]
+            if self.shuffle:
+                indices = [indices[i] for i in torch.randperm(len(indices), generator=g)]
+            batch_size = self._bucket_batch_size(key)
+            for offset in range(0, len(indices), batch_size):
+                batch = indices[offset:offset + batch_size]
+                if len(batch) == batch_size or not self.drop_last:
+                    batches.append(batch)
+        if self.shuffle:
+            batches = [batches[i] for i in torch.randperm(len(batches), generator=g)]
+        return self._track(batches, start)
+
+    def __len__(self):
+        length = 0
+        for key, indices in self.buckets.items():
+            batch_size = self._bucket_batch_size(key)
+            if self.drop_last:
+                length += len(indices) // batch_size
+            else:
+                length += (len(indices) + batch_size - 1) // batch_size
+        return length
@@ -3,7 +3,7 @@ import torch
 import torch.nn as nn
 import torch.nn.functional as F
 
-from models.layers import CL, CBL, CE, C
+from models.layers import CL, CBL, CE, C, CheckpointMixin
 
 
 # %% Submodules
@@ -60,7 +60,9 @@ class Expand(nn.Module):
 
 
 # %% Main CLass
-class CoarseNet(nn.Module):
+class CoarseNet(CheckpointMixin, nn.Module):
+    checkpoint_blocks = ('cl0', 'cbl0', 'cbl1', 'cbl2', 'cl1', 'ce0', 'ce1', 'ce2', 'ce3', 'ce4', 'ce5')
+
     def __init__(self, input_channels=3, output_channels=3):
         """
         Implementation of CoarseNet, a modified version of UNet.
@@ -93,18 +95,18 @@ class CoarseNet(nn.Module):
         self.final = C(64, self.output_channels, kernel_size=3, stride=1, padding=1, activation=None)
 
     def forward(self, x):
-        out = self.cl0(x)  # 3>64
-        out2 = self.cbl0(out)  # 64>128
-        out3 = self.cbl1(out2)  # 128>256
-        out4 = self.cbl2(out3)  # 256>512
-        out5 = self.cl1(out4)  # 512>512
-        in0 = self.ce0(out5)
-
-        in1 = self.ce1(out4, in0)  # 512>512
-        in2 = self.ce2(out3, in1)  # 512>256
-        in3 = self.ce3(out2, in2)  # 256>128
-        in4 = self.ce4(out, in3)  # 128>64
-        f = self.ce5(in4)
+        out = self.run_block('cl0', x)  # 3>64
+        out2 = self.run_block('cbl0', out)  # 64>128
+        out3 = self.run_block('cbl1', out2)  # 128>256
+        out4 = self.run_block('cbl2', out3)  # 256>512
+        out5 = self.run_block('cl1', out4)  # 512>512
+        in0 = self.run_block('ce0', out5)
+
+        in1 = self.run_block('ce1', out4, in0)  # 512>512
+        in2 = self.run_block('ce2', out3, in1)  # 512>256
+        in3 = self.run_block('ce3', out2, in2)  # 256>128
+        in4 = self.run_block('ce4', out, in3)  # 128>64
+        f = self.run_block('ce5', in4)
         f = self.final(f)
         return f
 
@@ -1,6 +1,6 @@
 import torch
 import torch.nn as nn
-from models.layers import CBL, CL, C
+from models.layers import CBL, CL, C, CheckpointMixin
 
 
 class ResidualBlock(nn.Module):
@@ -29,7 +29,9 @@ class ResidualBlock(nn.Module):
         return out
 
 
-class DetailsNet(nn.Module):
+class DetailsNet(CheckpointMixin, nn.Module):
+    checkpoint_blocks = ('block0', 'block1', 'block3')  # block2 is never run by forward, block3 runs twice
+
     def __init__(self, input_channels=32, output_channels=3):
         """
         The generator of GAN networks contains repeated residual blocks and C block at the end.
@@ -53,18 +55,18 @@ class DetailsNet(nn.Module):
                        kernel_size=3, stride=1, padding=1, activation='tanh')
 
     def forward(self, x):
-        x = self.block0(x)
+        x = self.run_block('block0', x)
 
         residual1 = x
-        x = self.block1(x)
+        x = self.run_block('block1', x)
         x += residual1
 
         residual2 = x
-        x = self.block3(x)
+        x = self.run_block('block3', x)
         x += residual2
 
         residual3 = x
-        x = self.block3(x)
+        x = self.run_block('block3', x)
         x += residual3
 
         x = self.final(x)
@@ -1,9 +1,11 @@
 import torch
 import torch.nn as nn
-from models.layers import CBR, C
+from models.layers import CBR, C, CheckpointMixin
 
 
-class EdgeNet(nn.Module):
+class EdgeNet(CheckpointMixin, nn.Module):
+    checkpoint_blocks = ('cbr0', 'cbr1', 'cbr2', 'cbr3', 'cbr4')
+
     def __init__(self, input_channels=3, output_channels=1):
         """
         A simple convolutional neural network to learn edges using Canny edge detector
@@ -26,11 +28,11 @@ class EdgeNet(nn.Module):
         self.final = C(32, self.output_channels, kernel_size=3, stride=1, padding=1, activation='sigmoid')
 
     def forward(self, x):
-        c = self.cbr0(x)
-        c = self.cbr1(c)
-        c = self.cbr2(c)
-        c = self.cbr3(c)
-        c = self.cbr4(c)
+        c = self.run_block('cbr0', x)
+        c = self.run_block('cbr1', c)
+        c = self.run_block('cbr2', c)
+        c = self.run_block('cbr3', c)
+        c = self.run_block('cbr4', c)
 
         c = self.final(c)
         return c
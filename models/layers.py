@@ -1,5 +1,9 @@
+from functools import partial, reduce
+
 import torch
 import torch.nn as nn
+from torch.nn.modules.batchnorm import _BatchNorm
+from torch.utils.checkpoint import checkpoint as _checkpoint
 
 
 class CL(nn.Module):
@@ -106,3 +110,80 @@ class C(nn.Module):
     def forward(self, x):
         return self.layer(x)
 
+
+def _recompute(module, *inputs):
+    if not torch.is_grad_enabled():  # first pass, activations are dropped
+        return module(*inputs[:-1])
+    # second pass during backward: normalize exactly as before without updating running statistics twice
+    norms = [m for m in module.modules() if isinstance(m, _BatchNorm) and m.training and m.track_running_stats]
+    momenta = [m.momentum for m in norms]
+    for m in norms:
+        m.momentum = 0.
+    try:
+        return module(*inputs[:-1])
+    finally:
+        for m, momentum in zip(norms, momenta):
+            m.momentum = momentum
+            if getattr(m, 'num_batches_tracked', None) is not None:
+                m.num_batches_tracked.sub_(1)
+
+
+def checkpoint(module, *inputs):
+    """
+    Run a module without keeping its intermediate activations for backward; they are recomputed from ``inputs`` when
+    gradients are needed. Running statistics of BatchNorm layers inside the module are updated once per step as usual.
+
+    :param module: module to run
+    :param inputs: tensors passed to the module
+    :return: output of the module
+    """
+
+    if not torch.is_grad_enabled():
+        return module(*inputs)
+    # a tensor requiring grad makes the checkpoint differentiable even when inputs are not, e.g. the first layer,
+    # so parameters of the module still get their gradients
+    anchor = inputs[0].new_ones(1).requires_grad_()
+    return _checkpoint(partial(_recompute, module), *(inputs + (anchor,)))
+
+
+class CheckpointMixin(object):
+    """
+    Activation checkpointing of selected blocks of a network. Subclasses list the names of their blocks in
+    ``checkpoint_blocks`` (in forward order) and call them in ``forward`` through ``run_block``.
+    """
+
+    checkpoint_blocks = ()
+    checkpointed = frozenset()
+
+    def set_checkpointing(self, policy=None):
+        """
+        Choose blocks whose activations are recomputed during backward instead of kept since forward
+
+        :param policy: None or 0 to keep all activations, an integer k to checkpoint every k-th block (1 for all), or
+            names of blocks; a name also selects the blocks below it, e.g. 'layer3' for 'layer3.0', 'layer3.1', ...
+        :return: sorted names of checkpointed blocks
+        """
+
+        if not policy:
+            selected = []
+        elif isinstance(policy, int):
+            selected = self.checkpoint_blocks[::policy]
+        else:
+            policy = [policy] if isinstance(policy, str) else policy
+            unknown = [p for p in policy if not any(b == p or b.startswith(p + '.') for b in self.checkpoint_blocks)]
+            if len(unknown) > 0:
+                raise ValueError('{} has no blocks {}, choose from {}'.format(
+                    type(self).__name__, unknown, list(self.checkpoint_blocks)))
+            selected = [b for b in self.checkpoint_blocks if any(b == p or b.startswith(p + '.') for p in policy)]
+        self.checkpointed = frozenset(selected)
+        return sorted(self.checkpointed)
+
+    def run_block(self, name, *inputs):
+        """
+        Call block ``name`` (dotted path below this network) on inputs, checkpointed if chosen by the policy
+        """
+
+        block = reduce(getattr, name.split('.'), self)
+        if name in self.checkpointed:
+            return checkpoint(block, *inputs)
+        return block(*inputs)
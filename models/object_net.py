@@ -3,6 +3,7 @@ import torch.nn as nn
 import torchvision
 from models import resnet
 from lib.nn import SynchronizedBatchNorm2d
+from models.layers import CheckpointMixin
 
 import pandas as pd
 import numpy as np
@@ -58,21 +59,12 @@ class SegmentationModule(SegmentationModuleBase):
         :return: A new tensor with same height and width but reduced channel size from 150 to 25
         """
 
-        # use mask to sum all combinations then zero anything else our 25 classes
-        batch_size, channel_size, height, width = tuple(pred.size())
-        mapping = torch.arange(0, 150)
+        # add probabilities of merged classes to their target, then keep only our 25 classes
+        mapping = torch.arange(0, pred.size(1)).long()
         for item in self.replacement_dic:
             mapping[item] = self.replacement_dic[item]
-        pred = torch.zeros(batch_size, channel_size, height, width).scatter_add(1, mapping, pred)
-
-        # first accumulate all other probs in arbitrary index 149 then make it zero.
-        de_mask = torch.arange(0, 150).scatter_(0, self.final_class_indices, 0.).nonzero().view((125,))
-        mask = torch.arange(0, 150).scatter_(0, de_mask, 149.)
-        pred = torch.zeros(batch_size, channel_size, height, width).scatter_add(1, mask, pred)
-        pred[:, 149, :, :] = 0
-        # now we shrink channel size to 25 by moving values to 0 to 24 indices
-        pred = pred[:, self.final_class_indices, :, :]
-        return pred
+        merged = torch.zeros_like(pred).index_add_(1, mapping.to(pred.device), pred)
+        return merged[:, self.final_class_indices.long().to(pred.device), :, :]
 
     def forward(self, feed_dict, *, segSize=None):
         # training
@@ -93,7 +85,7 @@ class SegmentationModule(SegmentationModuleBase):
         else:
             pred = self.decoder(self.encoder(feed_dict['img_data'], return_feature_maps=True), segSize=segSize)
             pred = self.merge_probs(pred)
-            _, pred = torch.max(pred, dim=0)
+            _, pred = torch.max(pred, dim=1)
             return pred
 
 
@@ -156,7 +148,7 @@ class ModelBuilder:
         return net_decoder
 
 
-class ResnetDilated(nn.Module):
+class ResnetDilated(CheckpointMixin, nn.Module):
     def __init__(self, orig_resnet, dilate_scale=8):
         super(ResnetDilated, self).__init__()
         from functools import partial
@@ -185,6 +177,9 @@ class ResnetDilated(nn.Module):
         self.layer2 = orig_resnet.layer2
         self.layer3 = orig_resnet.layer3
         self.layer4 = orig_resnet.layer4
+        # bottlenecks of the dilated stages run at 1/8 of input resolution with up to 2048 channels
+        self.checkpoint_blocks = tuple('{}.{}'.format(layer, i) for layer in ('layer3', 'layer4')
+                                       for i in range(len(getattr(self, layer))))
 
     def _nostride_dilate(self, m, dilate):
         classname = m.__class__.__name__
@@ -213,9 +208,11 @@ class ResnetDilated(nn.Module):
         conv_out.append(x);
         x = self.layer2(x);
         conv_out.append(x);
-        x = self.layer3(x);
+        for i in range(len(self.layer3)):
+            x = self.run_block('layer3.{}'.format(i), x)
         conv_out.append(x);
-        x = self.layer4(x);
+        for i in range(len(self.layer4)):
+            x = self.run_block('layer4.{}'.format(i), x)
         conv_out.append(x);
 
         if return_feature_maps:
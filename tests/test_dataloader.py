@@ -0,0 +1,59 @@
+import pytest
+
+torch = pytest.importorskip('torch')
+
+from lib.utils.data.dataloader import DataLoader  # noqa: E402
+
+
+@pytest.mark.parametrize('num_workers', [0, 2])
+def test_ordered_loader_resumes_from_unordered_state(num_workers):
+    loader = DataLoader(list(range(10)), batch_size=2, num_workers=num_workers)
+    iterator = iter(loader)
+    state = iterator.state_dict()
+    del iterator
+
+    # batch 0 and, delivered out of order, batches 2 and 3 were returned before the state was saved
+    state['batch_sampler']['start'] = 1
+    state['skip'] = [2, 3]
+    loader.load_state_dict(state)
+    samples = [int(i) for batch in loader for i in batch]
+    assert samples == [2, 3, 8, 9]
+
+
+def test_drain_returns_only_requested_batches():
+    loader = DataLoader(list(range(40)), batch_size=2, num_workers=2, in_order=False)
+    iterator = iter(loader)
+    head = [next(iterator) for _ in range(3)]
+    iterator.drain()
+    rest = list(iterator)
+
+    assert len(head) + len(rest) <= 3 + 2 * 2  # at most the prefetched batches follow
+    state = iterator.state_dict()
+    assert state['skip'] == []
+    assert state['batch_sampler']['start'] == len(head) + len(rest)
+    samples = sorted(int(i) for batch in head + rest for i in batch)
+    assert samples == list(range(2 * (len(head) + len(rest))))
+
+
+class _Samples(object):
+    def __len__(self):
+        return 12
+
+    def __getitem__(self, index):
+        # every third sample has an index default_collate cannot collate
+        return {'x': torch.full((2, 3), float(index)), 'index': index if index % 3 != 2 else object()}
+
+
+def test_batch_slots_survive_failed_batches_and_skip_numbers():
+    loader = DataLoader(_Samples(), batch_size=1, num_workers=1, batch_slots=2, timeout=30)
+    seen = []
+    iterator = iter(loader)
+    for _ in range(len(loader)):
+        try:
+            batch = next(iterator)
+        except TypeError:  # a failed batch must give its slot back, or the worker runs out of slots and hangs
+            continue
+        assert batch['x'].size() == (1, 2, 3)
+        assert int(batch['x'][0, 0, 0]) == int(batch['index'][0])
+        seen.append(int(batch['index'][0]))
+    assert seen == [i for i in range(12) if i % 3 != 2]
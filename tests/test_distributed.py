@@ -0,0 +1,30 @@
+import pytest
+
+torch = pytest.importorskip('torch')
+
+from lib.utils.data.distributed import DistributedSampler  # noqa: E402
+
+SHARDS = [0] * 40 + [1] * 25 + [2] * 15 + [3] * 10 + [4] * 7 + [5] * 3
+
+
+def _assignment(epoch, num_replicas=3):
+    owned = []
+    for rank in range(num_replicas):
+        sampler = DistributedSampler(range(len(SHARDS)), num_replicas=num_replicas, rank=rank, shards=SHARDS)
+        sampler.set_epoch(epoch)
+        indices = list(sampler)
+        assert len(indices) == len(sampler)
+        owned.append(frozenset(SHARDS[i] for i in indices))
+    return owned
+
+
+def test_shards_cover_dataset_and_move_between_ranks():
+    assignments = [_assignment(epoch) for epoch in range(8)]
+    for owned in assignments:
+        assert frozenset().union(*owned) == frozenset(SHARDS)
+    assert len({tuple(owned) for owned in assignments}) > 1
+
+
+def test_too_few_shards_are_rejected():
+    with pytest.raises(ValueError):
+        DistributedSampler(range(10), num_replicas=3, rank=0, shards=[0] * 5 + [1] * 5)
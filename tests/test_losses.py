@@ -0,0 +1,37 @@
+import pytest
+
+torch = pytest.importorskip('torch')
+
+import models.vgg  # noqa: E402
+import utils.losses as losses  # noqa: E402
+
+
+@pytest.fixture
+def coarse_loss(monkeypatch):
+    monkeypatch.setattr(losses, 'vgg16_bn', lambda pretrained=False: models.vgg.vgg16_bn(pretrained=False))
+    torch.manual_seed(0)
+    return losses.CoarseLoss(w1=0, w2=1, feature_cache=losses.FeatureCache(persistent=True))
+
+
+def test_coarse_loss_caches_only_ground_truth_under_no_grad(coarse_loss):
+    y_d = torch.rand(2, 3, 64, 64)
+    first, second = torch.rand(2, 3, 64, 64), torch.rand(2, 3, 64, 64)
+    with torch.no_grad():
+        loss_first = coarse_loss(first, y_d, key=(0, 1))
+        loss_second = coarse_loss(second, y_d, key=(0, 1))
+        uncached_second = losses.CoarseLoss.forward(coarse_loss, second, y_d)
+
+    assert float(loss_first) > 0
+    assert float(loss_second) > 0
+    assert float(loss_second) == pytest.approx(float(uncached_second), rel=1e-5)
+    assert coarse_loss.feature_cache.hits == 1
+
+
+def test_coarse_loss_target_argument(coarse_loss):
+    y_d, pred = torch.rand(2, 3, 64, 64), torch.rand(2, 3, 64, 64)
+    with torch.no_grad():
+        loss = coarse_loss(y_d, pred, key='batch', target='y')
+        reference = coarse_loss(pred, y_d)
+    assert float(loss) == pytest.approx(float(reference), rel=1e-5)
+    with pytest.raises(ValueError):
+        coarse_loss(pred, y_d, target='x')
@@ -0,0 +1,43 @@
+import pytest
+
+torch = pytest.importorskip('torch')
+
+from utils.preprocess import MultiCropBuffer  # noqa: E402
+
+
+def _batches(count, images, crops, size, first_index):
+    for b in range(count):
+        index = torch.arange(images) + first_index + b * images
+        yield {'x': torch.rand(images, crops, 3, size, size), 'index': index}
+
+
+def test_multi_crop_buffer_follows_batch_size_of_each_crop_size():
+    batches = list(_batches(4, images=4, crops=2, size=8, first_index=0)) + \
+        list(_batches(4, images=2, crops=2, size=16, first_index=16))
+    out = list(MultiCropBuffer(batches, buffer_batches=2, seed=0))
+
+    small = [b for b in out if b['x'].size(2) == 8]
+    large = [b for b in out if b['x'].size(2) == 16]
+    assert [len(b['x']) for b in small] == [8] * 4
+    assert [len(b['x']) for b in large] == [4] * 4
+    indices = torch.cat([b['index'] for b in out]).tolist()
+    assert sorted(indices) == sorted(i for i in range(24) for _ in range(2))
+
+
+def test_replay_ignores_global_random():
+    np = pytest.importorskip('numpy')
+    Image = pytest.importorskip('PIL.Image')
+    transforms = pytest.importorskip('torchvision.transforms')
+    import random
+    from utils.preprocess import replay
+
+    image = Image.fromarray(np.random.RandomState(0).randint(0, 255, (48, 64, 3), dtype=np.uint8))
+    transform = transforms.Compose([transforms.RandomResizedCrop(size=32, scale=(0.8, 1.2)),
+                                    transforms.RandomRotation(degrees=(-30, 30)),
+                                    transforms.RandomHorizontalFlip(p=0.5)])
+    first = np.array(replay(transform, image, random.Random(7)))
+    random.seed(1)
+    random.random()
+    second = np.array(replay(transform, image, random.Random(7)))
+    assert first.shape == (32, 32, 3)
+    assert (first == second).all()
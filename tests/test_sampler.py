@@ -0,0 +1,51 @@
+import pytest
+
+torch = pytest.importorskip('torch')
+
+from lib.utils.data.sampler import BlockShuffleSampler, BucketBatchSampler, RandomSampler  # noqa: E402
+
+
+def _sizes(n):
+    g = torch.Generator()
+    g.manual_seed(0)
+    return (torch.randint(32, 640, (n, 2), generator=g)).tolist()
+
+
+@pytest.mark.parametrize('shuffle', [False, True])
+@pytest.mark.parametrize('max_pixels', [None, 3 * 256 * 256])
+def test_bucket_batch_sampler_yields_every_index_once(shuffle, max_pixels):
+    sampler = BucketBatchSampler(_sizes(103), batch_size=4, granularity=64, max_pixels=max_pixels, shuffle=shuffle)
+    indices = [i for batch in sampler for i in batch]
+    assert sorted(indices) == list(range(103))
+    assert len(list(sampler)) == len(sampler)
+
+
+@pytest.mark.parametrize('offsets', [None, list(range(103, 0, -1))])
+def test_block_shuffle_sampler_yields_every_index_once(offsets):
+    sampler = BlockShuffleSampler(range(103), block_size=8, window=3, offsets=offsets, seed=1)
+    indices = list(sampler)
+    assert sorted(indices) == list(range(103))
+    assert len(indices) == len(sampler)
+
+
+def test_block_shuffle_sampler_resumes_at_recorded_position():
+    sampler = BlockShuffleSampler(range(103), block_size=8, window=3, seed=1)
+    full = list(sampler)
+    iterator = iter(sampler)
+    head = [next(iterator) for _ in range(37)]
+    state = sampler.state_dict()
+
+    resumed = BlockShuffleSampler(range(103), block_size=8, window=3, seed=1)
+    resumed.load_state_dict(state)
+    assert head + list(resumed) == full
+
+
+def test_random_sampler_is_an_int32_permutation_and_resumes():
+    sampler = RandomSampler(range(1000))
+    perm = next(sampler.chunks())
+    assert perm.dtype.itemsize == 4
+    assert sorted(perm.tolist()) == list(range(1000))
+
+    state = dict(sampler.state_dict(), start=300)
+    sampler.load_state_dict(state)
+    assert list(sampler) == perm[300:].tolist()
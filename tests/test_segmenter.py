@@ -0,0 +1,18 @@
+import pytest
+
+torch = pytest.importorskip('torch')
+
+from utils.segmenter import AsyncSegmenter  # noqa: E402
+
+
+def test_async_segmenter_starts_and_stops(tmp_path):
+    segmenter = AsyncSegmenter(weights_dir=str(tmp_path), num_workers=1, threads=1)
+    assert all(w.is_alive() or w.exitcode is not None for w in segmenter.workers)
+
+    # no weights in tmp_path: the worker fails to build ObjectNet and the error reaches the trainer
+    seq = segmenter.submit(torch.zeros(1, 3, 8, 8))
+    with pytest.raises(Exception):
+        segmenter.get(seq)
+
+    segmenter.close()
+    assert all(not w.is_alive() for w in segmenter.workers)
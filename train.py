@@ -4,7 +4,9 @@ from models.coarse_net import CoarseNet
 from models.edge_net import EdgeNet
 from models.details_net import DetailsNet
 from models.discriminators import DiscriminatorOne, DiscriminatorTwo
-from utils.losses import CoarseLoss, EdgeLoss, DetailsLoss
+from utils.losses import CoarseLoss, EdgeLoss, DetailsLoss, AdversarialLoss, autocast, freeze
+from utils.segmenter import AsyncSegmenter
+from utils.stages import build_stage_cache
 from utils.preprocess import *
 
 # Pytorch
@@ -31,6 +33,8 @@ from scipy.io import loadmat
 from models.object_net import ModelBuilder, SegmentationModule
 from utils.object_net_utils import colorEncode
 from lib.nn import user_scattered_collate, async_copy_to
+from lib.utils.data.sampler import BucketBatchSampler, BlockShuffleSampler, RandomSampler, LossAwareSampler
+from lib.utils.data.dataloader import pad_collate, PrefetchTuner
 from lib.utils import as_numpy
 import lib.utils.data as torchdata
 import cv2
@@ -72,60 +76,127 @@ class args:
     lr_decay = 0.9
     cudnn = 0
     pm = 0
+    ms = 0
+    ms_cache = 'dataset/stats'
+    meta = None  # metadata sidecar of train set built by utils/metadata.py
+    blk = 0  # block size of block-shuffled sampling in storage order, 0 means fully random
+    rs = None  # progressive resolution phases as (start, crop size), e.g. [(0, 128), (4, 176), (8, 224), (14, 320)]
+    rs_unit = 'epoch'  # unit of start of phases: 'epoch' or 'step'
+    slots = 0  # shared memory batch slots per worker, 0 sends every batch as a new shared tensor
+    pw = 0  # keep loader workers alive between epochs (a phase change of the resolution schedule restarts them)
+    ap = 0  # adapt prefetch depth and number of workers (from nw) to measured waits of the training loop
+    uo = 0  # return train batches as soon as they are loaded rather than in sampler order
+    la = 0  # sample hard images more often, proportional to their recent loss (mixed with uniform sampling)
+    crops = 1  # crops per decoded and halftoned train image; a loader batch then holds bs // crops images
+    amp = 0  # bf16 autocast of forward passes and losses, opt-in until utils/benchmark.py shows it pays on our nodes
+    seg = None  # folder of cached ObjectNet segmentations (utils/segcache.py); ObjectNet then leaves the train loop
+    segp = 0  # without cache: ObjectNet processes segmenting batches ahead of training, 0 runs ObjectNet inline
+    segp_mode = 'target'  # 'target' segments ground truth crops, 'coarse' outputs of a shared copy of CoarseNet
+    segp_threads = 4  # intra-op threads per ObjectNet process
+    segp_depth = 2  # batches segmented ahead of training; bounds staleness of CoarseNet weights in 'coarse' mode
+    stages = 0  # staged training: CoarseNet/EdgeNet for es1 epochs, cache their outputs, then DetailsNet for es epochs
+    es1 = 10  # epochs of phase 1 of staged training
+    stage_dir = 'dataset/stage_cache'  # float16 arrays of crops and CoarseNet/EdgeNet outputs (about 1.1 MB per crop)
+    stage_passes = 1  # augmented crops of each train image in the stage cache
+    ckpt = None  # activation checkpointing per net, e.g. {'coarse': 2, 'edge': 1, 'details': 1}
+    mb = 0  # micro-batch size: accumulate gradients of micro-batches and step once per batch of bs, 0 disables
+    prof = 0  # print time per stage of the data pipeline (read, decode, halftone, ...) after every epoch
 
 # TODO to determine number of epoch size, we have to consider the concept of augmentation in pytorch
 # https://stackoverflow.com/questions/51677788/data-augmentation-in-pytorch/54460259#54460259
 
+# %% define datasets and their loaders
+def train_transforms(size, mean, std):
+    """
+    Augmentations of train set for a given crop size
 
-if args.cudnn == 1:
-    cudnn.benchmark = True
-else:
-    cudnn.benchmark = False
+    :param size: size of square crops
+    :param mean: per-channel mean of Normalize
+    :param std: per-channel std of Normalize
+    :return: Compose object
+    """
 
-if args.pm == 1:
-    pin_memory = True
-else:
-    pin_memory = False
+    return Compose([
+        RandomResizedCrop(size=size, scale=(0.8, 1.2)),
+        RandomRotation(degrees=(-30, 30)),
+        RandomHorizontalFlip(p=0.5),
+        ToTensor(),
+        # creepy images cause: https://discuss.pytorch.org/t/understanding-transform-normalize/21730/18
+        Normalize(mean=mean, std=std),
+        RandomNoise(p=0.5, mean=0, std=0.1)])
 
-# %% define datasets and their loaders
-custom_transforms = Compose([
-    RandomResizedCrop(size=224, scale=(0.8, 1.2)),
-    RandomRotation(degrees=(-30, 30)),
-    RandomHorizontalFlip(p=0.5),
-    ToTensor(),
-    # creepy images cause: https://discuss.pytorch.org/t/understanding-transform-normalize/21730/18
-    Normalize(mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225]),
-    RandomNoise(p=0.5, mean=0, std=0.1)])
-
-train_dataset = PlacesDataset(txt_path=args.txt,
-                              img_dir=args.img,
-                              transform=custom_transforms)
-
-train_loader = DataLoader(dataset=train_dataset,
-                          batch_size=args.bs,
-                          shuffle=True,
-                          num_workers=args.nw,
-                          pin_memory=pin_memory)
-
-test_dataset = PlacesDataset(txt_path=args.txt_t,
-                             img_dir=args.img_t,
-                             transform=ToTensor(),
-                             test=True)
-
-test_loader = DataLoader(dataset=test_dataset,
-                         batch_size=args.bs,
-                         shuffle=False,
-                         num_workers=args.nw,
-                         pin_memory=False)
 
 
 # %% train model
-def train_model(network, data_loader, optimizer, lr_scheduler, criterion, epochs=2):
+def one_hot(labels, num_classes=25):
+    """
+    Encode label maps as class probabilities, the object input of DetailsNet
+
+    :param labels: uint8 tensor (B, H, W) of class + 1, 0 where no class is known (as in the segmentation cache)
+    :param num_classes: number of classes of ObjectNet
+    :return: float tensor (B, num_classes, H, W), all zero where no class is known
+    """
+
+    out = torch.zeros(labels.size(0), num_classes + 1, labels.size(1), labels.size(2), device=labels.device)
+    out.scatter_(1, labels.long().unsqueeze(1), 1.)
+    return out[:, 1:]
+
+
+def color_encode(labels, colors):
+    """
+    Color label maps like ``colorEncode`` of ObjectNet utils, batched on the device of ``labels``
+
+    :param labels: uint8 tensor (B, H, W) of class + 1, 0 where no class is known
+    :param colors: float tensor (num_classes + 1, 3) of RGB colors in [0, 1], first row for no class
+    :return: float tensor (B, 3, H, W)
+    """
+
+    return colors[labels.long()].permute(0, 3, 1, 2).contiguous()
+
+
+def micro_batches(batch_size, micro_batch_size=None):
+    """
+    Split a batch into consecutive micro-batches for gradient accumulation
+
+    :param batch_size: number of samples in the batch
+    :param micro_batch_size: maximum number of samples per micro-batch, None or 0 keeps the batch whole
+    :return: list of (slice, weight) pairs; weight is the share of the micro-batch in the batch, which makes weighted
+        losses of micro-batches sum to the loss of the batch for losses that are means over samples
+    """
+
+    if not micro_batch_size or micro_batch_size >= batch_size:
+        return [(slice(0, batch_size), 1.0)]
+    return [(slice(start, min(start + micro_batch_size, batch_size)),
+             (min(start + micro_batch_size, batch_size) - start) / batch_size)
+            for start in range(0, batch_size, micro_batch_size)]
+
+
+def train_model(network, data_loader, optimizer, lr_scheduler, criterion, epochs=2, resolution_schedule=None,
+                loss_sampler=None, crops=1, amp=False, micro_batch_size=None, segmenter=None, stage='all'):
     """
     Train model
 
     :param network: Parameters of defined neural networks
     :param data_loader: A data loader object defined on train data set
+    :param resolution_schedule: A ResolutionSchedule object which provides loaders instead of ``data_loader``
+    :param loss_sampler: A LossAwareSampler object to report per-sample losses to
+    :param crops: number of crops per image of the data set; batches are then flattened and mixed by MultiCropBuffer
+    :param amp: run forward passes and losses under bf16 autocast (Gram matrices and cross entropies stay float32).
+        Off by default: its speed and memory against float32 are unmeasured, compare them with ``utils/benchmark.py``
+    :param segmenter: an AsyncSegmenter object adding ObjectNet maps to batches instead of running ObjectNet inline.
+        ObjectNet is not run either when batches hold 'y_object' from the segmentation cache. Unused in stage 'coarse',
+        which needs no maps
+    :param micro_batch_size: forward and backward each batch in micro-batches of at most this many samples and step
+        every optimizer once per batch on the accumulated gradients, so peak activation memory scales with the
+        micro-batch rather than the batch. BatchNorm layers still normalize with statistics of a micro-batch and update
+        their running statistics once per micro-batch; use micro-batches of at least 16 samples or freeze BatchNorm
+        if that matters. The style terms of CoarseLoss and DetailsLoss take one Gram matrix over all samples of what
+        they are given, which mixes samples and is not a mean over them, so accumulated gradients only approximate
+        those of the whole batch. Per-sample losses (L1, edge, cross entropy) accumulate exactly. None or 0 trains on
+        whole batches
+    :param stage: 'all' trains every network every step; 'coarse' trains CoarseNet and EdgeNet alone (phase 1 of
+        staged training); 'details' trains DetailsNet and discriminators on batches of a StageCache holding outputs
+        of frozen CoarseNet and EdgeNet (phase 3, see ``utils/stages.py``)
     :param epochs: Number of epochs to train model
     :param optimizer: Optimizer to train network
     :param lr_scheduler: Learning schedulers to decay its rate every epoch by 0.9
@@ -133,6 +204,13 @@ def train_model(network, data_loader, optimizer, lr_scheduler, criterion, epochs
     :return: None
     """
 
+    if stage not in ('all', 'coarse', 'details'):
+        raise ValueError("stage should be 'all', 'coarse' or 'details', but got {}".format(stage))
+    trained = {'all': ('coarse', 'edge', 'details', 'disc1', 'disc2'),
+               'coarse': ('coarse', 'edge'),
+               'details': ('details', 'disc1', 'disc2')}[stage]
+    generators = [name for name in ('coarse', 'edge', 'details') if name in trained]
+
     # Models
     coarse_net = network['coarse'].train()
     edge_net = network['edge'].train()
@@ -140,118 +218,159 @@ def train_model(network, data_loader, optimizer, lr_scheduler, criterion, epochs
     details_net = network['details'].train()
     disc_one = network['disc1'].train()
     disc_two = network['disc2'].train()
+    if stage == 'details':  # EdgeNet still maps outputs of DetailsNet to edges, gradients flow through it
+        freeze(coarse_net)
+        freeze(edge_net)
+
+    # colors of ObjectNet classes for the object input of discriminator two, black where no class is known
+    colors = loadmat('data/color150.mat')['colors'][object_net.final_class_indices.numpy()]
+    object_colors = torch.cat((torch.zeros(1, 3), torch.from_numpy(colors).float() / 255)).to(device)
 
     # Losses
     coarse_crit = criterion['coarse']
     edge_crit = criterion['edge']
     details_crit = criterion['details']
+    adversarial_crit = criterion['adversarial']
 
     # Optims
-    coarse_optim = optimizer['coarse']
-    edge_optim = optimizer['edge']
-    details_optim = optimizer['details']
     disc_one_optim = optimizer['disc1']
     disc_two_optim = optimizer['disc2']
 
-    # LR_schedulers
-    coarse_lr_scheduler = lr_scheduler['coarse']
-    edge_lr_scheduler = lr_scheduler['edge']
-    details_lr_scheduler = lr_scheduler['details']
-    disc_one_lr_scheduler = lr_scheduler['disc1']
-    disc_two_lr_scheduler = lr_scheduler['disc2']
-
     for epoch in range(epochs):
 
-        coarse_lr_scheduler.step()
-        edge_lr_scheduler.step()
-        details_lr_scheduler.step()
-        disc_one_lr_scheduler.step()
-        disc_two_lr_scheduler.step()
+        for name in trained:
+            lr_scheduler[name].step()
 
         running_loss_g = 0.0
         running_loss_disc_one = 0.0
         running_loss_disc_two = 0.0
-        for i, data in enumerate(data_loader, 0):
+        batches = resolution_schedule.batches(epoch) if resolution_schedule is not None else data_loader
+        if crops > 1:
+            batches = MultiCropBuffer(batches, buffer_batches=4)
+        if segmenter is not None and stage != 'coarse':
+            batches = segmenter.pipeline(batches)
+        for i, data in enumerate(batches, 0):
             x = data['x']
             y_d = data['y_descreen']
             y_e = data['y_edge']
 
-            x = x.to(device)
-            y_d = y_d.to(device)
-
-            coarse_optim.zero_grad()
-            edge_optim.zero_grad()
-
-            coarse_outputs = coarse_net(x)
-            edge_outputs = edge_net(x)
-            # we have to pass images as dictionary if we do not want to change source code of ObjectNet
-            object_inputs = object_net({'img_data': coarse_outputs})
-            seg_size = (coarse_outputs.size())
-            seg_size = (seg_size[2], seg_size[3])
-            object_outputs = object_net(object_inputs, segSize=seg_size)
-
-            # concatenation of input(halftone):h, coarse_output:a, object_output:c, and edge_output:e. I name it HACE to
-            # represent each tensor respectively. (feed into details_net)
-            hace_outputs = torch.cat((x, coarse_outputs, object_outputs, edge_outputs), dim=1)
-            details_outputs = details_net(hace_outputs)
-            details_outputs = details_outputs + coarse_outputs  # Do not use += (inplace operation)
-            details_edges = edge_net(details_outputs)
-            details_outputs_edges_dic = {'d_o': details_outputs, 'd_e': details_edges, 'y_e': y_e}
-
-            # Train generator: DetailsNet
-            details_optim.zero_grad()
-            disc_one_out = disc_one(details_outputs)
-            valid = torch.ones(disc_one_out.size()).to(device)
-            g_loss = criterion(disc_one_out, valid)  # TODO replace details_crit
-            g_loss.backward(retain_graph=True)
-            details_optim.step()
-
-            # train discriminator one
-            disc_one_optim.zero_grad()
-            ground_truth_residual = y_d - coarse_outputs
-            disc_one_out = disc_one(ground_truth_residual)
-            valid = torch.ones(disc_one_out.size()).to(device)
-            real_loss = criterion(disc_one_out, valid)  # TODO replace disc_loss
-            disc_one_out = disc_one(details_outputs)
-            fake = torch.zeros(disc_one_out.size()).to(device)
-            fake_loss = criterion(disc_one_out, fake)  # TODO replace disc_loss
-            disc_one_loss = (real_loss + fake_loss) / 2
-            disc_one_loss.backward(retain_graph=True)
-            disc_one_optim.step()
-
-            # concatenation of input(halftone):h, ground_truth(y_d):o, and details_output:d. I name it HOD to
-            # represent each tensor respectively. (feed into disc_two)
-            hod_outputs = torch.cat((x, y_d, details_outputs), dim=1)
-
-            # train discriminator two
-            disc_two_optim.zero_grad()
-
-            object_output = torch.Tensor().to(device)
-            disc_two_out = disc_two(torch.cat((y_d, object_output), dim=1))
-            valid = torch.ones(disc_two_out.size()).to(device)
-            real_loss = criterion(disc_two_out, valid)  # TODO replace disc_loss
-            disc_two_out = disc_two(torch.cat((details_outputs, object_output), dim=1))
-            fake = torch.zeros(disc_two_out.size()).to(device)
-            fake_loss = criterion(disc_two_out, fake)  # TODO replace disc_loss
-            disc_two_loss = (real_loss + fake_loss) / 2
-            disc_two_loss.backward()
-            disc_two_optim.step()
-
-            coarse_loss = coarse_crit(coarse_outputs, y_d)
-            edge_loss = edge_crit(edge_outputs, y_e.float())
-            details_loss = details_crit(hace_outputs, details_outputs_edges_dic)
-
-            coarse_crit.backward()
-            edge_crit.backward()
-            details_loss.backward()
-
-            coarse_optim.step()
-            edge_optim.step()
-
-
-            running_loss += coarse_loss.item() + edge_loss.item()
-            print(epoch + 1, ',', i + 1, 'coarse_loss: ', coarse_loss.item(),
-                  'edge_loss: ', edge_loss, 'details_loss: ', details_loss, 'sum of losses:', running_loss)
+            x = x.to(device).float()  # a StageCache holds float16
+            y_d = y_d.to(device).float()
+            y_e = y_e.to(device)
+            y_o = data['y_object'].to(device) if 'y_object' in data else None
+            if stage == 'details':
+                cached_coarse = data['coarse_outputs'].to(device).float()
+                cached_edge = data['edge_outputs'].to(device).float()
+            parts = micro_batches(x.size(0), micro_batch_size)
+
+            # Train generators: CoarseNet, EdgeNet and DetailsNet. Their losses share one graph (DetailsNet reads
+            # outputs of CoarseNet and EdgeNet, EdgeNet maps outputs of DetailsNet to edges), so one backward of their
+            # sum fills the gradients of all three before any of them steps; separate backward passes would need
+            # retain_graph and would see weights already updated by an earlier step. Losses of micro-batches are
+            # weighted by their share of the batch; accumulated gradients equal those of the whole batch for
+            # per-sample terms only, Gram terms and BatchNorm see one micro-batch at a time (see docstring)
+            for name in generators:
+                optimizer[name].zero_grad()
+
+            step_losses = {'coarse': 0.0, 'edge': 0.0, 'details': 0.0, 'g': 0.0}
+            generated = []  # detached outputs and segmentation of each micro-batch, inputs of discriminators
+            for part, w in parts:
+                part_losses = {}
+                with autocast(device.type, enabled=amp):
+                    if stage == 'details':
+                        coarse_outputs = cached_coarse[part]
+                        edge_outputs = cached_edge[part]
+                    else:
+                        coarse_outputs = coarse_net(x[part])
+                        edge_outputs = edge_net(x[part])
+                        part_losses['coarse'] = coarse_crit(coarse_outputs, y_d[part])
+                        part_losses['edge'] = edge_crit(edge_outputs, y_e[part].float())
+
+                    if stage != 'coarse':
+                        if y_o is not None:  # segmentation from the cache, segmenter or stage cache
+                            object_labels = y_o[part]
+                        else:
+                            # we have to pass images as dictionary if we do not want to change source code of
+                            # ObjectNet
+                            seg_size = (coarse_outputs.size(2), coarse_outputs.size(3))
+                            with torch.no_grad():
+                                object_labels = object_net({'img_data': coarse_outputs}, segSize=seg_size).byte() + 1
+                        object_outputs = one_hot(object_labels)
+
+                        # concatenation of input(halftone):h, coarse_output:a, object_output:c, and edge_output:e. I
+                        # name it HACE to represent each tensor respectively. (feed into details_net)
+                        hace_outputs = torch.cat((x[part], coarse_outputs, object_outputs, edge_outputs), dim=1)
+                        details_outputs = details_net(hace_outputs)
+                        details_outputs = details_outputs + coarse_outputs  # Do not use += (inplace operation)
+                        details_edges = edge_net(details_outputs)
+                        details_outputs_edges_dic = {'d_o': details_outputs, 'd_e': details_edges, 'y_e': y_e[part]}
+
+                        disc_one_out = disc_one(details_outputs)
+                        valid = torch.ones(disc_one_out.size()).to(device)
+                        part_losses['g'] = adversarial_crit(disc_one_out, valid)
+                        part_losses['details'] = details_crit(hace_outputs, details_outputs_edges_dic)
+
+                # backward and master weights stay in float32
+                (sum(part_losses.values()) * w).backward()
+                for name, loss in part_losses.items():
+                    step_losses[name] += loss.item() * w
+
+                if loss_sampler is not None:
+                    with torch.no_grad():
+                        sample_losses = 0.
+                        if 'coarse' in part_losses:
+                            sample_losses = sample_losses + coarse_crit.per_sample(coarse_outputs, y_d[part]) + \
+                                            edge_crit.per_sample(edge_outputs, y_e[part].float())
+                        if 'details' in part_losses:
+                            sample_losses = sample_losses + \
+                                            details_crit.per_sample(hace_outputs, details_outputs_edges_dic)
+                    loss_sampler.update(data['index'][part].numpy(), sample_losses.float().cpu().numpy())
+
+                if stage != 'coarse':
+                    generated.append((coarse_outputs.detach(), details_outputs.detach(), object_labels))
+            for name in generators:
+                optimizer[name].step()
+
+            disc_one_loss = disc_two_loss = 0.0
+            if stage != 'coarse':  # on outputs detached above, so discriminator losses never reach the generators
+                # train discriminator one
+                disc_one_optim.zero_grad()
+                for (part, w), (coarse_outputs, details_outputs, _) in zip(parts, generated):
+                    with autocast(device.type, enabled=amp):
+                        ground_truth_residual = y_d[part] - coarse_outputs
+                        disc_one_out = disc_one(ground_truth_residual)
+                        valid = torch.ones(disc_one_out.size()).to(device)
+                        real_loss = adversarial_crit(disc_one_out, valid)
+                        disc_one_out = disc_one(details_outputs)
+                        fake = torch.zeros(disc_one_out.size()).to(device)
+                        fake_loss = adversarial_crit(disc_one_out, fake)
+                        part_loss = (real_loss + fake_loss) / 2
+                    (part_loss * w).backward()
+                    disc_one_loss += part_loss.item() * w
+                disc_one_optim.step()
+
+                # train discriminator two
+                disc_two_optim.zero_grad()
+                for (part, w), (_, details_outputs, object_labels) in zip(parts, generated):
+                    with autocast(device.type, enabled=amp):
+                        # conditioned on halftone and color encoded segmentation: I_h, I_d and I_o
+                        object_output = color_encode(object_labels, object_colors)
+                        disc_two_out = disc_two(torch.cat((x[part], y_d[part], object_output), dim=1))
+                        valid = torch.ones(disc_two_out.size()).to(device)
+                        real_loss = adversarial_crit(disc_two_out, valid)
+                        disc_two_out = disc_two(torch.cat((x[part], details_outputs, object_output), dim=1))
+                        fake = torch.zeros(disc_two_out.size()).to(device)
+                        fake_loss = adversarial_crit(disc_two_out, fake)
+                        part_loss = (real_loss + fake_loss) / 2
+                    (part_loss * w).backward()
+                    disc_two_loss += part_loss.item() * w
+                disc_two_optim.step()
+
+            running_loss_g += sum(step_losses.values())
+            running_loss_disc_one += disc_one_loss
+            running_loss_disc_two += disc_two_loss
+            print(epoch + 1, ',', i + 1, 'coarse_loss: ', step_losses['coarse'], 'edge_loss: ', step_losses['edge'],
+                  'details_loss: ', step_losses['details'], 'sum of losses:', running_loss_g)
     print('*************** Training Finished ***************')
 
 # %% test
@@ -304,90 +423,227 @@ def show_batch_image(image_batch):
     cvs.show()
 
 
-# %% initialize network, loss and optimizer
-
-# CoarseNet
-coarse_crit = CoarseLoss(w1=50, w2=1).to(device)
-coarse_net = CoarseNet().to(device)
-coarse_optim = optim.Adam(coarse_net.parameters(), lr=args.lr)
-coarse_lr_scheduler = optim.lr_scheduler.StepLR(optimizer=coarse_optim, step_size=1, gamma=args.lr_decay)
-coarse_net.apply(init_weights)
-
-# EdgeNet
-edge_crit = EdgeLoss().to(device)
-edge_net = EdgeNet().to(device)
-edge_optim = optim.Adam(edge_net.parameters(), lr=args.lr)
-edge_lr_scheduler = optim.lr_scheduler.StepLR(optimizer=edge_optim, step_size=1, gamma=args.lr_decay)
-edge_net.apply(init_weights)
-
-# ObjectNet
-builder = ModelBuilder()
-net_encoder = builder.build_encoder(
-    arch='resnet101dilated',
-    fc_dim=2048,
-    weights=os.path.join('pretrained/baseline-resnet101dilated-ppm_deepsup', 'encoder' + '_epoch_25.pth'))
-net_decoder = builder.build_decoder(
-    arch='ppm_deepsup',
-    fc_dim=2048,
-    num_class=150,
-    weights=os.path.join('pretrained/baseline-resnet101dilated-ppm_deepsup', 'decoder' + '_epoch_25.pth'),
-    use_softmax=True)
-object_net = SegmentationModule(net_encoder, net_decoder, None)
-object_net.cuda()
-
-# DetailsNet
-details_crit = DetailsLoss().to(device)
-random_noise_adder = RandomNoise(p=0, mean=0, std=0.1)  # add noise to input of generator (DetailsNet)
-details_net = DetailsNet().to(device)
-disc_one = DiscriminatorOne().to(device)
-disc_two = DiscriminatorTwo().to(device)
-
-details_optim = optim.Adam(details_net.parameters(), lr=args.lr)
-disc_one_optim = optim.Adam(disc_one.parameters(), lr=args.lr)
-disc_two_optim = optim.Adam(disc_two.parameters(), lr=args.lr)
-details_lr_scheduler = optim.lr_scheduler.StepLR(optimizer=details_optim, step_size=1, gamma=args.lr_decay)
-disc_one_lr_scheduler = optim.lr_scheduler.StepLR(optimizer=disc_one_optim, step_size=1, gamma=args.lr_decay)
-disc_two_lr_scheduler = optim.lr_scheduler.StepLR(optimizer=disc_two_optim, step_size=1, gamma=args.lr_decay)
-
-details_net.apply(init_weights)
-disc_one.apply(init_weights)
-disc_two.apply(init_weights)
-
-
-# %% Train model
-
-models = {
-    'coarse': coarse_net,
-    'edge': edge_net,
-    'object': object_net,
-    'details': details_net,
-    'disc1': disc_one,
-    'disc2': disc_two
-}
-
-losses = {
-    'coarse': coarse_crit,
-    'edge': edge_crit,
-    'details': details_crit
-}
-
-optims = {
-    'coarse': coarse_optim,
-    'edge': edge_optim,
-    'details': details_optim,
-    'disc1': disc_one_optim,
-    'disc2': disc_two_optim
-}
-
-lr_schedulers = {
-    'coarse': coarse_lr_scheduler,
-    'edge': edge_lr_scheduler,
-    'details': details_lr_scheduler,
-    'disc1': disc_one_lr_scheduler,
-    'disc2': disc_two_lr_scheduler
-}
-
-train_model(network=models, data_loader=train_loader, optimizer=optims, lr_scheduler=lr_schedulers,
-            criterion=losses, epochs=args.es)
 
-# %% test
+# %% main
+def main():
+    """
+    Build data sets, loaders and networks from ``args`` and train them. Kept out of module scope, since processes
+    started with ``spawn`` (e.g. AsyncSegmenter) import the main module again
+    """
+
+    if args.cudnn == 1:
+        cudnn.benchmark = True
+    else:
+        cudnn.benchmark = False
+
+    if args.pm == 1:
+        pin_memory = True
+    else:
+        pin_memory = False
+
+    if args.ms == 1:  # statistics of our own training set, cached after the first run
+        stats_dataset = PlacesDataset(txt_path=args.txt,
+                                      img_dir=args.img,
+                                      transform=ToTensor(),
+                                      test=True)
+        mean, std = OnlineMeanStd(num_workers=args.nw, cache_dir=args.ms_cache)(stats_dataset)
+        mean, std = mean.tolist(), std.tolist()
+    else:  # ImageNet
+        mean, std = [0.485, 0.456, 0.406], [0.229, 0.224, 0.225]
+
+    custom_transforms = train_transforms(224, mean, std)
+
+    train_dataset = PlacesDataset(txt_path=args.txt,
+                                  img_dir=args.img,
+                                  transform=custom_transforms,
+                                  meta_path=args.meta,
+                                  crops=args.crops,
+                                  seg_dir=args.seg)
+
+    if args.la == 1:
+        train_sampler = LossAwareSampler(len(train_dataset), decay=0.9, uniform=0.2)
+    elif args.blk > 0:  # mostly sequential reads from tar archives
+        offsets = train_dataset.meta['tar_offset'] if train_dataset.use_offsets else None
+        train_sampler = BlockShuffleSampler(train_dataset, block_size=args.blk, offsets=offsets)
+    else:
+        train_sampler = RandomSampler(train_dataset)
+
+    # one tuner for all phases of the resolution schedule, so what it learned survives rebuilding the loader
+    loader_tuner = PrefetchTuner(args.nw) if args.ap == 1 else False
+
+    def build_train_loader(phase, sampler_state=None):
+        """
+        Build loader of train set for a phase of resolution schedule. Only transforms of the data set are swapped, the
+        (memory-mapped) file list and metadata are reused.
+
+        :param phase: index of phase in resolution schedule
+        :param sampler_state: state of train sampler to continue an interrupted pass from
+        :return: DataLoader object
+        """
+
+        train_dataset.set_transform(train_transforms(resolution_schedule.size(phase), mean, std))
+        if sampler_state is not None:
+            train_sampler.load_state_dict(sampler_state)
+        return torchdata.DataLoader(dataset=train_dataset,
+                                    batch_size=max(1, resolution_schedule.batch_size(phase) // args.crops),
+                                    sampler=train_sampler,
+                                    num_workers=loader_tuner.num_workers if loader_tuner else args.nw,
+                                    pin_memory=pin_memory,
+                                    batch_slots=args.slots,
+                                    persistent_workers=args.pw == 1,
+                                    adaptive=loader_tuner,
+                                    in_order=args.uo == 0,
+                                    profile=args.prof == 1)
+
+    resolution_schedule = ResolutionSchedule(args.rs if args.rs is not None else [(0, 224)],
+                                             loader_fn=build_train_loader,
+                                             base_size=224,
+                                             base_batch_size=args.bs,
+                                             unit=args.rs_unit)
+
+    train_loader = build_train_loader(0)
+
+    test_dataset = PlacesDataset(txt_path=args.txt_t,
+                                 img_dir=args.img_t,
+                                 transform=ToTensor(),
+                                 test=True)
+
+    # full resolution images of mixed sizes: batch similar sizes together and pad only to the largest of each batch
+    test_loader = DataLoader(dataset=test_dataset,
+                             batch_sampler=BucketBatchSampler(test_dataset.get_image_sizes, batch_size=args.bs,
+                                                              max_pixels=args.bs * 224 * 224 * 4),
+                             num_workers=args.nw,
+                             collate_fn=pad_collate,
+                             pin_memory=False)
+
+    # initialize network, loss and optimizer
+
+    # CoarseNet
+    coarse_crit = CoarseLoss(w1=50, w2=1).to(device)
+    coarse_net = CoarseNet().to(device)
+    coarse_optim = optim.Adam(coarse_net.parameters(), lr=args.lr)
+    coarse_lr_scheduler = optim.lr_scheduler.StepLR(optimizer=coarse_optim, step_size=1, gamma=args.lr_decay)
+    coarse_net.apply(init_weights)
+
+    # EdgeNet
+    edge_crit = EdgeLoss().to(device)
+    edge_net = EdgeNet().to(device)
+    edge_optim = optim.Adam(edge_net.parameters(), lr=args.lr)
+    edge_lr_scheduler = optim.lr_scheduler.StepLR(optimizer=edge_optim, step_size=1, gamma=args.lr_decay)
+    edge_net.apply(init_weights)
+
+    # ObjectNet
+    builder = ModelBuilder()
+    net_encoder = builder.build_encoder(
+        arch='resnet101dilated',
+        fc_dim=2048,
+        weights=os.path.join('pretrained/baseline-resnet101dilated-ppm_deepsup', 'encoder' + '_epoch_25.pth'))
+    net_decoder = builder.build_decoder(
+        arch='ppm_deepsup',
+        fc_dim=2048,
+        num_class=150,
+        weights=os.path.join('pretrained/baseline-resnet101dilated-ppm_deepsup', 'decoder' + '_epoch_25.pth'),
+        use_softmax=True)
+    object_net = SegmentationModule(net_encoder, net_decoder, None)
+    if args.seg is None and args.segp == 0:  # otherwise maps come from the cache or segmenter processes
+        object_net.to(device)
+
+    # DetailsNet
+    details_crit = DetailsLoss().to(device)
+    random_noise_adder = RandomNoise(p=0, mean=0, std=0.1)  # add noise to input of generator (DetailsNet)
+    details_net = DetailsNet().to(device)
+    disc_one = DiscriminatorOne().to(device)
+    disc_two = DiscriminatorTwo().to(device)
+
+    details_optim = optim.Adam(details_net.parameters(), lr=args.lr)
+    disc_one_optim = optim.Adam(disc_one.parameters(), lr=args.lr)
+    disc_two_optim = optim.Adam(disc_two.parameters(), lr=args.lr)
+    details_lr_scheduler = optim.lr_scheduler.StepLR(optimizer=details_optim, step_size=1, gamma=args.lr_decay)
+    disc_one_lr_scheduler = optim.lr_scheduler.StepLR(optimizer=disc_one_optim, step_size=1, gamma=args.lr_decay)
+    disc_two_lr_scheduler = optim.lr_scheduler.StepLR(optimizer=disc_two_optim, step_size=1, gamma=args.lr_decay)
+
+    details_net.apply(init_weights)
+    disc_one.apply(init_weights)
+    disc_two.apply(init_weights)
+
+    # activation checkpointing: recompute activations of chosen blocks during backward to fit larger crops or batches
+    # 'object' only matters if ObjectNet is ever trained: online ObjectNet runs under no_grad and stores no activations
+    checkpointed_nets = {'coarse': coarse_net, 'edge': edge_net, 'details': details_net, 'object': net_encoder}
+    for name, policy in (args.ckpt or {}).items():
+        print('checkpointed blocks of', name, ':', checkpointed_nets[name].set_checkpointing(policy))
+
+    # Train model
+    segmenter = None
+    if args.seg is None and args.segp > 0:
+        segmenter = AsyncSegmenter(mode=args.segp_mode, coarse_net=coarse_net if args.segp_mode == 'coarse' else None,
+                                   num_workers=args.segp, threads=args.segp_threads, depth=args.segp_depth)
+
+    models = {
+        'coarse': coarse_net,
+        'edge': edge_net,
+        'object': object_net,
+        'details': details_net,
+        'disc1': disc_one,
+        'disc2': disc_two
+    }
+
+    losses = {
+        'coarse': coarse_crit,
+        'edge': edge_crit,
+        'details': details_crit,
+        'adversarial': AdversarialLoss().to(device)
+    }
+
+    optims = {
+        'coarse': coarse_optim,
+        'edge': edge_optim,
+        'details': details_optim,
+        'disc1': disc_one_optim,
+        'disc2': disc_two_optim
+    }
+
+    lr_schedulers = {
+        'coarse': coarse_lr_scheduler,
+        'edge': edge_lr_scheduler,
+        'details': details_lr_scheduler,
+        'disc1': disc_one_lr_scheduler,
+        'disc2': disc_two_lr_scheduler
+    }
+
+    if args.stages == 0:
+        train_model(network=models, data_loader=train_loader, optimizer=optims, lr_scheduler=lr_schedulers,
+                    criterion=losses, epochs=args.es, resolution_schedule=resolution_schedule,
+                    loss_sampler=train_sampler if args.la == 1 else None, crops=args.crops, amp=args.amp == 1,
+                    micro_batch_size=args.mb, segmenter=segmenter)
+    else:
+        # phase 1: CoarseNet and EdgeNet alone
+        train_model(network=models, data_loader=train_loader, optimizer=optims, lr_scheduler=lr_schedulers,
+                    criterion=losses, epochs=args.es1, resolution_schedule=resolution_schedule,
+                    loss_sampler=train_sampler if args.la == 1 else None, crops=args.crops, amp=args.amp == 1,
+                    micro_batch_size=args.mb, segmenter=None, stage='coarse')
+
+        resolution_schedule.close()  # persistent workers of phase 1 are not needed anymore
+
+        # phase 2: outputs of frozen CoarseNet and EdgeNet (and ObjectNet) once per crop
+        train_dataset.set_transform(train_transforms(224, mean, std))
+        cache_loader = torchdata.DataLoader(dataset=train_dataset, batch_size=max(1, args.bs // args.crops),
+                                            num_workers=args.nw, pin_memory=pin_memory)
+        cache_batches = (MultiCropBuffer.flatten(b) if args.crops > 1 else b
+                         for _ in range(args.stage_passes) for b in cache_loader)
+        if segmenter is not None:
+            cache_batches = segmenter.pipeline(cache_batches)
+        stage_cache = build_stage_cache(cache_batches, coarse_net, edge_net, object_net, args.stage_dir,
+                                        num_samples=len(train_dataset) * args.crops * args.stage_passes, size=224,
+                                        device=device, amp=args.amp == 1)
+
+        # phase 3: DetailsNet and discriminators from the cache
+        stage_loader = torchdata.DataLoader(dataset=stage_cache, batch_size=args.bs, shuffle=True, num_workers=args.nw,
+                                            pin_memory=pin_memory, persistent_workers=args.pw == 1)
+        train_model(network=models, data_loader=stage_loader, optimizer=optims, lr_scheduler=lr_schedulers,
+                    criterion=losses, epochs=args.es, amp=args.amp == 1, micro_batch_size=args.mb, stage='details')
+    if segmenter is not None:
+        segmenter.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,105 @@
+# %% libraries
+import argparse
+import multiprocessing
+import resource
+import time
+
+import torch
+import torch.nn.functional as F
+
+from models.coarse_net import CoarseNet
+from models.edge_net import EdgeNet
+from models.details_net import DetailsNet
+from models.discriminators import DiscriminatorOne
+from utils.losses import CoarseLoss, EdgeLoss, DetailsLoss, AdversarialLoss, autocast
+
+
+# %% functions
+def generator_step(nets, crits, optims, x, y_d, y_e, amp):
+    """
+    One optimization step of CoarseNet, EdgeNet and DetailsNet as in ``train_model``. ObjectNet is replaced by random
+    class probabilities of the same shape, as it is frozen and its cost does not depend on the step.
+
+    :return: sum of losses
+    """
+
+    for optim in optims:
+        optim.zero_grad()
+    with autocast('cpu', enabled=amp):
+        coarse_outputs = nets['coarse'](x)
+        edge_outputs = nets['edge'](x)
+        object_outputs = F.softmax(torch.randn(x.size(0), 25, x.size(2), x.size(3)), dim=1)
+        hace_outputs = torch.cat((x, coarse_outputs, object_outputs, edge_outputs), dim=1)
+        details_outputs = nets['details'](hace_outputs) + coarse_outputs
+        details_edges = nets['edge'](details_outputs)
+        disc_one_out = nets['disc1'](details_outputs)
+        loss = crits['coarse'](coarse_outputs, y_d) + crits['edge'](edge_outputs, y_e) + \
+            crits['details'](hace_outputs, {'d_o': details_outputs, 'd_e': details_edges, 'y_e': y_e}) + \
+            crits['adversarial'](disc_one_out, torch.ones(disc_one_out.size()))
+    loss.backward()
+    for optim in optims:
+        optim.step()
+    return loss.item()
+
+
+def run(amp, ckpt, batch_size, size, steps, warmup, threads, results):
+    """
+    Measure one mode in a fresh process, so peak RSS is not shared with other modes
+
+    :param amp: bf16 autocast
+    :param ckpt: activation checkpointing policy of CoarseNet, EdgeNet and DetailsNet (see ``set_checkpointing``)
+    """
+
+    torch.set_num_threads(threads)
+    torch.manual_seed(0)
+    nets = {'coarse': CoarseNet(), 'edge': EdgeNet(), 'details': DetailsNet(), 'disc1': DiscriminatorOne()}
+    for k in ('coarse', 'edge', 'details'):
+        nets[k].set_checkpointing(ckpt)
+    crits = {'coarse': CoarseLoss(), 'edge': EdgeLoss(), 'details': DetailsLoss(), 'adversarial': AdversarialLoss()}
+    optims = [torch.optim.Adam(nets[k].parameters(), lr=1e-4) for k in ('coarse', 'edge', 'details')]
+
+    x = torch.rand(batch_size, 3, size, size)
+    y_d = torch.rand(batch_size, 3, size, size)
+    y_e = (torch.rand(batch_size, 1, size, size) > 0.9).float()
+
+    for _ in range(warmup):
+        generator_step(nets, crits, optims, x, y_d, y_e, amp)
+    start = time.time()
+    for _ in range(steps):
+        generator_step(nets, crits, optims, x, y_d, y_e, amp)
+    seconds = time.time() - start
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.  # kilobytes on Linux
+    mode = ('bf16' if amp else 'fp32') + ('+ckpt' if ckpt else '')
+    results.put((mode, batch_size * steps / seconds, seconds / steps, peak))
+
+
+# %% command line tool
+if __name__ == '__main__':
+    # No reference numbers are kept in the repository: results depend on the CPU, threads and PyTorch build, so run
+    # it on the machine to train on, e.g. python -m utils.benchmark --bs 8 --size 224 --ckpt 2. Until bf16 is measured
+    # to be faster or smaller there, args.amp of train.py stays 0
+    parser = argparse.ArgumentParser(description='Measure images/s, s/step and peak RSS of the generator step in fp32 '
+                                                 'and bf16 autocast on CPU, optionally with activation checkpointing')
+    parser.add_argument('--bs', type=int, default=8, help='batch size')
+    parser.add_argument('--size', type=int, default=224, help='crop size')
+    parser.add_argument('--steps', type=int, default=10, help='measured steps per mode')
+    parser.add_argument('--warmup', type=int, default=2, help='steps before measuring')
+    parser.add_argument('--ckpt', type=int, default=0, help='also measure checkpointing of every k-th block, 0 skips')
+    parser.add_argument('--threads', type=int, default=torch.get_num_threads(), help='intra-op threads')
+    opt = parser.parse_args()
+
+    if not hasattr(torch, 'autocast'):
+        raise SystemExit('torch.autocast is not available in PyTorch {}'.format(torch.__version__))
+
+    results = multiprocessing.Queue()
+    modes = [(amp, ckpt) for ckpt in sorted({0, opt.ckpt}) for amp in (False, True)]
+    for amp, ckpt in modes:
+        p = multiprocessing.Process(target=run, args=(amp, ckpt, opt.bs, opt.size, opt.steps, opt.warmup,
+                                                      opt.threads, results))
+        p.start()
+        p.join()
+
+    rows = sorted(results.get() for _ in modes)
+    print('{:<11}{:>12}{:>12}{:>14}'.format('mode', 'images/s', 's/step', 'peak RSS MB'))
+    for mode, throughput, step, peak in rows:
+        print('{:<11}{:>12.2f}{:>12.3f}{:>14.0f}'.format(mode, throughput, step, peak))
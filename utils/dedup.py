@@ -0,0 +1,209 @@
+# %% libraries
+import argparse
+import multiprocessing
+import tarfile
+
+import numpy as np
+from PIL import Image
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components
+from torchvision.transforms import ToTensor
+
+from utils.preprocess import PlacesDataset
+
+
+# %% constants
+HASH_SIZE = 8
+"""Perceptual hashes are HASH_SIZE x HASH_SIZE = 64 bits"""
+DCT_SIZE = 32
+"""Images are reduced to DCT_SIZE x DCT_SIZE grayscale before the DCT"""
+
+_DCT_MATRIX = np.cos(np.pi * np.outer(np.arange(DCT_SIZE), 2 * np.arange(DCT_SIZE) + 1) / (2 * DCT_SIZE))
+_POPCOUNT = np.array([bin(i).count('1') for i in range(256)], dtype=np.uint8)
+_BIT_WEIGHTS = np.uint64(1) << np.arange(HASH_SIZE * HASH_SIZE, dtype=np.uint64)
+
+
+# %% functions
+def phash(image):
+    """
+    Return 64-bit DCT perceptual hash of an image: low frequencies of a 32x32 grayscale thumbnail thresholded at
+    their median. Rescaling, re-compression and mild color changes keep the hash within a few bits.
+
+    :param image: PIL image
+    :return: numpy uint64
+    """
+
+    image.draft('L', (DCT_SIZE * 2, DCT_SIZE * 2))  # JPEG: decode at reduced size
+    pixels = np.asarray(image.convert('L').resize((DCT_SIZE, DCT_SIZE), Image.BILINEAR), dtype=np.float64)
+    dct = _DCT_MATRIX.dot(pixels).dot(_DCT_MATRIX.T)[:HASH_SIZE, :HASH_SIZE].flatten()
+    bits = dct > np.median(dct[1:])  # DC term only carries brightness
+    return np.bitwise_or.reduce(_BIT_WEIGHTS[bits], initial=np.uint64(0))
+
+
+def hamming(a, b):
+    """
+    Return element-wise Hamming distance of two uint64 arrays
+
+    :param a: numpy uint64 array
+    :param b: numpy uint64 array of same size
+    :return: numpy array of distances
+    """
+
+    x = np.ascontiguousarray(np.bitwise_xor(a, b), dtype=np.uint64)
+    return _POPCOUNT[x.view(np.uint8)].reshape(-1, 8).sum(axis=1)
+
+
+def _flip_masks(bits, radius):
+    """
+    Return all masks of ``bits`` bits with at most ``radius`` bits set
+    """
+
+    masks = [0]
+    for _ in range(radius):
+        masks = sorted(set(m | (1 << b) for m in masks for b in range(bits)) | set(masks))
+    return np.array(masks, dtype=np.uint64)
+
+
+def near_duplicate_pairs(hashes, threshold=4, bands=4, chunk_size=1 << 20):
+    """
+    Find all pairs of hashes within a Hamming distance using multi-index hashing: hashes are split into ``bands``
+    bands, and by pigeonhole two hashes within ``threshold`` bits match in at least one band within
+    ``threshold // bands`` bits. Only those candidates are compared, so no all-pairs comparison is done.
+
+    :param hashes: numpy uint64 array of unique hashes
+    :param threshold: maximum Hamming distance of near duplicates
+    :param bands: number of bands, ``64 / bands`` bits each
+    :param chunk_size: maximum number of candidate pairs expanded at once
+    :return: A tuple of numpy arrays (i, j) with i < j
+    """
+
+    band_bits = HASH_SIZE * HASH_SIZE // bands
+    radius = threshold // bands
+    masks = _flip_masks(band_bits, radius)
+    band_mask = np.uint64((1 << band_bits) - 1)
+    pairs_i, pairs_j = [], []
+
+    for band in range(bands):
+        keys = (hashes >> np.uint64(band * band_bits)) & band_mask
+        order = np.argsort(keys, kind='stable')
+        sorted_keys = keys[order]
+        for mask in masks:
+            queries = keys ^ mask
+            lo = np.searchsorted(sorted_keys, queries, side='left')
+            counts = np.searchsorted(sorted_keys, queries, side='right') - lo
+            ends = np.cumsum(counts)
+
+            # expand (query, candidate) pairs in chunks of about chunk_size
+            start = 0
+            while start < len(hashes):
+                stop = int(np.searchsorted(ends, (ends[start - 1] if start > 0 else 0) + chunk_size, side='right'))
+                stop = max(stop, start + 1)
+                c = counts[start:stop]
+                qi = np.repeat(np.arange(start, stop), c)
+                within = np.arange(len(qi)) - np.repeat(np.cumsum(c) - c, c)
+                cj = order[np.repeat(lo[start:stop], c) + within]
+                keep = qi < cj
+                qi, cj = qi[keep], cj[keep]
+                keep = hamming(hashes[qi], hashes[cj]) <= threshold
+                pairs_i.append(qi[keep])
+                pairs_j.append(cj[keep])
+                start = stop
+
+    if len(pairs_i) == 0:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+    return np.concatenate(pairs_i), np.concatenate(pairs_j)
+
+
+def clusters(hashes, threshold=4, bands=4):
+    """
+    Group images into near-duplicate clusters (connected components of the "within threshold" graph)
+
+    :param hashes: numpy uint64 array of hashes of all images
+    :param threshold: maximum Hamming distance of near duplicates
+    :param bands: number of bands of multi-index hashing
+    :return: numpy array of cluster label of each image
+    """
+
+    unique, inverse = np.unique(hashes, return_inverse=True)  # exact duplicates collapse here
+    i, j = near_duplicate_pairs(unique, threshold=threshold, bands=bands)
+    graph = coo_matrix((np.ones(len(i), dtype=np.int8), (i, j)), shape=(len(unique), len(unique)))
+    _, labels = connected_components(graph, directed=False)
+    return labels[inverse]
+
+
+_dedup_dataset = None
+"""PlacesDataset object of a hashing worker process"""
+
+
+def _init_hash_worker(dataset):
+    global _dedup_dataset
+    if dataset.tf is not None:  # do not share the parent's file offset
+        dataset.tf = tarfile.open(dataset.img_dir)
+    _dedup_dataset = dataset
+
+
+def _hash_chunk(indices):
+    """
+    Return hashes of a chunk of images and a mask of images which could be hashed
+    """
+
+    hashes = np.zeros(len(indices), dtype=np.uint64)
+    valid = np.zeros(len(indices), dtype=np.bool_)
+    for k, index in enumerate(indices):
+        try:
+            hashes[k] = phash(_dedup_dataset.get_image(index))
+            valid[k] = True
+        except Exception:
+            pass
+    return hashes, valid
+
+
+def hash_dataset(dataset, num_workers=4, chunk_size=256):
+    """
+    Compute perceptual hashes of all images of a PlacesDataset with a process pool
+
+    :param dataset: PlacesDataset object
+    :param num_workers: number of processes
+    :param chunk_size: number of images per task sent to a worker
+    :return: A tuple of (uint64 hashes, bool mask of images which could be decoded)
+    """
+
+    chunks = [range(i, min(i + chunk_size, len(dataset))) for i in range(0, len(dataset), chunk_size)]
+    with multiprocessing.Pool(num_workers, initializer=_init_hash_worker, initargs=(dataset,)) as pool:
+        results = pool.map(_hash_chunk, chunks)
+    return np.concatenate([r[0] for r in results]), np.concatenate([r[1] for r in results])
+
+
+# %% command line tool
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Write a file list without near-duplicate images')
+    parser.add_argument('--txt', required=True, help='file list (text or .idx)')
+    parser.add_argument('--img', required=True, help='image folder or uncompressed tar archive')
+    parser.add_argument('--meta', default=None, help='metadata sidecar; the largest image of a cluster is kept')
+    parser.add_argument('--out', required=True, help='output deduplicated file list')
+    parser.add_argument('--threshold', type=int, default=4, help='maximum Hamming distance of near duplicates')
+    parser.add_argument('--bands', type=int, default=4, help='number of bands of multi-index hashing')
+    parser.add_argument('--nw', type=int, default=4, help='number of worker processes')
+    opt = parser.parse_args()
+
+    dataset = PlacesDataset(txt_path=opt.txt, img_dir=opt.img, transform=ToTensor(), test=True, meta_path=opt.meta)
+    hashes, valid = hash_dataset(dataset, num_workers=opt.nw)
+
+    # images which could not be hashed are kept as they are, each in its own cluster
+    labels = np.full(len(dataset), -1, dtype=np.int64)
+    labels[valid] = clusters(hashes[valid], threshold=opt.threshold, bands=opt.bands)
+    labels[~valid] = labels.max() + 1 + np.arange(np.count_nonzero(~valid))
+
+    if dataset.meta is not None:
+        priority = dataset.meta['width'].astype(np.int64) * dataset.meta['height']
+    else:
+        priority = np.zeros(len(dataset), dtype=np.int64)
+    order = np.lexsort((np.arange(len(dataset)), -priority, labels))  # per cluster: largest first, then first listed
+    first = np.ones(len(order), dtype=np.bool_)
+    first[1:] = labels[order][1:] != labels[order][:-1]
+    keep = np.sort(order[first])
+
+    with open(opt.out, 'w') as f:
+        for i in keep:
+            f.write(dataset.img_names[i] + '\n')
+    print('Kept {} of {} images ({} near duplicates removed)'.format(len(keep), len(dataset), len(dataset) - len(keep)))
@@ -0,0 +1,145 @@
+# %% libraries
+import argparse
+import hashlib
+import os
+
+import numpy as np
+
+
+# %% constants
+INDEX_MAGIC = b'DHFLIST1'
+"""First 8 bytes of every prebuilt file list index"""
+
+
+# %% classes
+class FileList(object):
+    def __init__(self, names, offsets):
+        """
+        A compact, read-only list of image names stored as one contiguous bytes buffer plus an int64 offsets array.
+
+        Name ``i`` is ``names[offsets[i]:offsets[i + 1]]`` decoded as UTF-8. Both arrays are single numpy objects, so
+        forked DataLoader workers never touch per-name reference counts and the pages stay shared (no copy-on-write).
+
+        :param names: uint8 numpy array (or memmap) of concatenated names
+        :param offsets: int64 numpy array (or memmap) of size ``len(self) + 1``
+        """
+
+        self.names = names
+        self.offsets = offsets
+
+    @classmethod
+    def from_txt(cls, txt_path):
+        """
+        Build a file list from a text file containing one image per line. Only the first space separated token of
+        each line is kept, so Places365 style ``name label`` lines are supported.
+
+        :param txt_path: path to the text file
+        :return: A FileList object
+        """
+
+        with open(txt_path, 'rb') as f:
+            tokens = [line.split(b' ', 1)[0].strip() for line in f]
+        return cls.from_names(tokens)
+
+    @classmethod
+    def from_names(cls, names):
+        """
+        Build a file list from an iterable of names.
+
+        :param names: iterable of str or bytes; empty names are skipped
+        :return: A FileList object
+        """
+
+        tokens = [n.encode('utf-8') if isinstance(n, str) else n for n in names]
+        tokens = [t for t in tokens if len(t) > 0]
+
+        offsets = np.zeros(len(tokens) + 1, dtype=np.int64)
+        np.cumsum([len(t) for t in tokens], out=offsets[1:])
+        names = np.frombuffer(b''.join(tokens), dtype=np.uint8)
+        return cls(names, offsets)
+
+    @classmethod
+    def load(cls, index_path):
+        """
+        Memory-map a prebuilt index written by :meth:`save`. Nothing is read until a name is accessed, so opening
+        an index of millions of names is near-instant.
+
+        :param index_path: path to the index file
+        :return: A FileList object backed by the mapped file
+        """
+
+        raw = np.memmap(index_path, dtype=np.uint8, mode='r')
+        if raw[:8].tobytes() != INDEX_MAGIC:
+            raise ValueError('{} is not a file list index'.format(index_path))
+        n = int(raw[8:16].view(np.int64)[0])
+        names_start = 16 + 8 * (n + 1)
+        offsets = raw[16:names_start].view(np.int64)
+        names = raw[names_start:]
+        return cls(names, offsets)
+
+    @classmethod
+    def open(cls, path):
+        """
+        Open a file list from either a prebuilt index (``.idx``) or a plain text file.
+
+        :param path: path to ``.idx`` index or text file
+        :return: A FileList object
+        """
+
+        if path.endswith('.idx'):
+            return cls.load(path)
+        return cls.from_txt(path)
+
+    def save(self, index_path):
+        """
+        Write the list as a single file: magic, count, offsets and the names buffer, in this order.
+
+        :param index_path: path of the output index file
+        :return: None
+        """
+
+        with open(index_path, 'wb') as f:
+            f.write(INDEX_MAGIC)
+            np.array([len(self)], dtype=np.int64).tofile(f)
+            np.asarray(self.offsets, dtype=np.int64).tofile(f)
+            np.asarray(self.names, dtype=np.uint8).tofile(f)
+
+    def digest(self):
+        """
+        Return a hex digest identifying the content and order of the list, used as a key for cached results.
+
+        :return: sha1 hex string
+        """
+
+        h = hashlib.sha1()
+        h.update(np.ascontiguousarray(self.offsets, dtype=np.int64).tobytes())
+        h.update(np.ascontiguousarray(self.names, dtype=np.uint8).tobytes())
+        return h.hexdigest()
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, index):
+        index = int(index)
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError('file list index out of range')
+        return self.names[self.offsets[index]:self.offsets[index + 1]].tobytes().decode('utf-8')
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+
+# %% build index
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Prebuild a memory-mappable index of a file list')
+    parser.add_argument('txt', help='text file containing names of images line by line')
+    parser.add_argument('--out', default=None, help='output index path (default: <txt>.idx)')
+    opt = parser.parse_args()
+
+    out = opt.out if opt.out is not None else os.path.splitext(opt.txt)[0] + '.idx'
+    file_list = FileList.from_txt(opt.txt)
+    file_list.save(out)
+    print('Wrote {} names to {}'.format(len(file_list), out))
@@ -1,18 +1,122 @@
 # %% libraries
+import contextlib
+import functools
+
 import torch.nn as nn
+import torch.nn.functional as F
 import torch
 from models.vgg import vgg16_bn, vgg19_bn
 import numpy as np
 
 
+# %% mixed precision
+def autocast(device_type='cpu', enabled=True, dtype=torch.bfloat16):
+    """
+    Return ``torch.autocast`` context, or a context doing nothing if disabled or not supported by this PyTorch
+
+    :param device_type: 'cpu' or 'cuda'
+    :param enabled: whether to autocast
+    :param dtype: lower precision type of autocast regions
+    :return: context manager
+    """
+
+    if not enabled or not hasattr(torch, 'autocast'):
+        return contextlib.suppress()
+    return torch.autocast(device_type=device_type, dtype=dtype)
+
+
+def float32(fn):
+    """
+    Decorator pinning a numerically sensitive function to float32: it runs outside autocast and its floating point
+    tensor arguments are cast to float32 (e.g. Gram matrix normalization, binary cross entropy).
+    """
+
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        tensors = [a for a in args if torch.is_tensor(a)]
+        args = [a.float() if torch.is_tensor(a) and a.is_floating_point() else a for a in args]
+        if len(tensors) == 0 or not hasattr(torch, 'autocast'):
+            return fn(*args, **kwargs)
+        with torch.autocast(device_type=tensors[0].device.type, enabled=False):
+            return fn(*args, **kwargs)
+    return wrapper
+
+
+def per_sample_mean(mat):
+    """
+    Return mean of each sample of a batch
+
+    :param mat: A tensor (batch_size, ...)
+    :return: A tensor (batch_size)
+    """
+
+    return mat.contiguous().view(mat.size(0), -1).mean(1)
+
+
+def freeze(net):
+    """
+    Stop gradients of parameters of a fixed feature extractor; gradients still flow through it to its input
+
+    :param net: nn.Module object
+    :return: the same object in eval mode
+    """
+
+    for param in net.parameters():
+        param.requires_grad = False
+    return net.eval()
+
+
+class FeatureCache(object):
+    def __init__(self, persistent=False):
+        """
+        Target-side results of perceptual losses (Gram matrices of VGG feature maps) computed under ``no_grad``.
+        Without a key (as ``train_model`` calls the losses) nothing is stored and only the ``no_grad`` computation of
+        the target takes effect. A Gram matrix mixes all samples it is given, so a key has to name the whole batch,
+        e.g. a tuple of sample indices, and entries are only reused when the same batch of the same crops comes
+        again, as in a validation loader with fixed crops and order.
+
+        :param persistent: keep entries across ``clear`` (i.e. across steps and epochs), for validation sets with
+            fixed crops whose targets never change; otherwise ``clear`` at the end of each step drops them
+        """
+
+        self.persistent = persistent
+        self.entries = {}
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, fn):
+        """
+        Return cached value of ``key``, computing it by ``fn`` under ``no_grad`` if missing
+
+        :param key: hashable key, None computes without storing
+        :param fn: function without arguments returning the value
+        :return: the value
+        """
+
+        if key is not None and key in self.entries:
+            self.hits += 1
+            return self.entries[key]
+        self.misses += 1
+        with torch.no_grad():
+            value = fn()
+        if key is not None:
+            self.entries[key] = value
+        return value
+
+    def clear(self):
+        if not self.persistent:
+            self.entries.clear()
+
+
 class CoarseLoss(nn.Module):
-    def __init__(self, w1=50, w2=1, weight_vgg=None):
+    def __init__(self, w1=50, w2=1, weight_vgg=None, feature_cache=None):
         """
         A weighted sum of pixel-wise L1 loss and sum of L2 loss of Gram matrices.
 
         :param w1: weight of L1  (pixel-wise)
         :param w2: weight of L2 loss (Gram matrix)
         :param weight_vgg: weight of VGG extracted features (should be add up to 1.0)
+        :param feature_cache: FeatureCache object for Gram matrices of targets, may be shared with other losses
         """
         super(CoarseLoss, self).__init__()
         if weight_vgg is None:
@@ -24,10 +128,12 @@ class CoarseLoss(nn.Module):
         # https://github.com/PatWie/tensorflow-recipes/blob/33962bb45e81f3619bfa6a8aeae5556cc7534caf/EnhanceNet/enet_pat.py#L169
 
         self.weight_vgg = weight_vgg
-        self.vgg16_bn = vgg16_bn(pretrained=True).eval()
+        self.vgg16_bn = freeze(vgg16_bn(pretrained=True))
+        self.feature_cache = feature_cache if feature_cache is not None else FeatureCache()
 
     # reference: https://github.com/pytorch/tutorials/blob/master/advanced_source/neural_style_tutorial.py
     @staticmethod
+    @float32
     def gram_matrix(mat):
         """
         Return Gram matrix
@@ -41,14 +147,47 @@ class CoarseLoss(nn.Module):
         gram = torch.mm(features, features.t())
         return gram.div(a * b * c * d)
 
-    def forward(self, y, y_pred):
-        y_vgg = self.vgg16_bn(y)
-        y_pred_vgg = self.vgg16_bn(y_pred)
-        loss_vgg = [self.l2(self.gram_matrix(ly), self.gram_matrix(lp)) for ly, lp in zip(y_vgg, y_pred_vgg)]
+    def grams(self, mat, key=None):
+        """
+        Return Gram matrices of VGG-16 features of a target batch, computed once under ``no_grad`` and kept in
+        ``feature_cache``
+
+        :param mat: A tensor (batch_size, 3, height, width)
+        :param key: key of the target in ``feature_cache``, None to not store it
+        :return: list of Gram matrices
+        """
+
+        return self.feature_cache.get(None if key is None else ('coarse', key),
+                                      lambda: [self.gram_matrix(f) for f in self.vgg16_bn(mat)])
+
+    def forward(self, y, y_pred, key=None, target='y_pred'):
+        """
+        :param y: prediction (as called by ``train_model``)
+        :param y_pred: ground truth (as called by ``train_model``)
+        :param key: key of the ground truth in ``feature_cache``, None to not store it
+        :param target: name of the argument holding the ground truth, 'y_pred' or 'y'; only its Gram matrices are
+            cached, the other side is always computed (with gradients if enabled)
+        """
+
+        if target not in ('y', 'y_pred'):
+            raise ValueError("target should be 'y' or 'y_pred', but got {}".format(target))
+        truth, prediction = (y_pred, y) if target == 'y_pred' else (y, y_pred)
+        prediction_grams = [self.gram_matrix(f) for f in self.vgg16_bn(prediction)]
+        loss_vgg = [self.l2(gp, gt) for gp, gt in zip(prediction_grams, self.grams(truth, key))]
 
         loss = self.w1 * self.l1(y, y_pred) + self.w2 * np.dot(loss_vgg, self.weight_vgg)
         return loss
 
+    def per_sample(self, y, y_pred):
+        """
+        Return weighted pixel-wise L1 loss of each sample. Gram matrices mix all samples of a batch, so they are left
+        out.
+
+        :return: A tensor (batch_size)
+        """
+
+        return self.w1 * per_sample_mean((y - y_pred).abs())
+
 
 class EdgeLoss(nn.Module):
     def __init__(self):
@@ -58,13 +197,24 @@ class EdgeLoss(nn.Module):
         super(EdgeLoss, self).__init__()
         self.cross_entropy = nn.BCELoss(reduction='mean')
 
+    @float32
     def forward(self, y, y_pred):
         loss = self.cross_entropy(y, y_pred)
         return loss
 
+    @float32
+    def per_sample(self, y, y_pred):
+        """
+        Return binary cross entropy of each sample
+
+        :return: A tensor (batch_size)
+        """
+
+        return per_sample_mean(F.binary_cross_entropy(y, y_pred, reduction='none'))
+
 
 class DetailsLoss(nn.Module):
-    def __init__(self, w1=100, w2=0.1, w3=0.5, w4=1):
+    def __init__(self, w1=100, w2=0.1, w3=0.5, w4=1, feature_cache=None):
         """
 
         Return weighted sum of CoarseNet, EdgeNet, DetailsNet and Adversarial losses averaged over
@@ -74,6 +224,7 @@ class DetailsLoss(nn.Module):
         :param w2: Weight of EdgeNet loss
         :param w3: Weight of Local Patch loss
         :param w4: Weight of Adversarial loss
+        :param feature_cache: FeatureCache object for Gram matrices of targets, may be shared with other losses
         """
 
         super(DetailsLoss, self).__init__()
@@ -84,10 +235,12 @@ class DetailsLoss(nn.Module):
         self.l1_loss = nn.L1Loss(reduction='mean')
         self.MSE_loss = nn.MSELoss(reduction='mean')
         self.BCE_loss = nn.BCELoss(reduction='mean')
-        self.vgg19_bn = vgg19_bn(pretrained=True).eval()
+        self.vgg19_bn = freeze(vgg19_bn(pretrained=True))
+        self.feature_cache = feature_cache if feature_cache is not None else FeatureCache()
 
     # reference: https://github.com/pytorch/tutorials/blob/master/advanced_source/neural_style_tutorial.py
     @staticmethod
+    @float32
     def gram_matrix(mat):
         """
         Return Gram matrix
@@ -118,25 +271,65 @@ class DetailsLoss(nn.Module):
         patches = patches.contiguous().view((batch_size, channel_size, -1, size, stride))
         return patches
 
-    def forward(self, y, y_pred):
+    def patch_grams(self, mat):
+        """
+        Return Gram matrices of patches of VGG-19 features of a batch
+
+        :param mat: A tensor (batch_size, 3, height, width)
+        :return: list of Gram matrices
+        """
+
+        return [self.gram_matrix(self.get_patch(f)) for f in self.vgg19_bn(mat)]
+
+    def forward(self, y, y_pred, key=None):
         """
 
         :param y: Ground truth tensor which is the concatenation of (x, coarse, object, edge)
         :param y_pred: Estimated prediction which is a dictionary of (details_outputs, details_edges)
+        :param key: key of the target ``x`` in ``feature_cache``, None to not store it
         :return: A scalar number
         """
 
         x, coarse_outputs, object_outputs, edge_outputs = y.split((3, 3, 25, 1), dim=1)
         details_outputs, details_edges, y_e = y_pred['d_o'], y_pred['d_e'], y_pred['y_e']
 
-        y_vgg = self.vgg19_bn(x)
-        details_outputs_vgg = self.vgg19_bn(details_outputs)
+        # the target needs no gradients: its Gram matrices are computed once without building a graph
+        y_grams = self.feature_cache.get(None if key is None else ('details', key), lambda: self.patch_grams(x))
         coarse_loss = self.l1_loss(x, details_outputs)
-        edge_loss = self.BCE_loss(y_e, details_edges)
-        patch_loss = np.sum(
-            [self.MSE_loss(self.gram_matrix(self.get_patch(ly)), self.gram_matrix(self.get_patch(lp)))
-             for ly, lp in zip(y_vgg, details_outputs_vgg)])
+        edge_loss = float32(self.BCE_loss)(y_e, details_edges)
+        patch_loss = np.sum([self.MSE_loss(gy, gp) for gy, gp in zip(y_grams, self.patch_grams(details_outputs))])
         adversarial_loss = self.MSE_loss(x, details_outputs)
 
         loss = self.w1 * coarse_loss + self.w2 * edge_loss + self.w3 * patch_loss + self.w4 * adversarial_loss
         return loss
+
+    def per_sample(self, y, y_pred):
+        """
+        Return weighted sum of pixel-wise losses of each sample. Gram matrices of patches mix all samples of a batch,
+        so they are left out.
+
+        :param y: Ground truth tensor which is the concatenation of (x, coarse, object, edge)
+        :param y_pred: Estimated prediction which is a dictionary of (details_outputs, details_edges)
+        :return: A tensor (batch_size)
+        """
+
+        x = y[:, :3]
+        details_outputs, details_edges, y_e = y_pred['d_o'], y_pred['d_e'], y_pred['y_e']
+        coarse_loss = per_sample_mean((x - details_outputs).abs())
+        edge_loss = per_sample_mean(float32(F.binary_cross_entropy)(y_e, details_edges, reduction='none'))
+        adversarial_loss = per_sample_mean((x - details_outputs) ** 2)
+        return self.w1 * coarse_loss + self.w2 * edge_loss + self.w4 * adversarial_loss
+
+
+class AdversarialLoss(nn.Module):
+    def __init__(self):
+        """
+        Return binary cross entropy of discriminator logits against real (1) or fake (0) targets, in float32
+        """
+        super(AdversarialLoss, self).__init__()
+        self.cross_entropy = nn.BCEWithLogitsLoss(reduction='mean')
+
+    @float32
+    def forward(self, y_pred, y):
+        loss = self.cross_entropy(y_pred, y)
+        return loss
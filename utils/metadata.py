@@ -0,0 +1,191 @@
+# %% libraries
+import argparse
+import io
+import multiprocessing
+import os
+import tarfile
+
+import numpy as np
+from PIL import Image
+
+from utils.filelist import FileList
+
+
+# %% constants
+MODES = ['1', 'L', 'LA', 'P', 'RGB', 'RGBA', 'CMYK', 'YCbCr', 'LAB', 'HSV', 'I', 'F', 'I;16']
+"""PIL modes, stored in the sidecar as their index in this list (``MODE_UNKNOWN`` otherwise)"""
+MODE_UNKNOWN = 255
+
+FLAG_CORRUPT = 1
+"""Image could not be opened or decoded"""
+FLAG_UNDERSIZED = 2
+"""Shorter side of image is smaller than ``min_size`` of the scan"""
+
+COLUMNS = ('width', 'height', 'mode', 'grayscale', 'file_size', 'tar_offset', 'flags')
+
+
+# %% functions
+def probe_image(fp, min_size=224, probe_size=64, tolerance=2):
+    """
+    Read header of an image plus a cheap low resolution decode to decide whether it is grayscale.
+
+    For JPEG, ``draft`` lets the decoder scale down in the DCT domain, so the probe costs a fraction of a full
+    decode but still walks the whole stream, which catches truncated files.
+
+    :param fp: file path or file object of the image
+    :param min_size: images with a shorter side smaller than this value are flagged as undersized
+    :param probe_size: approximate resolution of the grayscale probe
+    :param tolerance: maximum absolute difference between color channels of a grayscale image (JPEG noise)
+    :return: A tuple of (width, height, mode, grayscale, flags)
+    """
+
+    try:
+        image = Image.open(fp)
+        width, height = image.size
+        mode = MODES.index(image.mode) if image.mode in MODES else MODE_UNKNOWN
+        image.draft('RGB', (probe_size, probe_size))
+        image = image.convert('RGB')
+        image.thumbnail((probe_size, probe_size))
+        pixels = np.asarray(image, dtype=np.int16)
+        grayscale = bool(np.abs(pixels[..., 0] - pixels[..., 1]).max() <= tolerance and
+                         np.abs(pixels[..., 1] - pixels[..., 2]).max() <= tolerance)
+    except Exception:
+        return 0, 0, MODE_UNKNOWN, False, FLAG_CORRUPT
+
+    flags = FLAG_UNDERSIZED if min(width, height) < min_size else 0
+    return width, height, mode, grayscale, flags
+
+
+def load_metadata(path, file_list=None):
+    """
+    Load a sidecar written by ``scan``.
+
+    :param path: path to the ``.npz`` sidecar
+    :param file_list: if given, a FileList object the sidecar must have been built from
+    :return: A dict of numpy arrays, one entry per column in ``COLUMNS``
+    """
+
+    with np.load(path) as data:
+        if file_list is not None and str(data['digest']) != file_list.digest():
+            raise ValueError('metadata {} was not built from this file list'.format(path))
+        return {column: data[column] for column in COLUMNS}
+
+
+_scan_source = None
+"""A tuple of (img_dir, tar file descriptor or None) of a scan worker process"""
+
+
+def _init_scan_worker(img_dir, is_tar):
+    global _scan_source
+    _scan_source = (img_dir, os.open(img_dir, os.O_RDONLY) if is_tar else None)
+
+
+def _scan_chunk(task):
+    """
+    Probe a chunk of images of the worker's source.
+
+    :param task: A tuple of (names, tar offsets, file sizes, min_size); offsets and sizes are None for folders
+    :return: A dict of lists, one per column in ``COLUMNS``
+    """
+
+    names, offsets, sizes, min_size = task
+    img_dir, fd = _scan_source
+    out = {column: [] for column in COLUMNS}
+    for i, name in enumerate(names):
+        if fd is not None:
+            if offsets[i] < 0:
+                fp, file_size, offset = None, 0, -1
+            else:
+                file_size, offset = int(sizes[i]), int(offsets[i])
+                fp = io.BytesIO(os.pread(fd, file_size, offset))
+        else:
+            fp, offset = os.path.join(img_dir, name), -1
+            file_size = os.path.getsize(fp) if os.path.isfile(fp) else 0
+
+        if fp is None:  # listed but missing in the tar archive
+            width, height, mode, grayscale, flags = 0, 0, MODE_UNKNOWN, False, FLAG_CORRUPT
+        else:
+            width, height, mode, grayscale, flags = probe_image(fp, min_size=min_size)
+        for column, value in zip(COLUMNS, (width, height, mode, grayscale, file_size, offset, flags)):
+            out[column].append(value)
+    return out
+
+
+def scan(img_dir, file_list=None, num_workers=4, chunk_size=256, min_size=224):
+    """
+    Scan all images of a PlacesDataset source (folder or uncompressed tar) with a process pool.
+
+    :param img_dir: path to image folder or uncompressed tar archive
+    :param file_list: FileList object of names to scan; for tar archives all regular members are used if None
+    :param num_workers: number of processes
+    :param chunk_size: number of images per task sent to a worker
+    :param min_size: images with a shorter side smaller than this value are flagged as undersized
+    :return: A tuple of (FileList object, dict of numpy arrays)
+    """
+
+    is_tar = img_dir.__contains__('tar')
+    offsets = sizes = None
+    if is_tar:
+        members = {}
+        with tarfile.open(img_dir) as tf:
+            for member in tf:
+                if member.isfile():
+                    members[member.name] = (member.offset_data, member.size)
+                tf.members = []  # stream headers without keeping millions of TarInfo objects
+        if file_list is None:
+            names = sorted(members, key=lambda n: members[n][0])
+            file_list = FileList.from_names(names)
+        offsets = np.full(len(file_list), -1, dtype=np.int64)
+        sizes = np.zeros(len(file_list), dtype=np.int64)
+        for i, name in enumerate(file_list):
+            offsets[i], sizes[i] = members.get(name, (-1, 0))
+        del members
+    elif file_list is None:
+        raise ValueError('a file list is required to scan a folder')
+
+    tasks = []
+    for start in range(0, len(file_list), chunk_size):
+        end = min(start + chunk_size, len(file_list))
+        tasks.append(([file_list[i] for i in range(start, end)],
+                      None if offsets is None else offsets[start:end],
+                      None if sizes is None else sizes[start:end],
+                      min_size))
+
+    chunks = []
+    with multiprocessing.Pool(num_workers, initializer=_init_scan_worker, initargs=(img_dir, is_tar)) as pool:
+        for chunk in pool.imap(_scan_chunk, tasks):
+            chunks.append(chunk)
+
+    dtypes = {'width': np.int32, 'height': np.int32, 'mode': np.uint8, 'grayscale': np.bool_,
+              'file_size': np.int64, 'tar_offset': np.int64, 'flags': np.uint8}
+    metadata = {column: np.array([v for chunk in chunks for v in chunk[column]], dtype=dtypes[column])
+                for column in COLUMNS}
+    return file_list, metadata
+
+
+# %% command line tool
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Index sizes, modes and offsets of a PlacesDataset source')
+    parser.add_argument('img', help='image folder or uncompressed tar archive')
+    parser.add_argument('--txt', default=None, help='file list (text or .idx); optional for tar archives')
+    parser.add_argument('--out', required=True, help='output .npz sidecar')
+    parser.add_argument('--nw', type=int, default=4, help='number of worker processes')
+    parser.add_argument('--min_size', type=int, default=224, help='flag images with a smaller shorter side')
+    parser.add_argument('--clean', default=None, help='also write a file list without flagged images')
+    opt = parser.parse_args()
+
+    names = FileList.open(opt.txt) if opt.txt is not None else None
+    names, meta = scan(opt.img, names, num_workers=opt.nw, min_size=opt.min_size)
+    np.savez(opt.out, digest=names.digest(), **meta)
+    if opt.txt is None:
+        names.save(os.path.splitext(opt.out)[0] + '.idx')
+
+    corrupt = int(np.count_nonzero(meta['flags'] & FLAG_CORRUPT))
+    undersized = int(np.count_nonzero(meta['flags'] & FLAG_UNDERSIZED))
+    print('Scanned {} images: {} corrupt, {} undersized, {} grayscale'.format(
+        len(names), corrupt, undersized, int(np.count_nonzero(meta['grayscale']))))
+
+    if opt.clean is not None:
+        with open(opt.clean, 'w') as f:
+            for i in np.flatnonzero(meta['flags'] == 0):
+                f.write(names[i] + '\n')
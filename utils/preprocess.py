@@ -1,44 +1,91 @@
 from __future__ import print_function, division
 from PIL import Image
-from torchvision.transforms import ToTensor, ToPILImage, Compose, Normalize
+from torchvision.transforms import ToTensor, ToPILImage, Compose, Normalize, RandomResizedCrop, RandomRotation, \
+    RandomHorizontalFlip
+import torchvision.transforms.functional as TF
 import random
+import copy
+import math
 
 import numpy as np
 import tarfile
 import io
 import os
-import pandas as pd
+import json
+import hashlib
+import multiprocessing
 from skimage import feature
 
 from torch.utils.data import Dataset
 import torch
 
 from utils.halftone import generate_halftone
+from utils.filelist import FileList
+from utils.metadata import load_metadata
+from lib.utils.data import profiler
 
 
 # %% classes
 class PlacesDataset(Dataset):
-    def __init__(self, txt_path='dataset/sub_test/filelist.txt', img_dir='dataset/sub_test/data', transform=None, test=False):
+    def __init__(self, txt_path='dataset/sub_test/filelist.txt', img_dir='dataset/sub_test/data', transform=None, test=False,
+                 meta_path=None, crops=1, seg_dir=None):
         """
         Initialize data set as a list of IDs corresponding to each item of data set
         :param img_dir: path to image files as a uncompressed tar archive
-        :param txt_path: a text file containing names of all of images line by line
+        :param txt_path: a text file containing names of all of images line by line, or its prebuilt ``.idx`` index
+        (see ``utils/filelist.py``) which is memory-mapped instead of parsed
         :param transform: apply some transforms like cropping, rotating, etc on input image
         :param test: is inference time or not
+        :param meta_path: optional ``.npz`` sidecar of ``utils/metadata.py`` built from the same file list. For tar
+        archives, images are then read directly at their stored offsets instead of through ``tarfile``
+        :param crops: number of independently transformed crops per decoded and halftoned image. With ``crops > 1``
+        tensors of a sample are stacked to (crops, ...); flatten and mix batches with ``MultiCropBuffer``
+        :param seg_dir: folder of ObjectNet segmentations built by ``utils/segcache.py``. Each sample then also holds
+        the cached map under 'y_object', cropped, rotated and flipped like the ground truth (see ``augment``)
         :return a 3-value dict containing input image (y_descreen) as ground truth, input image X as halftone
         image and edge-map (y_edge) of ground truth image to feed into the network.
         """
 
-        df = pd.read_csv(txt_path, sep=' ', index_col=0)
-        self.img_names = df.index.values
+        self.img_names = FileList.open(txt_path)
         self.txt_path = txt_path
         self.img_dir = img_dir
         self.transform = transform
+        self.test = test
+        self.crops = crops
+        self.seg_dir = seg_dir
         self.to_tensor = ToTensor()
         self.to_pil = ToPILImage()
         self.get_image_selector = True if img_dir.__contains__('tar') else False
-        self.tf = tarfile.open(self.img_dir) if self.get_image_selector else None
+        self.meta = load_metadata(meta_path, self.img_names) if meta_path is not None else None
+        self.use_offsets = self.get_image_selector and self.meta is not None
+        self.tf = tarfile.open(self.img_dir) if self.get_image_selector and not self.use_offsets else None
+        self.fd = None
+        self.fd_pid = None
+        self.tf_pid = None
         self.transform_gt = transform if test else Compose(self.transform.transforms[:-1])  # omit noise of ground truth
+        self.transform_seg = label_transform(transform) if seg_dir is not None and not test else None
+
+    def set_transform(self, transform):
+        """
+        Replace transforms of input and ground truth images without re-reading the file list or metadata
+
+        :param transform: new transforms of input image, same convention as ``transform`` of constructor
+        :return: None
+        """
+
+        self.transform = transform
+        self.transform_gt = transform if self.test else Compose(self.transform.transforms[:-1])
+        self.transform_seg = label_transform(transform) if self.seg_dir is not None and not self.test else None
+
+    def get_segmentation(self, index):
+        """
+        Gets the cached ObjectNet segmentation of an image
+
+        :param index: index of item in IDs list
+        :return: a PIL image of mode 'L', 0 where no class is known and class + 1 elsewhere
+        """
+
+        return Image.open(segmentation_path(self.seg_dir, self.img_names[index]))
 
     def get_image_from_tar(self, name):
         """
@@ -52,6 +99,28 @@ class PlacesDataset(Dataset):
         image = Image.open(io.BytesIO(image))
         return image
 
+    def get_image_from_offset(self, index):
+        """
+        Gets a image of the tar archive by its offset stored in metadata. ``pread`` does not move a shared file
+        position, so it is safe in forked workers; each process opens its own descriptor. Images without an offset
+        (-1, e.g. metadata scanned from a folder) are read through ``tarfile``, opened on first use in each process.
+
+        :param index: index of targeted image
+        :return: a PIL image
+        """
+        offset = int(self.meta['tar_offset'][index])
+        if offset < 0:
+            if self.tf is None or self.tf.closed or self.tf_pid != os.getpid():
+                self.tf = tarfile.open(self.img_dir)
+                self.tf_pid = os.getpid()
+            return self.get_image_from_tar(self.img_names[index])
+        if self.fd_pid != os.getpid():
+            self.fd = os.open(self.img_dir, os.O_RDONLY)
+            self.fd_pid = os.getpid()
+        image = os.pread(self.fd, int(self.meta['file_size'][index]), offset)
+        image = Image.open(io.BytesIO(image))
+        return image
+
     def get_image_from_folder(self, name):
         """
         gets a image by a name gathered from file list text file
@@ -63,6 +132,32 @@ class PlacesDataset(Dataset):
         image = Image.open(os.path.join(self.img_dir, name))
         return image
 
+    def get_image(self, index):
+        """
+        Gets a image by its index from whichever source the data set was built on
+
+        :param index: index of item in IDs list
+        :return: a PIL image
+        """
+
+        if self.use_offsets:
+            return self.get_image_from_offset(index)
+        elif self.get_image_selector:  # note: we prefer to extract then process!
+            return self.get_image_from_tar(self.img_names[index])
+        else:
+            return self.get_image_from_folder(self.img_names[index])
+
+    def get_image_sizes(self):
+        """
+        Returns (width, height) of all images, from metadata if available, otherwise by reading image headers only.
+
+        :return: A numpy array of size (number of images, 2)
+        """
+
+        if self.meta is not None:
+            return np.stack((self.meta['width'], self.meta['height']), axis=1)
+        return np.array([self.get_image(i).size for i in range(len(self))], dtype=np.int32)
+
     def canny_edge_detector(self, image):
         """
         Returns a binary image with same size of source image which each pixel determines belonging to an edge or not.
@@ -99,39 +194,188 @@ class PlacesDataset(Dataset):
         """
 
         # close tarfile opened in __init__
-        if index == (self.__len__() - 1) and self.get_image_selector:
+        if index == (self.__len__() - 1) and self.tf is not None:
             self.tf.close()
 
-        if self.get_image_selector:  # note: we prefer to extract then process!
-            y_descreen = self.get_image_from_tar(self.img_names[index])
-        else:
-            y_descreen = self.get_image_from_folder(self.img_names[index])
+        with profiler.stage('read') as stage:
+            y_descreen = self.get_image(index)
+            stage.nbytes = int(self.meta['file_size'][index]) if self.meta is not None else 0
+        with profiler.stage('decode') as stage:
+            y_descreen.load()
+            stage.nbytes = profiler.nbytes(y_descreen)
+        y_object = self.get_segmentation(index) if self.transform_seg is not None else None
+        sample = self.make_sample(y_descreen, y_object)
+        sample['index'] = int(index)  # lets the training loop report per-sample losses back to the sampler
+        return sample
+
+    def make_sample(self, y_descreen, y_object=None, rng=None):
+        """
+        Generate a sample from a ground truth image: halftone it, apply the same random transforms to both and
+        extract the edge-map of the transformed ground truth. The halftone is computed once for all ``crops``.
+
+        :param y_descreen: PIL image
+        :param y_object: optional cached segmentation of ``y_descreen``, transformed alike
+        :param rng: np.random.RandomState drawing the transforms, e.g. one per thread (default: global ``np.random``)
+        :return: a sample of data as a dict
+        """
 
         # generate halftone image
-        x = generate_halftone(y_descreen)
+        with profiler.stage('halftone') as stage:
+            x = generate_halftone(y_descreen)
+            stage.nbytes = profiler.nbytes(x)
+
+        if self.crops == 1:
+            return self.augment(x, y_descreen, y_object, rng)
+        samples = [self.augment(x, y_descreen, y_object, rng) for _ in range(self.crops)]
+        return {key: torch.stack([sample[key] for sample in samples]) for key in samples[0]}
+
+    def augment(self, x, y_descreen, y_object=None, rng=None):
+        """
+        Apply the same random transforms to a halftone image and its ground truth and extract the edge-map of the
+        transformed ground truth.
+
+        :param x: halftone PIL image
+        :param y_descreen: ground truth PIL image
+        :param y_object: optional segmentation of ground truth as PIL image; replayed with nearest neighbor
+        interpolation and returned as a uint8 tensor (H, W) under 'y_object'
+        :param rng: np.random.RandomState drawing the seed of the transforms (default: global ``np.random``)
+        :return: a sample of data as a dict
+        """
 
         # https://github.com/pytorch/vision/issues/9#issuecomment-304224800
-        # Solution to apply same transforms for input and target images
+        # Solution to apply same transforms for input and target images: replay them from generators of one seed.
+        # The global random module is left alone, so threads (see utils/streaming.py) can augment concurrently.
 
-        seed = np.random.randint(2147483647)
-        random.seed(seed)
+        seed = (rng if rng is not None else np.random).randint(2147483647)
 
         if self.transform is not None:
-            x = self.transform(x)
-            random.seed(seed)
-            y_descreen = self.transform_gt(y_descreen)
+            with profiler.stage('transform') as stage:
+                x = replay(self.transform, x, random.Random(seed))
+                y_descreen = replay(self.transform_gt, y_descreen, random.Random(seed))
+                stage.nbytes = profiler.nbytes(x) + profiler.nbytes(y_descreen)
+                if y_object is not None:
+                    y_object = replay(self.transform_seg, y_object, random.Random(seed))
 
         # generate edge-map
-        y_edge = self.canny_edge_detector(y_descreen)
-        y_edge = self.to_tensor(y_edge)
+        with profiler.stage('edge') as stage:
+            y_edge = self.canny_edge_detector(y_descreen)
+            y_edge = self.to_tensor(y_edge)
+            stage.nbytes = profiler.nbytes(y_edge)
 
         sample = {'x': x,
                   'y_descreen': y_descreen,
                   'y_edge': y_edge}
+        if y_object is not None:
+            sample['y_object'] = y_object
 
         return sample
 
 
+class LabelToTensor(object):
+    """
+    Convert a label map (PIL image of mode 'L') to a uint8 tensor of shape (H, W) without scaling
+    """
+
+    def __call__(self, label):
+        return torch.from_numpy(np.array(label, dtype=np.uint8, copy=True))
+
+
+def label_transform(transform):
+    """
+    Build the transforms of a label map matching ``transform`` of images: transforms of PIL images (crop, rotation,
+    flip, ...) are kept with nearest neighbor interpolation, so classes are never blended; ``ToTensor`` keeps label
+    values and transforms of tensors after it (``Normalize``, ``RandomNoise``) are dropped. Random parameters are
+    drawn in the same order, so ``replay`` from the same seed gives the crop, rotation and flip of the image.
+
+    :param transform: Compose object of image transforms
+    :return: Compose object
+    """
+
+    transforms = []
+    for t in transform.transforms:
+        if isinstance(t, ToTensor):
+            transforms.append(LabelToTensor())
+            break
+        t = copy.copy(t)
+        if hasattr(t, 'interpolation'):
+            t.interpolation = Image.NEAREST
+        if hasattr(t, 'resample'):
+            t.resample = False  # nearest; corners rotated in are 0, i.e. no class
+        transforms.append(t)
+    return Compose(transforms)
+
+
+def _resized_crop_params(image, scale, ratio, rng):
+    """
+    ``RandomResizedCrop.get_params`` drawing from ``rng``
+
+    :return: (top, left, height, width) of the crop
+    """
+
+    width, height = image.size
+    area = height * width
+    for _ in range(10):
+        target_area = area * rng.uniform(*scale)
+        aspect_ratio = math.exp(rng.uniform(math.log(ratio[0]), math.log(ratio[1])))
+        w = int(round(math.sqrt(target_area * aspect_ratio)))
+        h = int(round(math.sqrt(target_area / aspect_ratio)))
+        if 0 < w <= width and 0 < h <= height:
+            return rng.randint(0, height - h), rng.randint(0, width - w), h, w
+
+    # fallback to central crop
+    in_ratio = width / height
+    if in_ratio < min(ratio):
+        w, h = width, int(round(width / min(ratio)))
+    elif in_ratio > max(ratio):
+        w, h = int(round(height * max(ratio))), height
+    else:
+        w, h = width, height
+    return (height - h) // 2, (width - w) // 2, h, w
+
+
+def replay(transform, image, rng):
+    """
+    Apply transforms drawing their random parameters from ``rng`` instead of the global ``random``, so images replayed
+    with generators of the same seed get the same crop, rotation and flip whatever other threads draw meanwhile.
+    RandomResizedCrop, RandomRotation, RandomHorizontalFlip and RandomNoise are replayed; other transforms are
+    applied as they are and must not be random.
+
+    :param transform: Compose object or a single transform
+    :param image: PIL image
+    :param rng: random.Random object
+    :return: transformed image
+    """
+
+    for t in transform.transforms if isinstance(transform, Compose) else [transform]:
+        if isinstance(t, RandomResizedCrop):
+            top, left, height, width = _resized_crop_params(image, t.scale, t.ratio, rng)
+            image = TF.resized_crop(image, top, left, height, width, t.size, t.interpolation)
+        elif isinstance(t, RandomRotation):
+            angle = rng.uniform(t.degrees[0], t.degrees[1])
+            image = TF.rotate(image, angle, getattr(t, 'resample', getattr(t, 'interpolation', False)), t.expand,
+                              t.center)
+        elif isinstance(t, RandomHorizontalFlip):
+            if rng.random() < t.p:
+                image = TF.hflip(image)
+        elif isinstance(t, RandomNoise):
+            image = t(image, rng)
+        else:
+            image = t(image)
+    return image
+
+
+def segmentation_path(seg_dir, name):
+    """
+    Return path of the cached segmentation of an image
+
+    :param seg_dir: root folder of the cache
+    :param name: name of image in the file list, e.g. 'a/abbey/00000001.jpg'
+    :return: path of a PNG file
+    """
+
+    return os.path.join(seg_dir, os.path.splitext(name)[0] + '.png')
+
+
 class RandomNoise(object):
     def __init__(self, p, mean=0, std=0.1):
         """
@@ -145,8 +389,8 @@ class RandomNoise(object):
         self.mean = mean
         self.std = std
 
-    def __call__(self, img):
-        if random.random() <= self.p:
+    def __call__(self, img, rng=random):
+        if rng.random() <= self.p:
             noise = torch.empty(*img.size(), dtype=torch.float, requires_grad=False)
             return img+noise.normal_(self.mean, self.std)
         return img
@@ -221,63 +465,299 @@ class UnNormalizeNative(object):
         return Normalize((-self.mean / self.std).tolist(), (1.0 / self.std).tolist())(tensor)
 
 
+class MultiCropBuffer:
+    def __init__(self, batches, batch_size=None, buffer_batches=4, seed=None):
+        """
+        Flatten batches of multi-crop samples (``PlacesDataset(crops=K)``) and shuffle crops across a few batches, so
+        crops of one image are spread over different optimization steps instead of landing in the same batch.
+
+        Tensors of shape (B, K, ...) are flattened to (B * K, ...); tensors of shape (B) (e.g. 'index') are repeated
+        for each crop.
+
+        :param batches: iterable of batches, e.g. a DataLoader
+        :param batch_size: size of output batches (default: B * K of the first batch of each crop size, so batches
+            follow the batch size of each phase of a ResolutionSchedule)
+        :param buffer_batches: number of output batches shuffled together; more mixes better but holds more memory
+        :param seed: seed of shuffling
+        """
+
+        self.batches = batches
+        self.batch_size = batch_size
+        self.buffer_batches = buffer_batches
+        self.seed = seed
+
+    @staticmethod
+    def flatten(batch, copy=False):
+        """
+        Flatten a batch of multi-crop samples to a batch of crops
+
+        :param batch: dict of tensors (B, K, ...) or (B)
+        :param copy: return tensors not sharing memory with ``batch``, e.g. to hold them while a DataLoader with
+            ``batch_slots`` refills the slot ``batch`` lives in
+        :return: dict of tensors (B * K, ...)
+        """
+
+        crops = next(v.size(1) for v in batch.values() if v.dim() > 1)
+        flat = {}
+        for key, value in batch.items():
+            if value.dim() == 1:
+                flat[key] = value.view(-1, 1).expand(value.size(0), crops).contiguous().view(-1)
+            else:
+                flat[key] = value.contiguous().view((-1,) + tuple(value.size()[2:]))
+                if copy:
+                    flat[key] = flat[key].clone()
+        return flat
+
+    def _drain(self, pending, g, batch_size, final):
+        merged = {key: torch.cat([p[key] for p in pending]) for key in pending[0]}
+        n = len(next(iter(merged.values())))
+        perm = torch.randperm(n, generator=g)
+        merged = {key: value[perm] for key, value in merged.items()}
+        stop = n if final else n - n % batch_size
+        out = [{key: value[i:i + batch_size] for key, value in merged.items()} for i in range(0, stop, batch_size)]
+        rest = [{key: value[stop:] for key, value in merged.items()}] if stop < n else []
+        return out, rest
+
+    def __iter__(self):
+        g = torch.Generator()
+        g.manual_seed(self.seed if self.seed is not None else int(torch.LongTensor(1).random_(0, 2 ** 31 - 1)[0]))
+        batch_size, shape = self.batch_size, None
+        pending, count = [], 0
+        for batch in self.batches:
+            flat = self.flatten(batch, copy=True)  # buffered across loader batches
+            if flat['x'].size()[1:] != shape:
+                # crops of another size (e.g. a new resolution phase) cannot be mixed with buffered ones
+                if len(pending) > 0:
+                    out, pending = self._drain(pending, g, batch_size, final=True)
+                    count = 0
+                    for b in out:
+                        yield b
+                shape = flat['x'].size()[1:]
+                if self.batch_size is None:
+                    batch_size = len(flat['x'])
+            pending.append(flat)
+            count += len(flat['x'])
+            if count >= self.buffer_batches * batch_size:
+                out, pending = self._drain(pending, g, batch_size, final=False)
+                count = sum(len(p['x']) for p in pending)
+                for b in out:
+                    yield b
+        if len(pending) > 0:
+            out, _ = self._drain(pending, g, batch_size, final=True)
+            for b in out:
+                yield b
+
+
+class ResolutionSchedule:
+    def __init__(self, phases, loader_fn, base_size=224, base_batch_size=128, unit='epoch'):
+        """
+        Progressive resolution training: crop size grows phase by phase while batch size shrinks with the number of
+        pixels, so memory use stays about the same as ``base_batch_size`` crops of ``base_size``.
+
+        :param phases: list of (start, crop size) tuples, e.g. [(0, 128), (4, 176), (8, 224), (12, 320)]
+        :param loader_fn: a function of (phase, sampler_state=None) returning the data loader of a phase. With
+        ``sampler_state`` it has to continue the interrupted pass of the sampler (``load_state_dict``)
+        :param base_size: crop size that ``base_batch_size`` fits in memory
+        :param base_batch_size: batch size at ``base_size``
+        :param unit: 'epoch' or 'step', unit of start of each phase
+        """
+
+        assert unit in ('epoch', 'step')
+        assert len(phases) > 0 and min(phases)[0] == 0, 'first phase must start at 0'
+        self.phases = sorted(phases)
+        self.loader_fn = loader_fn
+        self.base_size = base_size
+        self.base_batch_size = base_batch_size
+        self.unit = unit
+        self.step = 0
+        self.current = None
+        self.loader = None
+
+    def phase(self, epoch, step):
+        """
+        Return index of the phase active at given epoch and (global) step
+
+        :param epoch: current epoch
+        :param step: number of optimization steps taken so far
+        :return: index into ``phases``
+        """
+
+        t = epoch if self.unit == 'epoch' else step
+        return max(i for i, (start, _) in enumerate(self.phases) if start <= t)
+
+    def size(self, phase):
+        return self.phases[phase][1]
+
+    def batch_size(self, phase):
+        return max(1, int(self.base_batch_size * (self.base_size / self.size(phase)) ** 2))
+
+    def batches(self, epoch):
+        """
+        Yield batches of one epoch, rebuilding the loader whenever a new phase starts. In 'step' mode a phase may
+        start mid-epoch; the rest of the epoch then continues from the same sampler position at the new resolution.
+        A loader with ``in_order=False`` may have returned batches past that position; it is drained of the batches
+        still missing before them, which are returned at the old resolution first, so no sample is dropped or seen
+        twice and no new batch of the old phase is requested.
+
+        :param epoch: current epoch
+        :return: generator of batches
+        """
+
+        phase = self.phase(epoch, self.step)
+        if phase != self.current:
+            self.close()
+            self.current, self.loader = phase, self.loader_fn(phase)
+            print('Resolution phase {}: crop size {}, batch size {}'.format(phase, self.size(phase),
+                                                                            self.batch_size(phase)))
+
+        loader = self.loader
+        while loader is not None:
+            batches, next_loader = iter(loader), None
+            for data in batches:
+                self.step += 1
+                yield data
+                phase = self.phase(epoch, self.step)
+                if phase != self.current:
+                    state = batches.state_dict()
+                    if len(state.get('skip', ())) > 0:  # the new loader can only resume from a single position
+                        batches.drain()  # no new batches, only those still missing before the last one returned
+                    while len(state.get('skip', ())) > 0:
+                        data = next(batches, None)
+                        if data is None:
+                            break
+                        self.step += 1
+                        yield data
+                        state = batches.state_dict()
+                    state = state['batch_sampler']
+                    sampler_state = dict(state['sampler'], start=state['start'] * loader.batch_size)
+                    self.close()
+                    self.current = phase
+                    self.loader = next_loader = self.loader_fn(phase, sampler_state)
+                    print('Resolution phase {}: crop size {}, batch size {}'.format(phase, self.size(phase),
+                                                                                    self.batch_size(phase)))
+                    break
+            loader = next_loader
+
+    def close(self):
+        """
+        Shut down workers of the current loader, which ``persistent_workers`` keeps alive between epochs. Called
+        before a new phase builds its loader, and by the owner once training on the schedule is over.
+        """
+
+        if self.loader is not None and hasattr(self.loader, 'shutdown'):
+            self.loader.shutdown()
+        self.current, self.loader = None, None
+
+
 class OnlineMeanStd:
-    def __init__(self):
-        pass
+    def __init__(self, num_workers=4, chunk_size=256, cache_dir=None):
+        """
+        Calculate per-channel mean and std of a PlacesDataset over raw uint8 pixels in parallel.
+
+        Each worker accumulates per-channel sums and sums of squares in float64 over a chunk of images (from 256-bin
+        histograms, so they are exact) and returns the chunk as (count, mean, M2). Chunks are merged with Chan's
+        parallel formula, hence the result does not depend on the number of workers or chunk size.
 
-    def __call__(self, dataset, batch_size, method='strong'):
+        :param num_workers: number of processes reading images
+        :param chunk_size: number of images per task sent to a worker
+        :param cache_dir: if given, results are stored as json keyed by a hash of the file list and reused
         """
-        Calculate mean and std of a dataset in lazy mode (online)
-        On mode strong, batch size will be discarded because we use batch_size=1 to minimize leaps.
+        self.num_workers = num_workers
+        self.chunk_size = chunk_size
+        self.cache_dir = cache_dir
 
-        :param dataset: Dataset object corresponding to your dataset
-        :param batch_size: higher size, more accurate approximation
-        :param method: weak: fast but less accurate, strong: slow but very accurate - recommended = strong
+    def __call__(self, dataset):
+        """
+        Return statistics of ground truth images in ``dataset`` scaled to [0, 1] like ``ToTensor`` output, so they
+        can be passed to ``Normalize`` directly.
+
+        :param dataset: PlacesDataset object corresponding to your dataset
         :return: A tuple of (mean, std) with size of (3,)
         """
 
-        if method == 'weak':
-            loader = DataLoader(dataset=dataset,
-                                batch_size=batch_size,
-                                shuffle=False,
-                                num_workers=1,
-                                pin_memory=0)
-            mean = 0.
-            std = 0.
-            nb_samples = 0.
-            for data in loader:
-                data = data['X']
-                batch_samples = data.size(0)
-                data = data.view(batch_samples, data.size(1), -1)
-                mean += data.mean(2).sum(0)
-                std += data.std(2).sum(0)
-                nb_samples += batch_samples
-
-            mean /= nb_samples
-            std /= nb_samples
-
-            return mean, std
-
-        elif method == 'strong':
-            loader = DataLoader(dataset=dataset,
-                                batch_size=1,
-                                shuffle=False,
-                                num_workers=1,
-                                pin_memory=0)
-            cnt = 0
-            fst_moment = torch.empty(3)
-            snd_moment = torch.empty(3)
-
-            for data in loader:
-                data = data['X']
-                b, c, h, w = data.shape
-                nb_pixels = b * h * w
-                sum_ = torch.sum(data, dim=[0, 2, 3])
-                sum_of_square = torch.sum(data ** 2, dim=[0, 2, 3])
-                fst_moment = (cnt * fst_moment + sum_) / (cnt + nb_pixels)
-                snd_moment = (cnt * snd_moment + sum_of_square) / (cnt + nb_pixels)
-
-                cnt += nb_pixels
-
-            return fst_moment, torch.sqrt(snd_moment - fst_moment ** 2)
+        cache_path = None
+        if self.cache_dir is not None:
+            key = hashlib.sha1((dataset.img_names.digest() + dataset.img_dir).encode('utf-8')).hexdigest()
+            cache_path = os.path.join(self.cache_dir, 'mean_std_{}.json'.format(key))
+            if os.path.exists(cache_path):
+                with open(cache_path) as f:
+                    stats = json.load(f)
+                return torch.tensor(stats['mean']), torch.tensor(stats['std'])
+
+        chunks = [range(i, min(i + self.chunk_size, len(dataset)))
+                  for i in range(0, len(dataset), self.chunk_size)]
+        count, mean, m2 = 0, np.zeros(3), np.zeros(3)
+        with multiprocessing.Pool(self.num_workers, initializer=_init_mean_std_worker, initargs=(dataset,)) as pool:
+            for chunk in pool.imap_unordered(_chunk_moments, chunks):
+                count, mean, m2 = self.merge((count, mean, m2), chunk)
+
+        mean = mean / 255.
+        std = np.sqrt(m2 / count) / 255.
+        if cache_path is not None:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            with open(cache_path, 'w') as f:
+                json.dump({'mean': mean.tolist(), 'std': std.tolist(), 'count': count}, f)
+        return torch.tensor(mean), torch.tensor(std)
+
+    @staticmethod
+    def merge(a, b):
+        """
+        Merge two partial results using Chan et al. parallel variance formula.
+
+        :param a: A tuple of (count, mean, M2) where M2 is sum of squared deviations from mean
+        :param b: A tuple of (count, mean, M2)
+        :return: A tuple of (count, mean, M2) of union of both
+        """
+        n_a, mean_a, m2_a = a
+        n_b, mean_b, m2_b = b
+        if n_a == 0:
+            return b
+        if n_b == 0:
+            return a
+        n = n_a + n_b
+        delta = mean_b - mean_a
+        mean = mean_a + delta * n_b / n
+        m2 = m2_a + m2_b + delta ** 2 * n_a * n_b / n
+        return n, mean, m2
+
+
+_mean_std_dataset = None
+"""PlacesDataset object of a OnlineMeanStd worker process"""
+
+
+def _init_mean_std_worker(dataset):
+    global _mean_std_dataset
+    if dataset.tf is not None:  # do not share the parent's file offset
+        dataset.tf = tarfile.open(dataset.img_dir)
+    _mean_std_dataset = dataset
+
+
+def _chunk_moments(indices):
+    """
+    Return (count, mean, M2) per channel of all pixels of images in ``indices``.
+
+    :param indices: indices of images in the worker's dataset
+    :return: A tuple of (count, mean, M2)
+    """
+
+    dataset = _mean_std_dataset
+    values = np.arange(256, dtype=np.float64)
+    count = 0
+    sum_ = np.zeros(3)
+    sum_of_square = np.zeros(3)
+    for index in indices:
+        image = dataset.get_image(index)
+        pixels = np.asarray(image.convert('RGB'), dtype=np.uint8).reshape(-1, 3)
+        count += pixels.shape[0]
+        for c in range(3):
+            hist = np.bincount(pixels[:, c], minlength=256).astype(np.float64)
+            sum_[c] += hist.dot(values)
+            sum_of_square[c] += hist.dot(values ** 2)
+
+    if count == 0:
+        return 0, np.zeros(3), np.zeros(3)
+    mean = sum_ / count
+    return count, mean, sum_of_square - count * mean ** 2
+
+
 # %% test
@@ -0,0 +1,126 @@
+# %% libraries
+import argparse
+import os
+
+import torch
+from PIL import Image
+from torchvision.transforms import Compose, ToTensor, Normalize
+
+from models.object_net import ModelBuilder, SegmentationModule
+from utils.preprocess import PlacesDataset, segmentation_path
+
+
+# %% functions
+def build_object_net(weights_dir='pretrained/baseline-resnet101dilated-ppm_deepsup', epoch=25):
+    """
+    Build the pretrained ObjectNet of ``train.py`` (ResNet-101 dilated encoder, PPM decoder) in eval mode
+
+    :param weights_dir: folder of encoder and decoder weights
+    :param epoch: epoch of the weights to load
+    :return: SegmentationModule object
+    """
+
+    builder = ModelBuilder()
+    net_encoder = builder.build_encoder(arch='resnet101dilated', fc_dim=2048,
+                                        weights=os.path.join(weights_dir, 'encoder_epoch_{}.pth'.format(epoch)))
+    net_decoder = builder.build_decoder(arch='ppm_deepsup', fc_dim=2048, num_class=150,
+                                        weights=os.path.join(weights_dir, 'decoder_epoch_{}.pth'.format(epoch)),
+                                        use_softmax=True)
+    return SegmentationModule(net_encoder, net_decoder, None).eval()
+
+
+class _Images(torch.utils.data.Dataset):
+    def __init__(self, dataset, indices, max_size):
+        """
+        Ground truth images of a PlacesDataset normalized like ImageNet for ObjectNet; images larger than
+        ``max_size`` are segmented at a lower resolution and their maps are upsampled to full resolution.
+        """
+
+        self.dataset = dataset
+        self.indices = indices
+        self.max_size = max_size
+        self.to_tensor = Compose([ToTensor(), Normalize(mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225])])
+
+    def __len__(self):
+        return len(self.indices)
+
+    def __getitem__(self, i):
+        index = self.indices[i]
+        image = self.dataset.get_image(index).convert('RGB')
+        size = image.size
+        if self.max_size and max(size) > self.max_size:
+            image.thumbnail((self.max_size, self.max_size), Image.BILINEAR)
+        return index, self.to_tensor(image), size
+
+
+def _single(batch):
+    return batch[0]
+
+
+def segment(object_net, image, size):
+    """
+    Segment an image into our 25 classes
+
+    :param object_net: SegmentationModule object in eval mode
+    :param image: normalized tensor of shape (1, 3, H, W) on the device of ``object_net``
+    :param size: (width, height) of the label map, the full resolution of the image
+    :return: uint8 numpy array (height, width) of class + 1, as stored in the cache
+    """
+
+    with torch.no_grad():
+        labels = object_net({'img_data': image}, segSize=(size[1], size[0]))
+    return (labels[0] + 1).byte().cpu().numpy()
+
+
+def build_cache(dataset, object_net, seg_dir, device, num_workers=4, max_size=1024, num_shards=1, shard=0):
+    """
+    Segment every image of a data set once and store the maps as PNG files under ``seg_dir``, mirroring the names of
+    the file list. Images already cached are skipped, so an interrupted run continues where it stopped.
+
+    :param dataset: PlacesDataset object
+    :param object_net: SegmentationModule object in eval mode on ``device``
+    :param seg_dir: root folder of the cache
+    :param device: torch device of ``object_net``
+    :param num_workers: number of processes reading and decoding images
+    :param max_size: longer side of images fed to ObjectNet, 0 for full resolution
+    :param num_shards: number of jobs sharing the data set, e.g. one per GPU
+    :param shard: index of this job, images ``shard::num_shards`` are segmented
+    :return: number of images segmented
+    """
+
+    indices = [i for i in range(shard, len(dataset), num_shards)
+               if not os.path.isfile(segmentation_path(seg_dir, dataset.img_names[i]))]
+    loader = torch.utils.data.DataLoader(_Images(dataset, indices, max_size), batch_size=1, num_workers=num_workers,
+                                         collate_fn=_single)
+    for n, (index, image, size) in enumerate(loader):
+        labels = segment(object_net, image.unsqueeze(0).to(device), size)
+        path = segmentation_path(seg_dir, dataset.img_names[index])
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        Image.fromarray(labels, mode='L').save(path + '.tmp', format='PNG', compress_level=6)
+        os.replace(path + '.tmp', path)  # a killed job never leaves a truncated map behind
+        if (n + 1) % 1000 == 0:
+            print('segmented', n + 1, 'of', len(indices))
+    return len(indices)
+
+
+# %% command line tool
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Cache ObjectNet segmentations of a training set, one PNG per image')
+    parser.add_argument('--txt', type=str, required=True, help='file list (or its .idx index) of images')
+    parser.add_argument('--img', type=str, required=True, help='image folder or uncompressed tar archive')
+    parser.add_argument('--meta', type=str, default=None, help='metadata sidecar of utils/metadata.py')
+    parser.add_argument('--out', type=str, required=True, help='root folder of the cache')
+    parser.add_argument('--weights', type=str, default='pretrained/baseline-resnet101dilated-ppm_deepsup',
+                        help='folder of ObjectNet weights')
+    parser.add_argument('--max_size', type=int, default=1024, help='longer side fed to ObjectNet, 0 for full size')
+    parser.add_argument('--nw', type=int, default=4, help='number of reading processes')
+    parser.add_argument('--num_shards', type=int, default=1, help='number of jobs sharing the images')
+    parser.add_argument('--shard', type=int, default=0, help='index of this job')
+    opt = parser.parse_args()
+
+    device = torch.device('cuda:0' if torch.cuda.is_available() else 'cpu')
+    dataset = PlacesDataset(txt_path=opt.txt, img_dir=opt.img, meta_path=opt.meta, test=True)
+    object_net = build_object_net(opt.weights).to(device)
+    count = build_cache(dataset, object_net, opt.out, device, num_workers=opt.nw, max_size=opt.max_size,
+                        num_shards=opt.num_shards, shard=opt.shard)
+    print('segmented', count, 'images into', opt.out)
@@ -0,0 +1,163 @@
+# %% libraries
+import collections
+import os
+import sys
+
+import torch
+import torch.multiprocessing as multiprocessing
+
+from lib.utils.data.dataloader import ExceptionWrapper
+from utils.segcache import build_object_net
+
+
+# %% workers
+def _segment_loop(weights_dir, coarse_net, threads, cpus, in_queue, out_queue):
+    """
+    Loop of a segmenter process: segment batches of ``in_queue`` into ``out_queue`` until None is received
+    """
+
+    torch.set_num_threads(threads)
+    if cpus is not None:
+        os.sched_setaffinity(0, cpus)
+    try:
+        object_net = build_object_net(weights_dir)
+        if coarse_net is not None:
+            coarse_net.eval()  # this copy only; parameters and running statistics stay shared with the trainer
+    except Exception:
+        out_queue.put((None, ExceptionWrapper(sys.exc_info())))
+        return
+
+    while True:
+        item = in_queue.get()
+        if item is None:
+            break
+        seq, images = item
+        try:
+            with torch.no_grad():
+                if coarse_net is not None:
+                    images = coarse_net(images.to(next(coarse_net.parameters()).device)).cpu()
+                labels = object_net({'img_data': images}, segSize=(images.size(2), images.size(3)))
+            out_queue.put((seq, labels.byte() + 1))  # class + 1 as in the segmentation cache
+        except Exception:
+            out_queue.put((seq, ExceptionWrapper(sys.exc_info())))
+
+
+# %% segmenter
+class AsyncSegmenter(object):
+    def __init__(self, weights_dir='pretrained/baseline-resnet101dilated-ppm_deepsup', mode='target', coarse_net=None,
+                 num_workers=1, threads=4, cpus=None, depth=2):
+        """
+        Run the frozen ObjectNet in separate processes with their own thread budget, so segmentation overlaps with
+        training instead of running inside ``train_model``. Images go to the processes and 25-class maps come back
+        through queues of shared memory tensors.
+
+        Wrap train batches with ``pipeline``: each batch is sent for segmentation as soon as it is loaded and returned
+        ``depth`` batches later with its map under 'y_object', like batches of the segmentation cache.
+
+        :param weights_dir: folder of ObjectNet weights
+        :param mode: 'target' segments ground truth crops ('y_descreen'); 'coarse' segments outputs of ``coarse_net``
+            on halftone crops ('x'), computed in the segmenter process with the trainer's current weights
+        :param coarse_net: CoarseNet of the trainer, required in 'coarse' mode. Its parameters are moved to shared
+            memory and read while the trainer updates them (Hogwild style), so maps of a batch come from weights at
+            most ``depth`` steps older than those it is trained with
+        :param num_workers: number of segmenter processes
+        :param threads: intra-op threads of each process
+        :param cpus: optional list of CPU ids per process (``os.sched_setaffinity``), e.g. the cores of one socket
+        :param depth: number of batches segmented ahead of training; bounds queued memory and staleness
+        """
+
+        if mode not in ('target', 'coarse'):
+            raise ValueError("mode should be 'target' or 'coarse', but got {}".format(mode))
+        if mode == 'coarse' and coarse_net is None:
+            raise ValueError("'coarse' mode needs coarse_net")
+
+        self.mode = mode
+        self.key = 'y_descreen' if mode == 'target' else 'x'
+        self.depth = depth
+        if coarse_net is not None:
+            coarse_net.share_memory()
+        context = multiprocessing.get_context('spawn')  # forked OpenMP thread pools misbehave
+        self.in_queue = context.Queue()
+        self.out_queue = context.Queue()
+        self.workers = [
+            context.Process(target=_segment_loop,
+                            args=(weights_dir, coarse_net if mode == 'coarse' else None, threads,
+                                  None if cpus is None else cpus[i], self.in_queue, self.out_queue))
+            for i in range(num_workers)]
+        for w in self.workers:
+            w.daemon = True
+            w.start()
+        self.sent = 0
+        self.ready = {}
+        self.abandoned = set()  # tickets of batches a stopped pipeline will never ask for
+        self.closed = False
+
+    def submit(self, images):
+        """
+        Send a batch of images for segmentation
+
+        :param images: tensor (B, 3, H, W); its memory must not be reused before ``get`` returns, see ``pipeline``
+        :return: ticket to pass to ``get``
+        """
+
+        seq = self.sent
+        self.in_queue.put((seq, images.detach().cpu()))
+        self.sent += 1
+        return seq
+
+    def get(self, seq):
+        """
+        Wait for the map of a submitted batch
+
+        :param seq: ticket returned by ``submit``
+        :return: uint8 tensor (B, H, W) of class + 1, 0 where no class is known
+        """
+
+        while seq not in self.ready:
+            s, labels = self.out_queue.get()
+            if isinstance(labels, ExceptionWrapper):
+                raise labels.exc_type(labels.exc_msg)
+            if s in self.abandoned:
+                self.abandoned.discard(s)
+                continue
+            self.ready[s] = labels
+        return self.ready.pop(seq)
+
+    def pipeline(self, batches):
+        """
+        Add maps of the segmenter to batches under 'y_object', ``depth`` batches ahead of the consumer. Held batches
+        are copied, since a DataLoader with ``batch_slots`` overwrites a slot as soon as the next batch is requested
+
+        :param batches: iterable of batches as dicts, e.g. a DataLoader
+        :return: generator of batches
+        """
+
+        pending = collections.deque()
+        try:
+            for batch in batches:
+                batch = {key: value.clone() if torch.is_tensor(value) else value for key, value in batch.items()}
+                pending.append((self.submit(batch[self.key]), batch))
+                if len(pending) > self.depth:
+                    seq, batch = pending.popleft()
+                    batch['y_object'] = self.get(seq)
+                    yield batch
+            while len(pending) > 0:
+                seq, batch = pending.popleft()
+                batch['y_object'] = self.get(seq)
+                yield batch
+        finally:  # e.g. a loop broken off early
+            for seq, _ in pending:
+                if self.ready.pop(seq, None) is None:
+                    self.abandoned.add(seq)
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        for _ in self.workers:
+            self.in_queue.put(None)
+        for w in self.workers:
+            w.join()
+
+    def __del__(self):
+        self.close()
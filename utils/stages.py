@@ -0,0 +1,106 @@
+# %% libraries
+import json
+import os
+
+import numpy as np
+import torch
+from torch.utils.data import Dataset
+
+from utils.losses import autocast
+
+
+# %% constants
+FIELDS = {'x': (3, np.float16),
+          'y_descreen': (3, np.float16),
+          'y_edge': (1, np.uint8),
+          'y_object': (None, np.uint8),
+          'coarse_outputs': (3, np.float16),
+          'edge_outputs': (1, np.float16)}
+"""Arrays of a stage cache: number of channels (None for a label map of shape (H, W)) and stored type"""
+
+
+# %% classes
+class StageCache(Dataset):
+    def __init__(self, cache_dir):
+        """
+        Crops of the train set with outputs of frozen CoarseNet and EdgeNet, written by ``build_stage_cache``. Arrays
+        are memory-mapped, so workers of a DataLoader share the page cache instead of copies.
+
+        Samples hold the keys of PlacesDataset samples ('x', 'y_descreen', 'y_edge', 'y_object', 'index') plus
+        'coarse_outputs' and 'edge_outputs'; floating point tensors stay float16 and are meant to be cast on device.
+
+        :param cache_dir: folder of the cache
+        """
+
+        with open(os.path.join(cache_dir, 'meta.json')) as f:
+            meta = json.load(f)
+        self.cache_dir = cache_dir
+        self.count = meta['count']
+        self.size = meta['size']
+        self.arrays = {name: np.load(os.path.join(cache_dir, name + '.npy'), mmap_mode='r') for name in FIELDS}
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, index):
+        sample = {name: torch.from_numpy(np.array(array[index])) for name, array in self.arrays.items()}
+        sample['y_edge'] = sample['y_edge'].float()
+        sample['index'] = int(index)
+        return sample
+
+
+# %% functions
+def build_stage_cache(batches, coarse_net, edge_net, object_net, cache_dir, num_samples, size, device, amp=False):
+    """
+    Phase 2 of staged training: run frozen CoarseNet and EdgeNet (and ObjectNet unless batches already hold
+    'y_object') once per crop and store crops and outputs in float16 arrays (label maps in uint8). Every crop costs
+    ``22 * size * size`` bytes, about 1.1 MB at 224.
+
+    :param batches: iterable of train batches with crops of ``size``, flattened if multi-crop
+    :param coarse_net: trained CoarseNet
+    :param edge_net: trained EdgeNet
+    :param object_net: SegmentationModule object, used for batches without 'y_object'
+    :param cache_dir: folder of the cache, created if missing
+    :param num_samples: number of crops to store; fewer are stored if ``batches`` runs out
+    :param size: size of square crops
+    :param device: torch device of the networks
+    :param amp: run networks under bf16 autocast
+    :return: StageCache object
+    """
+
+    os.makedirs(cache_dir, exist_ok=True)
+    arrays = {}
+    for name, (channels, dtype) in FIELDS.items():
+        shape = (num_samples, size, size) if channels is None else (num_samples, channels, size, size)
+        arrays[name] = np.lib.format.open_memmap(os.path.join(cache_dir, name + '.npy'), mode='w+', dtype=dtype,
+                                                 shape=shape)
+
+    coarse_net.eval()
+    edge_net.eval()
+    count = 0
+    with torch.no_grad():
+        for data in batches:
+            n = min(data['x'].size(0), num_samples - count)
+            if n <= 0:
+                break
+            x = data['x'][:n].to(device)
+            with autocast(device.type, enabled=amp):
+                coarse_outputs = coarse_net(x)
+                edge_outputs = edge_net(x)
+                if 'y_object' in data:
+                    y_object = data['y_object'][:n]
+                else:
+                    y_object = object_net({'img_data': coarse_outputs}, segSize=(size, size)).byte() + 1
+            values = {'x': x, 'y_descreen': data['y_descreen'][:n], 'y_edge': data['y_edge'][:n], 'y_object': y_object,
+                      'coarse_outputs': coarse_outputs, 'edge_outputs': edge_outputs}
+            for name, value in values.items():
+                arrays[name][count:count + n] = value.float().cpu().numpy().astype(FIELDS[name][1])
+            count += n
+            if count % 10000 < n:
+                print('cached', count, 'of', num_samples, 'crops')
+
+    for array in arrays.values():
+        array.flush()
+    with open(os.path.join(cache_dir, 'meta.json'), 'w') as f:
+        json.dump({'count': count, 'size': size}, f)
+    return StageCache(cache_dir)
@@ -0,0 +1,203 @@
+# %% libraries
+import json
+import os
+import queue
+import threading
+
+import numpy as np
+import torch
+from PIL import Image
+
+
+# %% sources
+class FileListSource(object):
+    def __init__(self, dataset, shuffle=True, num_shards=1, shard=0):
+        """
+        Stream ground truth images of a PlacesDataset (file list over a folder or tar archive).
+
+        :param dataset: PlacesDataset object
+        :param shuffle: visit images in a new random order on every pass
+        :param num_shards: number of readers sharing this source, e.g. DataLoader workers
+        :param shard: index of this reader, images ``shard::num_shards`` of each pass are read
+        """
+
+        self.dataset = dataset
+        self.shuffle = shuffle
+        self.num_shards = num_shards
+        self.shard = shard
+
+    def __iter__(self):
+        if self.shuffle:
+            order = torch.randperm(len(self.dataset)).numpy()[self.shard::self.num_shards]
+        else:
+            order = range(self.shard, len(self.dataset), self.num_shards)
+        for index in order:
+            yield self.dataset.get_image(index)
+
+
+class OdgtSource(object):
+    def __init__(self, odgt_path, root='', num_shards=1, shard=0):
+        """
+        Stream images listed in an ``.odgt`` file (one JSON record per line, as in ``data/validation.odgt``). Lines
+        are parsed lazily while reading, the file is never loaded as a whole.
+
+        :param odgt_path: path to the ``.odgt`` file
+        :param root: directory ``fpath_img`` of records is relative to
+        :param num_shards: number of readers sharing this source, e.g. DataLoader workers
+        :param shard: index of this reader, records ``shard::num_shards`` are read
+        """
+
+        self.odgt_path = odgt_path
+        self.root = root
+        self.num_shards = num_shards
+        self.shard = shard
+
+    def __iter__(self):
+        with open(self.odgt_path) as f:
+            for i, line in enumerate(f):
+                if i % self.num_shards != self.shard or len(line.strip()) == 0:
+                    continue
+                record = json.loads(line)
+                yield Image.open(os.path.join(self.root, record['fpath_img']))
+
+
+# %% interleaving
+_END = object()
+"""Put in the queue of a source when it is exhausted"""
+
+
+class _SourceReader(threading.Thread):
+    def __init__(self, source, processor, prefetch, repeat, stop_event, rng):
+        """
+        Background thread reading one source into its own bounded queue of ready samples. Transforms are drawn from
+        the reader's own ``rng`` (np.random.RandomState), so readers never share random state.
+        """
+
+        super(_SourceReader, self).__init__()
+        self.daemon = True
+        self.source = source
+        self.processor = processor
+        self.queue = queue.Queue(maxsize=prefetch)
+        self.repeat = repeat
+        self.stop_event = stop_event
+        self.rng = rng
+        self.errors = 0
+
+    def _put(self, item):
+        while not self.stop_event.is_set():
+            try:
+                self.queue.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def run(self):
+        while not self.stop_event.is_set():
+            empty = True
+            for image in self.source:
+                empty = False
+                try:
+                    sample = self.processor.make_sample(image.convert('RGB'), rng=self.rng)
+                except Exception:  # a broken image must not kill the stream
+                    self.errors += 1
+                    continue
+                if not self._put(sample):
+                    return
+            if not self.repeat or empty:
+                break
+        self._put(_END)
+
+
+class InterleavedDataset(object):
+    def __init__(self, sources, processor, weights=None, prefetch=32, repeat=True, seed=None):
+        """
+        Streaming data set interleaving several image sources (e.g. Places365 file list and ADE20K ``.odgt``).
+
+        Every source is read by its own thread into its own bounded prefetch queue. The next sample is drawn from
+        a source chosen by ``weights``; if that source has nothing ready, a ready source is taken instead, so a slow
+        source lowers its own share for a while but never stalls the batch.
+
+        The stream is not a map-style data set, so it is consumed through ``batches`` in place of a DataLoader, e.g.
+        ``for data in InterleavedDataset([FileListSource(places), OdgtSource('data/training.odgt', root)], places,
+        weights=[3, 1]).batches(args.bs)`` as ``data_loader`` of ``train_model`` (with ``epochs=1`` and
+        ``repeat=False``, or a bounded number of steps). Readers are threads, so halftoning and transforms run in
+        parallel only where they release the GIL. To spread them over processes, run one InterleavedDataset per
+        process (e.g. per rank of distributed training) on sources built with ``num_shards`` and ``shard``, so
+        every process reads its own share of each source.
+
+        :param sources: list of iterables of PIL images, e.g. FileListSource or OdgtSource objects
+        :param processor: PlacesDataset object whose ``make_sample`` halftones and transforms images
+        :param weights: relative sampling weight of each source (default: uniform)
+        :param prefetch: maximum number of ready samples queued per source
+        :param repeat: restart exhausted sources, so the stream is infinite and weights hold
+        :param seed: seed of source selection and of the transforms drawn by readers
+        """
+
+        self.sources = sources
+        self.processor = processor
+        weights = np.ones(len(sources)) if weights is None else np.asarray(weights, dtype=np.float64)
+        self.weights = weights / weights.sum()
+        self.prefetch = prefetch
+        self.repeat = repeat
+        self.seed = seed
+
+    def __iter__(self):
+        """
+        Yields samples as dicts like PlacesDataset, plus the index of their source under 'source'
+        """
+
+        rng = np.random.RandomState(self.seed)
+        stop_event = threading.Event()
+        readers = [_SourceReader(source, self.processor, self.prefetch, self.repeat, stop_event,
+                                 np.random.RandomState(None if self.seed is None else self.seed + 1 + k))
+                   for k, source in enumerate(self.sources)]
+        for reader in readers:
+            reader.start()
+
+        active = [k for k in range(len(readers)) if self.weights[k] > 0]
+        try:
+            while len(active) > 0:
+                k = active[rng.choice(len(active), p=self._normalize(active))]
+                try:
+                    item = readers[k].queue.get_nowait()
+                except queue.Empty:
+                    ready = [j for j in active if not readers[j].queue.empty()]
+                    if len(ready) > 0:  # take a ready source instead of waiting for a slow one
+                        k = ready[rng.choice(len(ready), p=self._normalize(ready))]
+                    try:
+                        item = readers[k].queue.get(timeout=0.05)
+                    except queue.Empty:
+                        continue
+                if item is _END:
+                    active.remove(k)
+                    continue
+                item['source'] = k
+                yield item
+        finally:
+            stop_event.set()
+
+    def _normalize(self, indices):
+        w = self.weights[indices]
+        return w / w.sum()
+
+    def batches(self, batch_size, collate_fn=None):
+        """
+        Yield collated batches of the stream
+
+        :param batch_size: number of samples per batch
+        :param collate_fn: merges a list of samples, ``default_collate`` of lib DataLoader by default
+        :return: generator of batches
+        """
+
+        if collate_fn is None:
+            from lib.utils.data.dataloader import default_collate
+            collate_fn = default_collate
+        batch = []
+        for sample in self:
+            batch.append(sample)
+            if len(batch) == batch_size:
+                yield collate_fn(batch)
+                batch = []
+        if len(batch) > 0:
+            yield collate_fn(batch)